@@ -15,10 +15,12 @@ from .predict import predict_router
 try:
     import infiagent
     from infiagent.schemas import FailedResponseBaseData
+    from infiagent.tools import AsyncPythonSandBoxTool
     from infiagent.utils import get_logger, init_logging, log_id_var
 except ImportError:
     print("import infiagent failed, please install infiagent by 'pip install .' in the pipeline directory of ADA-Agent")
     from ..schemas import FailedResponseBaseData
+    from ..tools import AsyncPythonSandBoxTool
     from ..utils import get_logger, init_logging, log_id_var
 
 asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
@@ -44,6 +46,11 @@ app.include_router(complete_chat_router)
 app.include_router(predict_router)
 
 
+@app.get("/sandbox_metrics")
+async def sandbox_metrics():
+    return AsyncPythonSandBoxTool.kernel_metrics()
+
+
 @app.middleware("http")
 async def log_id_middleware(request: Request, call_next):
     # Get X-Tt-Logid from request headers
@@ -20,6 +20,7 @@ async def chat_predict(
     temperature: Optional[str] = Form(None),
     top_p: Optional[str] = Form(None),
     top_k: Optional[str] = Form(None),
+    session_id: Optional[str] = Form(None),
     files: List[UploadFile] = File(...)
 ):
     kwargs = {}
@@ -33,6 +34,9 @@ async def chat_predict(
         kwargs['top_p'] = float(top_p)
     if top_k:
         kwargs['top_k'] = float(top_k)
+    if session_id:
+        # Resumes the sandbox of an earlier request with this id, from its kernel snapshot when enabled
+        kwargs['session_id'] = session_id
 
     response = await predict(prompt, model_name, files, **kwargs)
 
@@ -18,6 +18,7 @@ logger = get_logger()
 
 
 LLM_CONF_OVERRIDE_KEY = ['psm', 'dc', 'temperature', 'top_p', 'top_k', 'max_tokens']
+LLM_CONTEXT_KEYS = ['context_window', 'tokenizer']
 
 
 class BaseAgent(ABC):
@@ -168,9 +169,11 @@ class BaseAgent(ABC):
         if isinstance(obj, str):
             name = obj
             model_params = dict()
+            context_config = dict()
         else:
             name = obj.get('model_name', None)
             model_params = obj.get('params', dict())
+            context_config = {key: obj[key] for key in LLM_CONTEXT_KEYS if key in obj}
 
         module_name = obj['module_name']
         class_name = obj['class_name']
@@ -178,7 +181,7 @@ class BaseAgent(ABC):
         module = import_module(module_name)
         clazz = getattr(module, class_name)
 
-        llm = clazz(model_name=name, params=model_params)
+        llm = clazz(model_name=name, params=model_params, **context_config)
         self.llm = llm
 
     def _init_plugins(self, configs):
@@ -240,6 +243,8 @@ class BaseAgent(ABC):
         clazz = getattr(module, llm_class_name)
         assert issubclass(clazz, BaseLLM), f"{clazz} is not a subclass of BaseLLM"
         llm_instance = await clazz.create(config_data=llm_config)
+        # At startup, alongside the plugins, rather than on the first prompt
+        await llm_instance.load_tokenizer()
         return llm_instance
 
     @classmethod
@@ -1,16 +1,21 @@
+import asyncio
 import re
 import time
-from typing import Union, List, Dict
+from typing import AsyncGenerator, Callable, Union, List, Dict, Optional
 
 from werkzeug.datastructures import FileStorage
 
 from .. import BaseAgent
 from ...exceptions.exceptions import InternalErrorException, LLMException, SandboxException
+from ...prompt import IncrementalPrompt
+from .completion_stream import CompletionStopDetector
 from ...schemas import (
-    AgentType, AgentRequest, AgentFinish, AgentAction, AgentResponse,
-    BaseAgentResponse, AgentObservation, RunCodeOutput, MediaFile
+    AgentType, AgentRequest, AgentFinish, AgentAction, AgentMultiAction, AgentResponse,
+    BaseAgentResponse, AgentObservation, RunCodeOutput, MediaFile, BaseCompletion
 )
-from ...tools import PythonSandBoxToolResponse, AsyncPythonSandBoxTool
+from ...tools import PythonSandBoxToolResponse, SandboxEngine, SandboxResponse
+from ...tools.code_sandbox.output_capture import STREAM_QUEUE_SIZE
+from ...tools.execution_cache import is_side_effect_free
 from ...utils import get_logger, replace_latex_format, extract_and_replace_url, \
     OBSERVATION_PREFIX_CN, OBSERVATION_PREFIX_EN, AGENT_FAILED_CN, AGENT_FAILED_EN, \
     TOOL_INPUT_PREFIX_CN, TOOL_INPUT_PREFIX_EN
@@ -27,16 +32,62 @@ FINAL_ANSWER_INDICATORS = ["Final Answer:", "[END]", "The final Answer", "final
 CODE_BLOCK_START_TAG = '```python'
 CODE_BLOCK_TAG = '```'
 STOP_WORD = ['Observation:']
+# One Action and Action Input of an output holding several, "Then" marks an action that waits for the one before
+MULTI_ACTION_REGEX = r"(Then\s+)?Action:\s*(.*?)\n?Action\s*Input:\s*```(?:python|py)\n(.*?)```"
+PARALLEL_ACTIONS_HINT = ("Independent actions can be given together, one Action and Action Input after the other, "
+                         "actions on different tools run at the same time, actions on the same tool one after the "
+                         "other. Start an action with \"Then Action:\" when it needs the result of the action "
+                         "before it.\n")
 
 logger = get_logger()
 
 
+class _SpeculativeStep:
+    """
+    Sandbox step started as soon as the code block of the action was complete, while the LLM generation was still
+    being stopped. The output waits in a bounded queue until the agent loop gets to the step. Cancelling a step
+    interrupts its code in the sandbox.
+    """
+    _END = object()
+
+    def __init__(self, action: AgentAction, chunks: AsyncGenerator):
+        self.action = action
+        self._queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        self._task = asyncio.ensure_future(self._run(chunks))
+
+    async def _run(self, chunks: AsyncGenerator):
+        try:
+            async for chunk in chunks:
+                await self._queue.put(chunk)
+        except Exception as e:
+            await self._queue.put(e)
+        await self._queue.put(self._END)
+
+    async def __aiter__(self):
+        while True:
+            chunk = await self._queue.get()
+            if chunk is self._END:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def cancel(self):
+        self._task.cancel()
+
+
 class AsyncReactAgent(BaseAgent):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self._name = self._name or "AsyncReactAgent"
         self._type = AgentType.react
         self.__intermediate_steps: List[BaseAgentResponse] = []
+        self.__prompt: Optional[IncrementalPrompt] = None
+        # Run the code of an action while the LLM generation is still being stopped, instead of after it
+        self._speculative_execution = bool(kwargs.get('speculative_execution', False))
+        # Accept several actions in one model output and run them in the same round
+        self._parallel_actions = bool(kwargs.get('parallel_actions', False))
+        self.__speculative_step: Optional[_SpeculativeStep] = None
 
     @property
     def intermediate_steps(self):
@@ -45,11 +96,23 @@ class AsyncReactAgent(BaseAgent):
     def run(self, *args, **kwargs):
         pass
 
+    def _sandbox_plugin_name(self) -> str:
+        """The sandbox plugin, the one named python_code_sandbox if there are several."""
+        plugins_map = self.plugins_map
+        if isinstance(plugins_map.get(SAND_BOX_PLUGIN_NAME), SandboxEngine):
+            return SAND_BOX_PLUGIN_NAME
+        for name, plugin in plugins_map.items():
+            if isinstance(plugin, SandboxEngine):
+                return name
+        raise InternalErrorException("SandBox client is not ready for agent, please check init logic.")
+
+    def _resolve_tool(self, tool: str) -> str:
+        # The model names its tool freely, actions on unknown tools run in the sandbox
+        return tool if tool in self.plugins_map else self._sandbox_plugin_name()
+
     async def sync_to_sandbox(self, file: Union[str, Dict, FileStorage]):
-        sandbox_plugin = self.plugins_map.get(SAND_BOX_PLUGIN_NAME)
-        if not isinstance(sandbox_plugin, (AsyncPythonSandBoxTool, AsyncPythonSandBoxTool)):
-            raise InternalErrorException("SandBox client is not ready for agent, please check init logic.")
-        return await sandbox_plugin.sync_to_sandbox(file)
+        sandbox_plugin = self.plugins_map[self._sandbox_plugin_name()]
+        return await sandbox_plugin.upload(file)
 
     async def async_run(self, agent_req: AgentRequest):
         instruction = '\n'.join(message.content for message in agent_req.messages)
@@ -75,8 +138,20 @@ class AsyncReactAgent(BaseAgent):
                 break
 
             self.intermediate_steps.append(llm_response)
-            action_response, cur_output_files = await self._process_agent_action(llm_response, current_iteration,
-                                                                                 max_iterations, is_cn)
+            action_response, cur_output_files = None, []
+            if isinstance(llm_response, AgentMultiAction):
+                # Outputs of concurrent actions would interleave, they are returned once all finished
+                action_response, cur_output_files = await self._process_agent_actions(llm_response,
+                                                                                      current_iteration,
+                                                                                      max_iterations, is_cn)
+            else:
+                async for step in self._stream_agent_action(llm_response, current_iteration, max_iterations,
+                                                            is_cn):
+                    if isinstance(step, AgentResponse):
+                        # Partial observation, the complete one follows once the tool finished
+                        yield step
+                    else:
+                        action_response, cur_output_files = step
             logger.info("Round {} of {}, [Plugin raw output]:\n{}\n[Formatted output]:\n{}\n"
                         .format(current_iteration, max_iterations, action_response.raw_output,
                                 action_response.formatted_output))
@@ -88,52 +163,137 @@ class AsyncReactAgent(BaseAgent):
 
         logger.info(f"Finished iteration in {current_iteration}.")
 
-    # TODO update logic to not be sandbox specific, sandbox related logic should be handled in sandbox client
     async def _process_agent_action(self, response, current_iteration, max_iterations, is_cn: bool = False):
         try:
-            response.tool = 'python_code_sandbox'
+            response.tool = self._resolve_tool(response.tool)
             action_response = await self.get_plugin_tool_async_function()[response.tool](response.tool_input)
-            logger.info(
-                f"Step {current_iteration} of {max_iterations}. Got agent observation raw output:\n"
-                f"{action_response.output_text}")
+            return self._create_observation(response, action_response, current_iteration, max_iterations, is_cn)
 
-            if "STDERR" in action_response.output_text:
-                formatted_output = self._process_sandbox_output(action_response.output_text)
-            else:
-                formatted_output = action_response.output_text
-
-            formatted_output = replace_latex_format(formatted_output)
-            observation_prefix = OBSERVATION_PREFIX_CN if is_cn else OBSERVATION_PREFIX_EN
-            formatted_output = f"{observation_prefix}\n{formatted_output}\n"
-
-            action_observation = AgentObservation(tool=response.tool,
-                                                  formatted_output=formatted_output,
-                                                  raw_output=action_response.output_text)
-            cur_output_files = self._get_output_files(action_response)
-            return action_observation, cur_output_files
+        except Exception as e:
+            logger.error(f"Error occurred while executing tool {response.tool} with input {response.tool_input}. "
+                         f"Error: {str(e)}", exc_info=True)
+            raise SandboxException("Error occurred while running the tool") from e
 
+    async def _stream_agent_action(self, response, current_iteration, max_iterations, is_cn: bool = False):
+        """
+        Like _process_agent_action, but yield partial AgentResponses with the tool output as it is produced, then the
+        (observation, output files) tuple. Plugins other than sandbox engines yield the tuple only.
+        """
+        response.tool = self._resolve_tool(response.tool)
+        plugin = self.plugins_map[response.tool]
+        if not isinstance(plugin, SandboxEngine):
+            yield await self._process_agent_action(response, current_iteration, max_iterations, is_cn)
+            return
+
+        action_response = None
+        speculative_step, self.__speculative_step = self.__speculative_step, None
+        if speculative_step is not None and speculative_step.action is not response:
+            speculative_step.cancel()
+            speculative_step = None
+        try:
+            chunks = speculative_step if speculative_step is not None else plugin.run_step(response.tool_input)
+            async for chunk in chunks:
+                if isinstance(chunk, str):
+                    yield self.create_agent_response(chunk, [], chunk, is_partial=True)
+                else:
+                    action_response = chunk
         except Exception as e:
             logger.error(f"Error occurred while executing tool {response.tool} with input {response.tool_input}. "
                          f"Error: {str(e)}", exc_info=True)
-            # TODO: We hard code here as we only have one tool
             raise SandboxException("Error occurred while running the tool") from e
+        yield self._create_observation(response, action_response, current_iteration, max_iterations, is_cn)
+
+    async def _process_agent_actions(self, response: AgentMultiAction, current_iteration, max_iterations,
+                                     is_cn: bool = False):
+        """
+        Run the actions of a multi-action output, concurrently apart from those marked to run after the previous one,
+        and combine their observations in the order of the actions. A sandbox session runs one cell at a time, the
+        actions on the same sandbox take turns. The first failing action fails the step and cancels the others.
+        """
+        sandbox_locks = {name: asyncio.Lock() for name, plugin in self.plugins_map.items()
+                         if isinstance(plugin, SandboxEngine)}
+        chains: List[List[int]] = []
+        for i, action in enumerate(response.actions):
+            if action.after_previous and chains:
+                chains[-1].append(i)
+            else:
+                chains.append([i])
+
+        results = [None] * len(response.actions)
+
+        async def _run_action(i: int):
+            async for step in self._stream_agent_action(response.actions[i], current_iteration, max_iterations,
+                                                        is_cn):
+                if not isinstance(step, AgentResponse):
+                    results[i] = step
+
+        async def _run_chain(chain: List[int]):
+            for i in chain:
+                lock = sandbox_locks.get(self._resolve_tool(response.actions[i].tool))
+                if lock is None:
+                    await _run_action(i)
+                    continue
+                async with lock:
+                    await _run_action(i)
+
+        tasks = [asyncio.ensure_future(_run_chain(chain)) for chain in chains]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # Their observations would be dropped with the failed step, and their code must not run on unattended
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        observations = [observation for observation, _ in results]
+        action_observation = AgentObservation(tool=response.tool,
+                                              formatted_output="\n".join(observation.formatted_output
+                                                                         for observation in observations),
+                                              raw_output="\n".join(observation.raw_output
+                                                                   for observation in observations))
+        return action_observation, [file for _, output_files in results for file in output_files]
+
+    def _create_observation(self, response, action_response, current_iteration, max_iterations, is_cn: bool = False):
+        logger.info(
+            f"Step {current_iteration} of {max_iterations}. Got agent observation raw output:\n"
+            f"{action_response.output_text}")
+
+        if "STDERR" in action_response.output_text:
+            formatted_output = self._process_sandbox_output(action_response.output_text)
+        else:
+            formatted_output = action_response.output_text
+
+        formatted_output = replace_latex_format(formatted_output)
+        observation_prefix = OBSERVATION_PREFIX_CN if is_cn else OBSERVATION_PREFIX_EN
+        formatted_output = f"{observation_prefix}\n{formatted_output}\n"
+
+        action_observation = AgentObservation(tool=response.tool,
+                                              formatted_output=formatted_output,
+                                              raw_output=action_response.output_text)
+        cur_output_files = self._get_output_files(action_response)
+        return action_observation, cur_output_files
 
     def _compose_prompt(self, instruction) -> str:
         """
         Compose the prompt from template, worker description, examples and instruction.
         """
-        agent_scratchpad = self.prompt_template.construct_scratchpad(self.__intermediate_steps)
-        tool_description = self._get_plugin_description()
-        tool_names = ", ".join(list(self.plugins_map.keys()))
         if self.prompt_template is None:
             raise InternalErrorException("Agent prompt is none, please check init process")
-
-        return self.prompt_template.format(
-            instruction=instruction,
-            agent_scratchpad=agent_scratchpad,
-            tool_description=tool_description,
-            tool_names=tool_names
-        )
+        prompt_variables = {
+            'instruction': instruction,
+            'tool_description': self._get_plugin_description() + (PARALLEL_ACTIONS_HINT if self._parallel_actions
+                                                                  else ""),
+            'tool_names': ", ".join(list(self.plugins_map.keys()))
+        }
+        # Rendered once per run, later rounds only add their steps to the scratchpad
+        if self.__prompt is None or not self.__prompt.matches(**prompt_variables):
+            self.__prompt = IncrementalPrompt(self.prompt_template, count_tokens=self.llm.count_tokens,
+                                              max_tokens=self.llm.prompt_budget, **prompt_variables)
+        prompt = self.__prompt.render(self.__intermediate_steps)
+        if self.llm.prompt_budget is not None:
+            logger.info(f"Prompt of {self.__prompt.token_count} tokens for a budget of {self.llm.prompt_budget}, "
+                        f"{self.__prompt.elided_count} observations cut")
+        return prompt
 
     async def _single_round_thought(self, instruction: str, max_llm_iteration=3, is_cn: bool = False) -> \
             Union[AgentAction, AgentFinish]:
@@ -144,6 +304,8 @@ class AsyncReactAgent(BaseAgent):
         while llm_iteration_count <= max_llm_iteration:
             llm_iteration_count += 1
             try:
+                if self._speculative_execution:
+                    return await self._get_speculative_action(instruction, is_cn)
                 llm_response = await self._get_llm_response(instruction)
                 action_response = self._parse_output(llm_response.content, is_cn)
 
@@ -158,15 +320,64 @@ class AsyncReactAgent(BaseAgent):
                     return AgentFinish(formatted_output=AGENT_FAILED_CN if is_cn else AGENT_FAILED_EN,
                                        raw_output=str(llm_response))
 
-    async def _get_llm_response(self, instruction: str):
+    async def _get_speculative_action(self, instruction: str, is_cn: bool = False) -> Union[AgentAction, AgentFinish]:
+        """
+        Like _get_llm_response and _parse_output, but the code of a sandbox action starts running as soon as the
+        completion holds the whole step, before the generation is stopped and the step handed to the agent loop.
+        Only code the execution cache considers side-effect free starts early, a step that is discarded after all
+        leaves no state behind.
+        """
+        parsed = {}
+
+        def _dispatch(content: str):
+            try:
+                action = self._parse_output(content, is_cn)
+            except LLMException:
+                # Retried by the caller with a fresh completion
+                return
+            parsed[content] = action
+            # The actions of a multi-action output start together in the agent loop
+            if not isinstance(action, AgentAction) or isinstance(action, AgentMultiAction):
+                return
+            action.tool = self._resolve_tool(action.tool)
+            plugin = self.plugins_map[action.tool]
+            if isinstance(plugin, SandboxEngine) and is_side_effect_free(plugin.extract_code(action.tool_input)):
+                self.__speculative_step = _SpeculativeStep(action, plugin.run_step(action.tool_input))
+
+        try:
+            llm_response = await self._get_llm_response(instruction, on_step_complete=_dispatch)
+        except BaseException:
+            # The code may have started already, nobody will read its output
+            if self.__speculative_step is not None:
+                self.__speculative_step.cancel()
+                self.__speculative_step = None
+            raise
+        if llm_response.content in parsed:
+            return parsed[llm_response.content]
+        return self._parse_output(llm_response.content, is_cn)
+
+    async def _get_llm_response(self, instruction: str, on_step_complete: Optional[Callable[[str], None]] = None):
         prompt = self._compose_prompt(instruction)
         logger.info("Send prompt to LLM:\n{}".format(prompt))
-        response = await self.llm.async_completion(prompt)
-        if response.state == "error":
-            raise LLMException("Failed to retrieve response from LLM, error: {}".format(str(response.content)))
-
-        logger.info("Got response from llm, raw response content: \n{}".format(response.content))
-        return response
+        # Consume the completion as it is generated and stop it once the step is complete, the model tends to go on
+        # with an observation of its own
+        detector = CompletionStopDetector(STOP_WORD, stop_at_code_end=not self._parallel_actions)
+        completion = self.llm.async_stream_completion(prompt)
+        try:
+            async for response in completion:
+                if response.state == "error":
+                    raise LLMException("Failed to retrieve response from LLM, error: {}".format(str(response.content)))
+                if detector.feed(response.content):
+                    if on_step_complete is not None:
+                        on_step_complete(detector.text)
+                    break
+        finally:
+            await completion.aclose()
+
+        if detector.done:
+            logger.info("Stopped the LLM generation at the end of the step")
+        logger.info("Got response from llm, raw response content: \n{}".format(detector.text))
+        return BaseCompletion(state="success", content=detector.text)
 
     def _parse_output(self, llm_output: str, is_cn: bool = False) -> Union[AgentAction, AgentFinish]:
 
@@ -185,6 +396,11 @@ class AsyncReactAgent(BaseAgent):
                 formatted_output = replace_latex_format(formatted_output)
                 return AgentFinish(raw_output=llm_output, formatted_output=formatted_output)
 
+        if self._parallel_actions:
+            multi_action = self._parse_multi_action(llm_output, is_cn)
+            if multi_action is not None:
+                return multi_action
+
         # Updated regex pattern for capturing the expected input format
         ACTION_REGEX_1 = r"(.*?)\n?Action:\s*(.*?)\n?Action\s*Input:\s*```python\n(.*?)```(.*?)$|(.*?)\n?'''(\w+)\n?(.*?)\n?'''(.*?)$"
         ACTION_REGEX_2 = r"(.*?)\n?Action:\s*(.*?)\n?Action\s*Input:\s*```py\n(.*?)```(.*?)$|(.*?)\n?'''(\w+)\n?(.*?)\n?'''(.*?)$"
@@ -218,6 +434,30 @@ class AsyncReactAgent(BaseAgent):
         else:
             raise LLMException(f"Unrecognized LLM output format: `{llm_output}`")
 
+    def _parse_multi_action(self, llm_output: str, is_cn: bool = False) -> Optional[AgentMultiAction]:
+        """The actions of an output holding more than one, None for an output with a single action."""
+        matches = list(re.finditer(MULTI_ACTION_REGEX, llm_output, re.DOTALL))
+        if len(matches) < 2:
+            return None
+
+        context = llm_output[:matches[0].start()].strip()
+        prefix = TOOL_INPUT_PREFIX_CN if is_cn else TOOL_INPUT_PREFIX_EN
+        actions = []
+        for match in matches:
+            format_code_block = self._format_code_block(match.group(3).strip())
+            actions.append(AgentAction(tool=match.group(2).strip(),
+                                       tool_input=format_code_block,
+                                       formatted_output="{}\n{}\n".format(prefix, format_code_block),
+                                       raw_output=match.group(0),
+                                       after_previous=bool(match.group(1))))
+        formatted_output = replace_latex_format(context + "\n" + "".join(action.formatted_output
+                                                                           for action in actions))
+        return AgentMultiAction(tool=actions[0].tool,
+                                tool_input=actions[0].tool_input,
+                                formatted_output=formatted_output,
+                                raw_output=llm_output,
+                                actions=actions)
+
     def _format_code_block(self, tool_input):
         stripped_tool_input = tool_input.strip()
 
@@ -268,6 +508,9 @@ class AsyncReactAgent(BaseAgent):
     def _get_output_files(self, tool_response) -> list[MediaFile]:
         output_files = []
 
+        if isinstance(tool_response, SandboxResponse):
+            output_files.extend(tool_response.output_files)
+
         if isinstance(tool_response, PythonSandBoxToolResponse) and isinstance(tool_response.raw_output, RunCodeOutput):
             raw_output = tool_response.raw_output
 
@@ -294,6 +537,7 @@ class AsyncReactAgent(BaseAgent):
         return updated_string
 
     @staticmethod
-    def create_agent_response(formatted_output, output_files, raw_output):
-        return AgentResponse(output_text=formatted_output, output_files=output_files, raw_output_text=raw_output)
+    def create_agent_response(formatted_output, output_files, raw_output, is_partial=False):
+        return AgentResponse(output_text=formatted_output, output_files=output_files, raw_output_text=raw_output,
+                             is_partial=is_partial)
 
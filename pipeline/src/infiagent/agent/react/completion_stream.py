@@ -0,0 +1,73 @@
+import re
+from typing import List, Optional
+
+ACTION_INPUT_PATTERN = re.compile(r"Action\s*Input\s*:")
+CODE_FENCE = "```"
+# The keyword patterns may straddle two chunks, rescans start this far before the new text
+RESCAN_MARGIN = 32
+
+
+class CompletionStopDetector:
+    """
+    Finds where a ReAct step ends in a completion streamed chunk by chunk: at a stop word, where the model starts to
+    make up the observation, or at the close of the code block of the Action Input, after which the step has
+    everything it needs. Every chunk is scanned once, apart from a small margin around chunk boundaries.
+
+    :param stop_words: Words the step ends before.
+    :param stop_at_code_end: End the step with the code block of the first Action Input. Outputs that may hold
+        several actions end at a stop word only.
+    """
+
+    def __init__(self, stop_words: List[str], stop_at_code_end: bool = True):
+        self._stop_words = stop_words
+        self._stop_at_code_end = stop_at_code_end
+        self._text = ""
+        self._scanned = 0
+        self._action_input_end: Optional[int] = None
+        self._code_start: Optional[int] = None
+        self._end: Optional[int] = None
+
+    @property
+    def text(self) -> str:
+        """The completion so far, up to the end of the step once it is found."""
+        return self._text if self._end is None else self._text[:self._end]
+
+    @property
+    def done(self) -> bool:
+        return self._end is not None
+
+    def feed(self, chunk: str) -> bool:
+        """Add a chunk of the completion, returns whether the step is complete."""
+        if self._end is not None:
+            return True
+        self._text += chunk
+        rescan_from = max(self._scanned - RESCAN_MARGIN, 0)
+        self._scanned = len(self._text)
+
+        for stop_word in self._stop_words:
+            index = self._text.find(stop_word, rescan_from)
+            if index != -1 and (self._end is None or index < self._end):
+                self._end = index
+        if self._end is not None:
+            self._end = len(self._text[:self._end].rstrip())
+            return True
+        if not self._stop_at_code_end:
+            return False
+
+        if self._code_start is None:
+            if self._action_input_end is None:
+                match = ACTION_INPUT_PATTERN.search(self._text, rescan_from)
+                if match is None:
+                    return False
+                self._action_input_end = match.end()
+            fence = self._text.find(CODE_FENCE, self._action_input_end)
+            # The code starts after the line of the opening fence, which names the language
+            line_end = self._text.find("\n", fence) if fence != -1 else -1
+            if line_end == -1:
+                return False
+            self._code_start = line_end + 1
+            rescan_from = self._code_start
+        closing_fence = self._text.find(CODE_FENCE, max(rescan_from, self._code_start))
+        if closing_fence != -1:
+            self._end = closing_fence + len(CODE_FENCE)
+        return self._end is not None
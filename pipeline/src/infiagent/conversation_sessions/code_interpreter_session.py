@@ -1,5 +1,6 @@
 import logging
 import os
+import re
 import time
 from typing import Any, Dict, Union
 
@@ -7,7 +8,9 @@ from werkzeug.datastructures import FileStorage
 
 from ..agent import BaseAgent
 from ..agent.react import AsyncReactAgent
+from ..exceptions.exceptions import InputErrorException
 from ..schemas import AgentRequest, MediaFile, Message, RoleType
+from ..tools import SandboxEngine
 from ..utils import generate_random_string, get_logger, get_model_config_path
 
 logger = get_logger()
@@ -36,12 +39,20 @@ class CodeInterpreterSession:
     async def create(cls,
                      model_name: Union[None, str] = "openai",
                      config_path: Union[None, str] = None,
+                     session_id: Union[None, str] = None,
                      **kwargs: Dict[str, Any]):
+        """
+        Create a session. Passing the session_id of an earlier session resumes it, its sandbox variables are loaded
+        from the kernel snapshot on the first execution instead of replaying the earlier steps.
+        """
         if config_path is None:
             config_path = get_model_config_path(model_name)
         logger.info(f"Use Config Path: {config_path}")
 
-        sandbox_id = generate_random_string(12)
+        # The id names the work dir of the sandbox, it must not leave it
+        if session_id is not None and not re.fullmatch(r'[A-Za-z0-9_-]+', session_id):
+            raise InputErrorException(f"Invalid session_id {session_id!r}")
+        sandbox_id = session_id or generate_random_string(12)
 
         # setup agent
         agent = await BaseAgent.async_from_config_path_and_kwargs(config_path, **kwargs)
@@ -71,8 +82,9 @@ class CodeInterpreterSession:
         logger.info(f"Agent request: {agent_request.__dict__}")
 
         async for agent_response in self.agent.async_run(agent_request):
-            logger.info(f"Agent response:\n{agent_response.output_text}")
-            self.messages.append(Message(RoleType.System, agent_response.output_text))
+            if not agent_response.is_partial:
+                logger.info(f"Agent response:\n{agent_response.output_text}")
+                self.messages.append(Message(RoleType.System, agent_response.output_text))
             yield agent_response
 
         exec_time = time.time()
@@ -80,6 +92,12 @@ class CodeInterpreterSession:
             f'Agent Execution Latency: {exec_time - start_time}'
         )
 
+    async def close(self):
+        """End the sandbox sessions of the agent, their interpreters, kernels and containers are released."""
+        for plugin in self.agent.plugins_map.values():
+            if isinstance(plugin, SandboxEngine):
+                await plugin.close()
+
     def __enter__(self):
         pass
 
@@ -1,14 +1,31 @@
 from abc import ABC
+from typing import AsyncGenerator, Optional
 
 from ..exceptions.exceptions import InputErrorException
 from ..schemas import BaseCompletion
+from .token_counter import TokenCounter
+
+# Marks the text cut from a prompt over its budget
+ELIDED_MARKER = "\n...\n"
 
 
 class BaseLLM(ABC):
+    """
+    :param context_window: Tokens the model takes, prompt and completion together. None for no limit.
+    :param tokenizer: Name or path of the tokenizer counting the prompt tokens, in the transformers format.
+    """
+    # Context window of the models served by the client, unless the config names one
+    DEFAULT_CONTEXT_WINDOW: Optional[int] = None
 
-    def __init__(self, model_name: str, params: dict, **kwargs):
+    def __init__(self, model_name: str, params: dict, context_window: Optional[int] = None,
+                 tokenizer: Optional[str] = None, **kwargs):
         self.__model_name = model_name
         self.__params = params
+        self.__context_window = context_window or self.DEFAULT_CONTEXT_WINDOW
+        # The completion is part of the context window too
+        max_tokens = params.get('max_tokens') if isinstance(params, dict) else getattr(params, 'max_tokens', None)
+        self.__completion_tokens = max_tokens or 0
+        self.__token_counter = TokenCounter(tokenizer)
 
     @classmethod
     async def create(cls, config_data: dict):
@@ -28,9 +45,44 @@ class BaseLLM(ABC):
     def params(self) -> dict:
         return self.__params
 
+    @property
+    def prompt_budget(self) -> Optional[int]:
+        """Tokens left for the prompt once the completion is reserved, None for no limit."""
+        if self.__context_window is None:
+            return None
+        return max(self.__context_window - self.__completion_tokens, 0)
+
+    def count_tokens(self, text: str) -> int:
+        return self.__token_counter.count(text)
+
+    async def load_tokenizer(self):
+        """Load the tokenizer counting the prompt tokens off the event loop, counts are estimated until then."""
+        await self.__token_counter.load()
+
+    def fit_prompt(self, prompt: str) -> str:
+        """
+        Cut the middle of a prompt over the budget. The start holds the instructions and the question and the end the
+        latest step, both stay. Agents fit their prompts by step beforehand, this is the last resort for other callers.
+        """
+        budget = self.prompt_budget
+        if budget is None:
+            return prompt
+        tokens = self.count_tokens(prompt)
+        if tokens <= budget:
+            return prompt
+        # Characters per token of this prompt, a little under to land within the budget
+        keep = int(len(prompt) * budget / tokens * 0.95) // 2
+        return prompt[:keep] + ELIDED_MARKER + prompt[len(prompt) - keep:]
+
     def completion(self, prompt) -> BaseCompletion:
         pass
 
     async def async_completion(self, prompt) -> BaseCompletion:
         pass
 
+    async def async_stream_completion(self, prompt: str, **kwargs) -> AsyncGenerator[BaseCompletion, None]:
+        """
+        Yield the completion in chunks of content as it is generated. Closing the generator stops the generation.
+        Clients without streaming yield the whole completion at once.
+        """
+        yield await self.async_completion(prompt, **kwargs)
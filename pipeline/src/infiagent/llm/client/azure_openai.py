@@ -2,7 +2,7 @@ import json
 import logging
 import os
 from abc import ABC
-from typing import Callable, List
+from typing import AsyncGenerator, Callable, List
 
 import openai
 from tenacity import (  # for exponential backoff
@@ -128,6 +128,43 @@ class AzureOpenAIGPTClient(BaseLLM, ABC):
                               prompt_token=response.get("usage", {}).get("prompt_tokens", 0),
                               completion_token=response.get("usage", {}).get("completion_tokens", 0))
 
+    async def async_stream_completion(self, prompt: str, **kwargs) -> AsyncGenerator[BaseCompletion, None]:
+        """
+        Stream the completion as it is generated, one chunk of content at a time. Closing the generator closes the
+        connection, which stops the generation on the server.
+
+        :param prompt: The prompt to use for completion.
+        :type prompt: str
+        :param kwargs: Additional keyword arguments.
+        :type kwargs: dict
+        :return: BaseCompletion objects holding the chunks.
+        :rtype: AsyncGenerator[BaseCompletion, None]
+        """
+        response = await async_chatcompletion_with_backoff(
+            engine=self.get_model_name(),
+            messages=[
+                {"role": "user", "content": prompt[-MAX_PROMPT_LENGTH:]}
+            ],
+            timeout=1000,
+            temperature=self.params.temperature,
+            max_tokens=self.params.max_tokens,
+            top_p=self.params.top_p,
+            frequency_penalty=self.params.frequency_penalty,
+            presence_penalty=self.params.presence_penalty,
+            stream=True,
+            **kwargs
+        )
+        try:
+            async for chunk in response:
+                # Azure sends the content filter results in chunks without choices
+                if not chunk.choices:
+                    continue
+                content = chunk.choices[0].delta.get("content", "")
+                if content:
+                    yield BaseCompletion(state="success", content=content)
+        finally:
+            await response.aclose()
+
     def chat_completion(self, message: List[dict]) -> ChatCompletion:
         """
         Chat completion method for OpenAI GPT API.
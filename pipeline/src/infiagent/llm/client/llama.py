@@ -2,7 +2,7 @@ import json
 import logging
 import os
 from abc import ABC
-from typing import Callable, List
+from typing import AsyncGenerator, Callable, List
 
 import openai
 from tenacity import (  # for exponential backoff
@@ -17,8 +17,6 @@ from ...schemas import *
 
 logger = logging.getLogger(__name__)
 
-MAX_PROMPT_LENGTH = 4096
-
 
 @retry(wait=wait_random_exponential(min=1, max=10), stop=stop_after_attempt(5), reraise=True,
        before_sleep=before_sleep_log(logger, logging.WARNING))
@@ -47,8 +45,11 @@ class LlamaOpenAIClient(BaseLLM, ABC):
 
     model_name: str
     params: LlamaParamModel = LlamaParamModel()
+    DEFAULT_CONTEXT_WINDOW = 4096
 
     def __init__(self, **data):
+        # Served from the Hugging Face checkpoint, which brings its tokenizer
+        data.setdefault('tokenizer', data.get('model_name'))
         super().__init__(**data)
         openai.api_key = ""
         openai.api_base = "http://0.0.0.0:9729/v1"
@@ -77,7 +78,7 @@ class LlamaOpenAIClient(BaseLLM, ABC):
         response = chatcompletion_with_backoff(
             model=self.model_name,
             messages=[
-                {"role": "user", "content": prompt[-MAX_PROMPT_LENGTH:]}
+                {"role": "user", "content": self.fit_prompt(prompt)}
             ],
             timeout=1000,
             # temperature=self.params.temperature,
@@ -109,7 +110,7 @@ class LlamaOpenAIClient(BaseLLM, ABC):
         response = await async_chatcompletion_with_backoff(
             model=self.model_name,
             messages=[
-                {"role": "user", "content": prompt[-MAX_PROMPT_LENGTH:]}
+                {"role": "user", "content": self.fit_prompt(prompt)}
             ],
             timeout=1000,
             #temperature=0.2,
@@ -126,6 +127,35 @@ class LlamaOpenAIClient(BaseLLM, ABC):
                               prompt_token=response.get("usage", {}).get("prompt_tokens", 0),
                               completion_token=response.get("usage", {}).get("completion_tokens", 0))
 
+    async def async_stream_completion(self, prompt: str, **kwargs) -> AsyncGenerator[BaseCompletion, None]:
+        """
+        Stream the completion as it is generated, one chunk of content at a time. Closing the generator closes the
+        connection, which stops the generation on the server.
+
+        :param prompt: The prompt to use for completion.
+        :type prompt: str
+        :param kwargs: Additional keyword arguments.
+        :type kwargs: dict
+        :return: BaseCompletion objects holding the chunks.
+        :rtype: AsyncGenerator[BaseCompletion, None]
+        """
+        response = await async_chatcompletion_with_backoff(
+            model=self.model_name,
+            messages=[
+                {"role": "user", "content": self.fit_prompt(prompt)}
+            ],
+            timeout=1000,
+            stream=True,
+            **kwargs
+        )
+        try:
+            async for chunk in response:
+                content = chunk.choices[0].delta.get("content", "")
+                if content:
+                    yield BaseCompletion(state="success", content=content)
+        finally:
+            await response.aclose()
+
     def chat_completion(self, message: List[dict]) -> ChatCompletion:
         """
         Chat completion method for OpenAI GPT API.
@@ -0,0 +1,77 @@
+import asyncio
+import math
+from typing import Dict, Optional
+
+from ..utils import get_logger
+
+logger = get_logger()
+
+try:
+    from transformers import AutoTokenizer
+except ImportError:
+    AutoTokenizer = None
+
+# Without the tokenizer of the model, a token is taken for this many characters. Code and numbers tokenize denser
+# than prose, so this errs on the side of counting too many
+ESTIMATED_CHARS_PER_TOKEN = 3
+
+
+class TokenCounter:
+    """
+    Counts tokens with the tokenizer of the model, loaded with transformers. Loading may download the vocabulary and
+    takes seconds, inside an event loop it runs in a worker thread, started by load or by the first count, and counts
+    are estimated from the length of the text until it is done. Without transformers, or for a tokenizer that fails
+    to load, counts stay estimated.
+
+    :param tokenizer_name: Name or path of the tokenizer, in the transformers format. None estimates.
+    """
+    # Agents of the same model share the tokenizer, None for one that failed to load
+    _TOKENIZERS: Dict[str, object] = {}
+    _LOADS: Dict[str, asyncio.Future] = {}
+
+    def __init__(self, tokenizer_name: Optional[str] = None):
+        self._tokenizer_name = tokenizer_name
+
+    def count(self, text: str) -> int:
+        tokenizer = self._get_tokenizer()
+        if tokenizer is None:
+            return math.ceil(len(text) / ESTIMATED_CHARS_PER_TOKEN)
+        return len(tokenizer.encode(text, add_special_tokens=False))
+
+    async def load(self):
+        """Load the tokenizer in a worker thread, concurrent calls share one load."""
+        name = self._tokenizer_name
+        if name is None or name in TokenCounter._TOKENIZERS:
+            return
+        load = TokenCounter._LOADS.get(name)
+        if load is None:
+            load = TokenCounter._LOADS[name] = asyncio.ensure_future(asyncio.to_thread(_load_tokenizer, name))
+            load.add_done_callback(lambda _: TokenCounter._LOADS.pop(name, None))
+        await asyncio.shield(load)
+
+    def _get_tokenizer(self):
+        name = self._tokenizer_name
+        if name is None or name in TokenCounter._TOKENIZERS:
+            return TokenCounter._TOKENIZERS.get(name)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop to hold up, load it right away
+            _load_tokenizer(name)
+            return TokenCounter._TOKENIZERS[name]
+        if name not in TokenCounter._LOADS:
+            asyncio.ensure_future(self.load())
+        return None
+
+
+def _load_tokenizer(name: str):
+    if AutoTokenizer is None:
+        logger.warning(f"transformers is not installed, token counts for {name} are estimated")
+        tokenizer = None
+    else:
+        try:
+            tokenizer = AutoTokenizer.from_pretrained(name)
+        except Exception as e:
+            logger.warning(f"Failed to load tokenizer {name}, token counts are estimated. Error: {str(e)}")
+            tokenizer = None
+    TokenCounter._TOKENIZERS[name] = tokenizer
@@ -1,7 +1,8 @@
 """Prompt schema definition."""
 from abc import ABC, abstractmethod
+from dataclasses import replace
 from string import Formatter
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 from pydantic import BaseModel, Extra, root_validator
 
@@ -16,6 +17,13 @@ DEFAULT_OBSERVATION = "Observation:"
 DEFAULT_THOUGHT = "Thought:"
 DEFAULT_FINAL_ANSWER = "Final Answer:"
 
+SCRATCHPAD_VARIABLE = "agent_scratchpad"
+# Stands in for the scratchpad while the rest of the template is rendered, no prompt contains it
+_SCRATCHPAD_PLACEHOLDER = "\x00agent_scratchpad\x00"
+# What is left of an observation cut to fit the token budget
+ELIDED_OBSERVATION_LINES = 5
+ELIDED_OBSERVATION_CHARS = 500
+
 
 class PromptTemplate(BaseModel, ABC):
     _input_variables: List[str]
@@ -55,19 +63,19 @@ class PromptTemplate(BaseModel, ABC):
 
     def construct_scratchpad(self, intermediate_steps: List[BaseAgentResponse]) -> str:
         """Construct the scratchpad that lets the agent continue its thought process."""
-        thoughts = ""
-
-        for agent_response in intermediate_steps:
-            if isinstance(agent_response, AgentAction):
-                # for agent action, use thought
-                thoughts += agent_response.raw_output
-            elif isinstance(agent_response, AgentObservation):
-                # for agent observation use observation
-                thoughts += f"\n{self.keywords.get(OBSERVATION_KEY, DEFAULT_OBSERVATION)}\n" \
-                            f"{agent_response.formatted_output}\n\n" \
-                            f"{self.keywords.get(THOUGHT_KEY, DEFAULT_THOUGHT)}\n"
-
-        return thoughts
+        return "".join(self.scratchpad_step(agent_response) for agent_response in intermediate_steps)
+
+    def scratchpad_step(self, agent_response: BaseAgentResponse) -> str:
+        """The part of the scratchpad for one intermediate step."""
+        if isinstance(agent_response, AgentAction):
+            # for agent action, use thought
+            return agent_response.raw_output
+        if isinstance(agent_response, AgentObservation):
+            # for agent observation use observation
+            return f"\n{self.keywords.get(OBSERVATION_KEY, DEFAULT_OBSERVATION)}\n" \
+                   f"{agent_response.formatted_output}\n\n" \
+                   f"{self.keywords.get(THOUGHT_KEY, DEFAULT_THOUGHT)}\n"
+        return ""
 
     @classmethod
     @root_validator(skip_on_failure=True)
@@ -81,3 +89,100 @@ class PromptTemplate(BaseModel, ABC):
                 raise InputErrorException("Invalid prompt schema; check for mismatched or missing input parameters. ")\
                     from e
         return values
+
+
+class IncrementalPrompt:
+    """
+    Prompt of one agent run, with the template rendered once around the scratchpad. Every round renders only the
+    steps added since the last one and joins the parts, so the prompt of round N costs its new text and one copy
+    instead of rebuilding the whole scratchpad and formatting the template again.
+
+    With a token budget, the rendered template, holding the instructions and the question, always stays. When the
+    prompt grows over the budget, the oldest observations are cut down to their first lines, least recent first,
+    until it fits. The latest observation is kept whole. Cut observations stay cut, earlier rounds keep their text
+    and the prompts of a run share their start.
+
+    Steps are expected to be appended only, a shorter step list renders the scratchpad anew.
+
+    :param prompt_template: Template of the prompt.
+    :param count_tokens: Counts the tokens of a text with the tokenizer of the model.
+    :param max_tokens: Token budget of the prompt, None for no limit.
+    :param kwargs: The input variables of the template other than the scratchpad, fixed for the run.
+    """
+
+    def __init__(self, prompt_template: PromptTemplate, count_tokens: Optional[Callable[[str], int]] = None,
+                 max_tokens: Optional[int] = None, **kwargs):
+        self._prompt_template = prompt_template
+        # Nothing is counted without a budget to fit
+        self._max_tokens = max_tokens if count_tokens is not None else None
+        self._count_tokens = count_tokens if self._max_tokens is not None else None
+        self._variables = kwargs
+        rendered = prompt_template.format(**{SCRATCHPAD_VARIABLE: _SCRATCHPAD_PLACEHOLDER}, **kwargs)
+        # Templates without a scratchpad render to the same prompt every round
+        self._prefix, _, self._suffix = rendered.partition(_SCRATCHPAD_PLACEHOLDER)
+        self._has_scratchpad = _SCRATCHPAD_PLACEHOLDER in rendered
+        self._pinned_tokens = self._count(self._prefix) + self._count(self._suffix)
+        self._reset()
+
+    @property
+    def token_count(self) -> int:
+        """Tokens of the last rendered prompt, counted part by part. 0 without a token budget."""
+        return self._pinned_tokens + sum(self._part_tokens)
+
+    @property
+    def elided_count(self) -> int:
+        return len(self._elided)
+
+    def matches(self, **kwargs) -> bool:
+        """Whether the prompt was rendered for these input variables."""
+        return kwargs == self._variables
+
+    def render(self, intermediate_steps: List[BaseAgentResponse]) -> str:
+        if len(intermediate_steps) < len(self._steps):
+            self._reset()
+        if self._prompt is not None and len(intermediate_steps) == len(self._steps):
+            return self._prompt
+
+        for agent_response in intermediate_steps[len(self._steps):]:
+            part = self._prompt_template.scratchpad_step(agent_response) if self._has_scratchpad else ""
+            self._steps.append(agent_response)
+            self._parts.append(part)
+            self._part_tokens.append(self._count(part))
+        self._fit()
+        self._prompt = self._prefix + "".join(self._parts) + self._suffix
+        return self._prompt
+
+    def _reset(self):
+        self._steps: List[BaseAgentResponse] = []
+        self._parts: List[str] = []
+        self._part_tokens: List[int] = []
+        self._elided = set()
+        self._prompt: Optional[str] = None
+
+    def _count(self, text: str) -> int:
+        return self._count_tokens(text) if self._count_tokens is not None and text else 0
+
+    def _fit(self):
+        if self._max_tokens is None:
+            return
+        observations = [i for i, step in enumerate(self._steps) if isinstance(step, AgentObservation)]
+        tokens = self.token_count
+        for i in observations[:-1]:
+            if tokens <= self._max_tokens:
+                return
+            if i in self._elided:
+                continue
+            part = self._prompt_template.scratchpad_step(self._elide(self._steps[i]))
+            part_tokens = self._count(part)
+            self._elided.add(i)
+            if part_tokens < self._part_tokens[i]:
+                tokens += part_tokens - self._part_tokens[i]
+                self._parts[i], self._part_tokens[i] = part, part_tokens
+
+    @staticmethod
+    def _elide(observation: AgentObservation) -> AgentObservation:
+        output = observation.formatted_output
+        head = "\n".join(output.splitlines()[:ELIDED_OBSERVATION_LINES])[:ELIDED_OBSERVATION_CHARS]
+        return replace(observation,
+                       formatted_output=f"{head}\n[{len(output) - len(head)} more characters of this output were left "
+                                        f"out]")
@@ -24,6 +24,16 @@ class AgentAction(BaseAgentResponse):
     """
     tool: str
     tool_input: Union[str, dict]
+    # Runs once the action before it in the same model output finished, instead of alongside it
+    after_previous: bool = False
+
+
+@dataclass
+class AgentMultiAction(AgentAction):
+    """
+    Several actions given in one model output. tool and tool_input are those of the first one.
+    """
+    actions: List[AgentAction] = field(default_factory=list)
 
 
 @dataclass
@@ -92,6 +102,8 @@ class AgentResponse:
     sandbox_status: Optional[SandboxStatus] = None
     turn_level_prompt: Optional[List[str]] = None
     turn_level_response: Optional[List[str]] = None
+    # Intermediate output of a running step, superseded by the complete response of that step
+    is_partial: bool = False
 
 
 class RoleType(Enum):
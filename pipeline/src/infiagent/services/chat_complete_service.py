@@ -67,6 +67,8 @@ async def predict(
         user_messages = [Message(RoleType.User, prompt)]
         async for response in session.chat(user_messages):
             logger.info(f'Session Chat Response: {response}')
+            if response.is_partial:
+                continue
             if content is None:
                 content = response.output_text
             else:
@@ -97,6 +99,9 @@ async def predict(
         logger.error(err_msg, exc_info=True)
         
         raise Exception(err_msg)
+    finally:
+        # Release the interpreters and containers of the sandboxes, whether the chat succeeded or not
+        await session.close()
 
 import time
 from typing import Union, List, Any, Dict
@@ -166,6 +171,8 @@ async def predict(
 
         async for response in session.chat(user_messages):
             logger.info(f'Session Chat Response: {response}')
+            if response.is_partial:
+                continue
             if content is None:
                 content = response.output_text
             else:
@@ -194,3 +201,6 @@ async def predict(
         logger.error(err_msg, exc_info=True)
         
         raise Exception(err_msg)
+    finally:
+        # Release the interpreters and containers of the sandboxes, whether the chat succeeded or not
+        await session.close()
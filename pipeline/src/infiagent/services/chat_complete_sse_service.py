@@ -74,6 +74,10 @@ async def chat_event_generator(chat_request: ChatCompleteRequest):
         yield update_chat_response_with_message(base_response.copy(), message, status=FINISH_STATUS).dict()
         if session and session.conversation:
             session.conversation.status = ConversationStatus.FAILED
+    finally:
+        # Also when the client disconnects, the interpreters and containers of the sandboxes are released
+        if session is not None:
+            await session.close()
 
     yield DONE
 
@@ -105,6 +109,8 @@ async def chat_event_response(chat_request: ChatCompleteRequest):
         content = None
         output_files = []
         async for response in session.chat(user_messages, input_files):
+            if response.is_partial:
+                continue
             if content is None:
                 content = response.output_text
             else:
@@ -133,6 +139,8 @@ async def chat_event_response(chat_request: ChatCompleteRequest):
             session.conversation.status = ConversationStatus.FAILED
         await ConversationDAO.update_conversation(session.conversation)
         raise Exception(err_msg) from e
+    finally:
+        await session.close()
 
 
 async def get_or_create_conversation(chat_request: ChatCompleteRequest):
@@ -176,6 +184,11 @@ async def process_chat_response(session, base_response, user_messages, input_fil
         if chat_response_buffer:
             # Not the last one, using processing
             yield await update_chat_response(chat_response_buffer, base_response, PROCESSING_STATUS)
+            chat_response_buffer = None
+        if chat_response.is_partial:
+            # Partial tool output is forwarded right away, it is never the last response
+            yield await update_chat_response(chat_response, base_response, PROCESSING_STATUS)
+            continue
         chat_response_buffer = chat_response
 
     if chat_response_buffer:
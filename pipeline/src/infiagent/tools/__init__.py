@@ -1,8 +1,11 @@
 from .base_tool import BaseTool
+from .execution_cache import ExecutionCache
+from .sandbox_engine import CachedSandboxResponse, SandboxCapability, SandboxEngine, SandboxResponse
 from .code_sandbox import PythonSandBoxToolResponse, AsyncPythonSandBoxTool
+from .local_sandbox import LocalSandboxTool
 try:
     import docker
 except:
     pass
 else:
-    from .code_tool_docker import CodeTool, PythonSandBoxToolResponseDocker
\ No newline at end of file
+    from .code_tool_docker import CodeTool, PythonSandBoxToolResponseDocker
@@ -0,0 +1,83 @@
+import base64
+import hashlib
+import os
+from typing import Dict, List, Tuple
+
+# Preferred first, a figure published in several formats is stored once
+IMAGE_MIME_TYPES = {
+    'image/png': 'png',
+    'image/svg+xml': 'svg',
+}
+DEFAULT_MAX_SCAN_ENTRIES = 10000
+
+
+class ArtifactStore:
+    """
+    Content-addressed store for rich outputs of a sandbox session. Files are named after the sha256 of their content,
+    so a figure displayed again is not written twice.
+
+    :param store_dir: Directory of the store, created on first write.
+    """
+
+    def __init__(self, store_dir: str):
+        self._store_dir = store_dir
+
+    @property
+    def store_dir(self) -> str:
+        return self._store_dir
+
+    def put(self, content: bytes, extension: str) -> str:
+        """Store content and return its path."""
+        path = os.path.join(self._store_dir, f'{hashlib.sha256(content).hexdigest()}.{extension}')
+        if not os.path.exists(path):
+            os.makedirs(self._store_dir, exist_ok=True)
+            # Write then rename, readers never see a partial file
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as fp:
+                fp.write(content)
+            os.replace(tmp_path, path)
+        return path
+
+    def put_display_data(self, data: Dict) -> List[str]:
+        """Store the image of a display_data or execute_result mime bundle, returns the stored paths."""
+        for mime_type, extension in IMAGE_MIME_TYPES.items():
+            payload = data.get(mime_type)
+            if not payload:
+                continue
+            if isinstance(payload, list):
+                payload = ''.join(payload)
+            content = base64.b64decode(payload) if mime_type == 'image/png' else payload.encode('utf-8')
+            return [self.put(content, extension)]
+        return []
+
+
+def scan_files(root_dir: str, max_entries: int = DEFAULT_MAX_SCAN_ENTRIES) -> Dict[str, Tuple[int, int]]:
+    """
+    Map every file under root_dir to its (mtime_ns, size). Hidden files and directories are skipped and the scan
+    stops after max_entries files, keeping it cheap for sessions that unpack large archives.
+    """
+    files = {}
+    pending_dirs = [root_dir]
+    while pending_dirs and len(files) < max_entries:
+        try:
+            entries = os.scandir(pending_dirs.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending_dirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        stat = entry.stat(follow_symlinks=False)
+                        files[entry.path] = (stat.st_mtime_ns, stat.st_size)
+                except OSError:
+                    continue
+    return files
+
+
+def changed_files(before: Dict[str, Tuple[int, int]], after: Dict[str, Tuple[int, int]]) -> List[str]:
+    """Files created or modified between two scan_files results."""
+    return sorted(path for path, signature in after.items() if before.get(path) != signature)
@@ -0,0 +1,129 @@
+import asyncio
+import os
+import shutil
+import sys
+import uuid
+from typing import Dict, Optional
+
+from jupyter_client.asynchronous import AsyncKernelClient
+
+from ...exceptions.exceptions import SandboxException
+from ...utils import get_logger
+from .kernel_pool import KernelHandle
+from .resource_limits import APPLY_LIMITS_PY
+
+logger = get_logger()
+
+DEFAULT_STARTUP_TIMEOUT = 30
+READY_FD_ENV = 'INFIAGENT_KERNEL_READY_FD'
+WORKER_POLL_INTERVAL = 1.0
+
+# Executed in the kernel process before it starts serving. Expects `worker_pid` to be the pid of the worker that owns
+# the kernel, a daemon thread exits the kernel once the worker is gone instead of leaving it orphaned.
+WATCH_WORKER_PY = """import os, threading, time
+def _infiagent_watch_worker(worker_pid):
+    while True:
+        time.sleep(%r)
+        try:
+            os.kill(worker_pid, 0)
+        except ProcessLookupError:
+            os._exit(1)
+        except PermissionError:
+            pass
+threading.Thread(target=_infiagent_watch_worker, args=(worker_pid,), daemon=True).start()
+""" % WORKER_POLL_INTERVAL
+
+# Apply the resource limits, watch the worker, initialize the kernel app (sockets bound, connection file written),
+# report readiness on the inherited pipe, then start serving.
+LAUNCH_KERNEL_PY = """import os
+os.chdir({cwd!r})
+resource_limits = {rlimits!r}
+{apply_limits}
+worker_pid = os.getppid()
+{watch_worker}
+from ipykernel.kernelapp import IPKernelApp
+app = IPKernelApp.instance()
+app.initialize()
+with os.fdopen(int(os.environ.pop({ready_fd_env!r})), 'w') as ready:
+    ready.write(app.abs_connection_file + '\\n')
+app.start()
+"""
+
+
+async def read_ready_line(read_fd: int) -> bytes:
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader),
+                                                os.fdopen(read_fd, 'rb'))
+    try:
+        return await reader.readline()
+    finally:
+        transport.close()
+
+
+async def connect_client(kc: AsyncKernelClient):
+    kc.load_connection_file()
+    kc.start_channels()
+    await kc.wait_for_ready()
+
+
+def cleanup_failed_launch(kc: AsyncKernelClient, process, kernel_dir: str):
+    kc.stop_channels()
+    if process is not None and process.returncode is None:
+        process.kill()
+    shutil.rmtree(kernel_dir, ignore_errors=True)
+
+
+async def launch_kernel(pool_dir: str, cwd: str, startup_timeout: float = DEFAULT_STARTUP_TIMEOUT,
+                        rlimits: Optional[Dict[str, Optional[int]]] = None) -> KernelHandle:
+    """
+    Start an ipykernel process and return a ready handle.
+
+    The kernel reports readiness through a pipe once its sockets are bound, so there is no polling on the connection
+    file. A kernel that exits or does not become ready within startup_timeout seconds raises SandboxException.
+    """
+    kernel_id = uuid.uuid4().hex
+    kernel_dir = os.path.join(pool_dir, kernel_id)
+    connection_file = os.path.join(kernel_dir, f'kernel_connection_file_{kernel_id}.json')
+    os.makedirs(kernel_dir, exist_ok=True)
+
+    read_fd, write_fd = os.pipe()
+    try:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            '-c',
+            LAUNCH_KERNEL_PY.format(cwd=cwd, ready_fd_env=READY_FD_ENV, rlimits=rlimits or {},
+                                    apply_limits=APPLY_LIMITS_PY, watch_worker=WATCH_WORKER_PY),
+            '--IPKernelApp.connection_file',
+            connection_file,
+            '--matplotlib=inline',
+            '--quiet',
+            cwd=kernel_dir,
+            env={**os.environ, READY_FD_ENV: str(write_fd)},
+            pass_fds=(write_fd,))
+    except Exception:
+        os.close(read_fd)
+        shutil.rmtree(kernel_dir, ignore_errors=True)
+        raise
+    finally:
+        os.close(write_fd)
+
+    kc = AsyncKernelClient(connection_file=connection_file)
+
+    async def _wait_until_ready():
+        # EOF before the ready line means the kernel process died during startup
+        if not await read_ready_line(read_fd):
+            return_code = await process.wait()
+            raise SandboxException(f"Kernel {kernel_id} exited during startup with code {return_code}")
+        await connect_client(kc)
+
+    try:
+        await asyncio.wait_for(_wait_until_ready(), timeout=startup_timeout)
+    except BaseException as e:
+        cleanup_failed_launch(kc, process, kernel_dir)
+        if isinstance(e, asyncio.TimeoutError):
+            raise SandboxException(f"Kernel {kernel_id} not ready after {startup_timeout} seconds") from e
+        raise
+
+    logger.info(f"Kernel {kernel_id} started with pid {process.pid}")
+    return KernelHandle(kernel_id=kernel_id, client=kc, process=process, kernel_dir=kernel_dir)
@@ -0,0 +1,188 @@
+import asyncio
+import shutil
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Deque, Optional, Set
+
+from jupyter_client.asynchronous import AsyncKernelClient
+
+from ...exceptions.exceptions import InvalidConfigException
+from ...utils import get_logger
+
+logger = get_logger()
+
+DEFAULT_WARM_SIZE = 0
+DEFAULT_REFILL_RATE = 1.0
+KERNEL_RESET_TIMEOUT = 10
+
+
+@dataclass
+class KernelHandle:
+    """
+    A running ipykernel process together with its connected client. process is an asyncio subprocess, or a
+    ForkedKernelProcess for kernels forked from the template, both expose pid, returncode and kill().
+    """
+    kernel_id: str
+    client: AsyncKernelClient
+    process: asyncio.subprocess.Process
+    kernel_dir: str
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    killed: bool = False
+    # Variables changed since the last snapshot, None when any of them may have
+    unsaved_names: Optional[Set[str]] = field(default_factory=set)
+
+    def is_alive(self) -> bool:
+        # The returncode of a killed process is only set once its exit has been noticed
+        return not self.killed and self.process.returncode is None
+
+    def kill(self):
+        self.killed = True
+        self.process.kill()
+
+
+class KernelPool:
+    """
+    Pool of pre-started kernels shared by all sandbox sessions of a worker.
+
+    :param launcher: Coroutine function that starts a kernel and returns a ready KernelHandle.
+    :param warm_size: Number of idle kernels the refill task keeps ready.
+    :param high_water_mark: Maximum number of idle kernels held by the pool, returned kernels included.
+    :param refill_rate: Maximum number of kernels started per second by the refill task.
+    :param recycle_kernels: Reset and keep returned kernels instead of shutting them down.
+    :param reset_code: Code executed in a returned kernel before it goes back to the pool.
+    """
+
+    def __init__(self,
+                 launcher: Callable[[], Awaitable[KernelHandle]],
+                 warm_size: int = DEFAULT_WARM_SIZE,
+                 high_water_mark: Optional[int] = None,
+                 refill_rate: float = DEFAULT_REFILL_RATE,
+                 recycle_kernels: bool = False,
+                 reset_code: str = ""):
+        high_water_mark = warm_size if high_water_mark is None else high_water_mark
+        if warm_size < 0:
+            raise InvalidConfigException(f"Kernel pool warm_size must be >= 0, got {warm_size}")
+        if high_water_mark < warm_size:
+            raise InvalidConfigException(f"Kernel pool high_water_mark ({high_water_mark}) must be >= warm_size "
+                                         f"({warm_size})")
+        if refill_rate <= 0:
+            raise InvalidConfigException(f"Kernel pool refill_rate must be > 0, got {refill_rate}")
+
+        self._launcher = launcher
+        self._warm_size = warm_size
+        self._high_water_mark = high_water_mark
+        self._refill_rate = refill_rate
+        self._recycle_kernels = recycle_kernels
+        self._reset_code = reset_code
+        self._idle: Deque[KernelHandle] = deque()
+        self._refill_task: Optional[asyncio.Task] = None
+        self._recycle_tasks = set()
+        self._closed = False
+
+    @property
+    def idle_count(self) -> int:
+        return len(self._idle)
+
+    def fill(self):
+        """Schedule the background refill task up to warm_size, if there is a running event loop."""
+        self._schedule_refill()
+
+    async def lease(self) -> KernelHandle:
+        """Take a ready kernel from the pool, starting one on demand when the pool is empty."""
+        while self._idle:
+            handle = self._idle.popleft()
+            if handle.is_alive():
+                logger.info(f"Leased warm kernel {handle.kernel_id}, {len(self._idle)} idle kernels left")
+                self._schedule_refill()
+                return handle
+            logger.warning(f"Drop dead pooled kernel {handle.kernel_id}")
+            self.retire(handle)
+
+        self._schedule_refill()
+        logger.info("Kernel pool is empty, start kernel on demand")
+        return await self._launcher()
+
+    def release(self, handle: KernelHandle):
+        """
+        Give a leased kernel back. It is reset and pooled in the background when recycling is enabled,
+        otherwise retired.
+        """
+        if self._recycle_kernels and not self._closed and handle.is_alive() \
+                and len(self._idle) < self._high_water_mark:
+            try:
+                task = asyncio.get_running_loop().create_task(self._recycle(handle))
+                self._recycle_tasks.add(task)
+                task.add_done_callback(self._recycle_tasks.discard)
+                return
+            except RuntimeError:
+                logger.warning(f"No running event loop to reset kernel {handle.kernel_id}, retire it")
+        self.retire(handle)
+
+    async def _recycle(self, handle: KernelHandle):
+        try:
+            await handle.client.execute_interactive(self._reset_code, timeout=KERNEL_RESET_TIMEOUT,
+                                                    output_hook=lambda msg: None)
+        except Exception as e:
+            logger.warning(f"Failed to reset kernel {handle.kernel_id}, retire it. Error: {str(e)}")
+            self.retire(handle)
+            return
+
+        if self._closed or len(self._idle) >= self._high_water_mark:
+            self.retire(handle)
+            return
+        self._idle.append(handle)
+        logger.info(f"Kernel {handle.kernel_id} returned to pool, {len(self._idle)} idle kernels")
+
+    @staticmethod
+    def retire(handle: KernelHandle):
+        try:
+            handle.client.shutdown()
+            handle.client.stop_channels()
+        except Exception as e:
+            logger.warning(f"Failed to shutdown kernel {handle.kernel_id} cleanly. Error: {str(e)}")
+        shutil.rmtree(handle.kernel_dir, ignore_errors=True)
+
+    def close(self, kill: bool = False):
+        """
+        Stop refilling and retire the idle kernels.
+
+        :param kill: Kill the idle kernels rather than ask them to shut down, for when no event loop runs anymore.
+        """
+        self._closed = True
+        if self._refill_task is not None and not self._refill_task.done():
+            self._refill_task.cancel()
+        while self._idle:
+            handle = self._idle.popleft()
+            if kill:
+                try:
+                    handle.kill()
+                except ProcessLookupError:
+                    pass
+            self.retire(handle)
+
+    def _schedule_refill(self):
+        if self._closed or len(self._idle) >= self._warm_size:
+            return
+        if self._refill_task is not None and not self._refill_task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._refill_task = loop.create_task(self._refill())
+
+    async def _refill(self):
+        interval = 1.0 / self._refill_rate
+        while not self._closed and len(self._idle) < self._warm_size:
+            try:
+                handle = await self._launcher()
+            except Exception as e:
+                logger.error(f"Failed to start pooled kernel. Error: {str(e)}", exc_info=True)
+                return
+
+            if self._closed or len(self._idle) >= self._high_water_mark:
+                self.retire(handle)
+                return
+            self._idle.append(handle)
+            logger.info(f"Started warm kernel {handle.kernel_id}, {len(self._idle)} idle kernels")
+            await asyncio.sleep(interval)
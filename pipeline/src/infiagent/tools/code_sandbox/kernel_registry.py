@@ -0,0 +1,170 @@
+import asyncio
+import time
+from collections import Counter, OrderedDict
+from typing import Callable, Dict, List, Optional
+
+from ...exceptions.exceptions import InvalidConfigException
+from ...utils import get_logger
+from .kernel_pool import KernelHandle
+
+logger = get_logger()
+
+DEFAULT_REAP_INTERVAL = 60
+# Sessions remembered as evicted until they lease a kernel again, the oldest are forgotten beyond it
+MAX_EVICTED_SESSIONS = 10000
+
+EVICT_REASON_LRU = 'lru'
+EVICT_REASON_IDLE_TTL = 'idle_ttl'
+EVICT_REASON_DEAD = 'dead'
+EVICT_REASON_STUCK = 'stuck'
+
+
+class KernelRegistry:
+    """
+    Kernels leased by sandbox sessions, in least recently used order.
+
+    :param on_evict: Called with the sandbox id and handle of every evicted kernel, it owns the kernel afterwards.
+    :param max_live_kernels: Maximum number of leased kernels, the least recently used idle kernel is evicted beyond
+        it. None means unbounded.
+    :param idle_ttl: Seconds a kernel may stay unused before the reaper evicts it. None disables the TTL.
+    :param reap_interval: Seconds between two runs of the background reaper.
+    """
+
+    def __init__(self,
+                 on_evict: Callable[[str, KernelHandle], None],
+                 max_live_kernels: Optional[int] = None,
+                 idle_ttl: Optional[float] = None,
+                 reap_interval: float = DEFAULT_REAP_INTERVAL):
+        if max_live_kernels is not None and max_live_kernels <= 0:
+            raise InvalidConfigException(f"max_live_kernels must be > 0, got {max_live_kernels}")
+        if idle_ttl is not None and idle_ttl <= 0:
+            raise InvalidConfigException(f"Kernel idle_ttl must be > 0, got {idle_ttl}")
+        if reap_interval <= 0:
+            raise InvalidConfigException(f"Kernel reap_interval must be > 0, got {reap_interval}")
+
+        self._on_evict = on_evict
+        self._max_live_kernels = max_live_kernels
+        self._idle_ttl = idle_ttl
+        self._reap_interval = reap_interval
+        self._kernels: "OrderedDict[str, KernelHandle]" = OrderedDict()
+        self._last_used: Dict[str, float] = {}
+        self._evicted = Counter()
+        self._evicted_sessions: "OrderedDict[str, None]" = OrderedDict()
+        self._reaper_task: Optional[asyncio.Task] = None
+
+    def __contains__(self, sandbox_id: str) -> bool:
+        return sandbox_id in self._kernels
+
+    def __len__(self) -> int:
+        return len(self._kernels)
+
+    def get(self, sandbox_id: str) -> Optional[KernelHandle]:
+        """Return the kernel of a session and mark it as most recently used."""
+        handle = self._kernels.get(sandbox_id)
+        if handle is not None:
+            self.touch(sandbox_id)
+        return handle
+
+    def touch(self, sandbox_id: str):
+        if sandbox_id in self._kernels:
+            self._kernels.move_to_end(sandbox_id)
+            self._last_used[sandbox_id] = time.monotonic()
+
+    def add(self, sandbox_id: str, handle: KernelHandle) -> KernelHandle:
+        """Register a kernel for a session, returns the already registered one if there is any."""
+        existing = self._kernels.get(sandbox_id)
+        if existing is not None:
+            return existing
+
+        self._kernels[sandbox_id] = handle
+        self._last_used[sandbox_id] = time.monotonic()
+        self._enforce_max_live_kernels(keep=sandbox_id)
+        return handle
+
+    def pop(self, sandbox_id: str) -> Optional[KernelHandle]:
+        self._last_used.pop(sandbox_id, None)
+        self._evicted_sessions.pop(sandbox_id, None)
+        return self._kernels.pop(sandbox_id, None)
+
+    def pop_evicted(self, sandbox_id: str) -> bool:
+        """Whether the last kernel of the session was evicted rather than released by the session itself."""
+        if sandbox_id not in self._evicted_sessions:
+            return False
+        del self._evicted_sessions[sandbox_id]
+        return True
+
+    def pop_all(self) -> List[KernelHandle]:
+        """Hand over every leased kernel without evicting it, for worker shutdown."""
+        return [self.pop(sandbox_id) for sandbox_id in list(self._kernels.keys())]
+
+    def evict(self, sandbox_id: str, reason: str):
+        handle = self.pop(sandbox_id)
+        if handle is None:
+            return
+        self._evicted[reason] += 1
+        self._evicted_sessions[sandbox_id] = None
+        while len(self._evicted_sessions) > MAX_EVICTED_SESSIONS:
+            self._evicted_sessions.popitem(last=False)
+        logger.info(f"Evict kernel {handle.kernel_id} of sandbox {sandbox_id}, reason: {reason}")
+        try:
+            self._on_evict(sandbox_id, handle)
+        except Exception as e:
+            logger.error(f"Failed to release evicted kernel {handle.kernel_id}. Error: {str(e)}", exc_info=True)
+
+    def reap(self):
+        """Evict dead kernels and kernels idle for longer than idle_ttl."""
+        now = time.monotonic()
+        for sandbox_id, handle in list(self._kernels.items()):
+            if not handle.is_alive():
+                self.evict(sandbox_id, EVICT_REASON_DEAD)
+            elif self._idle_ttl is not None and not handle.lock.locked() \
+                    and now - self._last_used[sandbox_id] > self._idle_ttl:
+                self.evict(sandbox_id, EVICT_REASON_IDLE_TTL)
+
+    def start_reaper(self):
+        """Start the background reaper task, if there is a running event loop and it is not running yet."""
+        if self._reaper_task is not None and not self._reaper_task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._reaper_task = loop.create_task(self._reap_forever())
+
+    def stop_reaper(self):
+        if self._reaper_task is not None and not self._reaper_task.done():
+            self._reaper_task.cancel()
+        self._reaper_task = None
+
+    def metrics(self) -> Dict[str, int]:
+        busy = sum(1 for handle in self._kernels.values() if handle.lock.locked())
+        metrics = {
+            'live': len(self._kernels),
+            'busy': busy,
+            'idle': len(self._kernels) - busy,
+            'evicted': sum(self._evicted.values()),
+        }
+        for reason in [EVICT_REASON_LRU, EVICT_REASON_IDLE_TTL, EVICT_REASON_DEAD, EVICT_REASON_STUCK]:
+            metrics[f'evicted_{reason}'] = self._evicted[reason]
+        return metrics
+
+    def _enforce_max_live_kernels(self, keep: str):
+        if self._max_live_kernels is None:
+            return
+        # Oldest first, kernels running a cell and the kernel just added are never evicted
+        for sandbox_id in list(self._kernels.keys()):
+            if len(self._kernels) <= self._max_live_kernels:
+                return
+            if sandbox_id != keep and not self._kernels[sandbox_id].lock.locked():
+                self.evict(sandbox_id, EVICT_REASON_LRU)
+        if len(self._kernels) > self._max_live_kernels:
+            logger.warning(f"{len(self._kernels)} live kernels exceed max_live_kernels {self._max_live_kernels}, "
+                           f"all of them are running a cell")
+
+    async def _reap_forever(self):
+        while True:
+            await asyncio.sleep(self._reap_interval)
+            try:
+                self.reap()
+            except Exception as e:
+                logger.error(f"Kernel reaper failed. Error: {str(e)}", exc_info=True)
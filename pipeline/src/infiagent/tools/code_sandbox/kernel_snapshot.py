@@ -0,0 +1,166 @@
+import ast
+import os
+from typing import List, Optional
+
+from jupyter_client.asynchronous import AsyncKernelClient
+
+from ...utils import get_logger
+
+logger = get_logger()
+
+# Inside the session work dir, hidden from the output file scan
+SNAPSHOT_DIR_NAME = '.snapshot'
+SNAPSHOT_MANIFEST = 'manifest.json'
+DEFAULT_SNAPSHOT_TIMEOUT = 60
+
+# Runs in the kernel. Modules are recorded by name and imported again on restore, functions and classes are skipped
+# as they pickle by reference to a __main__ that the new kernel does not have. DataFrames go to parquet when pyarrow
+# is available, everything else is pickled, values failing to serialize are left out. With names given and a previous
+# snapshot in place only those variables are written again, the others keep their files. A variable changed through
+# another one sharing its object keeps its old value then.
+SNAPSHOT_PY = """def _infiagent_snapshot(snapshot_dir, names):
+    import importlib.util, inspect, json, os, pickle, shutil, types
+    shell = get_ipython()
+    manifest_path = os.path.join(snapshot_dir, %r)
+    user_ns = shell.user_ns
+    # A function of the session may have changed any global, calling one needs a full snapshot
+    if names is not None and any(inspect.isfunction(user_ns.get(name)) and user_ns[name].__module__ == '__main__'
+                                 for name in names):
+        names = None
+    if names is None or not os.path.isfile(manifest_path):
+        target_dir = snapshot_dir + '.tmp'
+        shutil.rmtree(target_dir, ignore_errors=True)
+        os.makedirs(target_dir)
+        manifest = {}
+        names = list(user_ns)
+    else:
+        target_dir = snapshot_dir
+        with open(manifest_path) as fp:
+            manifest = json.load(fp)
+    use_parquet = importlib.util.find_spec('pyarrow') is not None
+
+    def _write(file_name, write):
+        # Replaced only once complete, the manifest never points to a partial file
+        path = os.path.join(target_dir, file_name)
+        try:
+            write(path + '.part')
+            os.replace(path + '.part', path)
+            return True
+        except Exception:
+            if os.path.exists(path + '.part'):
+                os.remove(path + '.part')
+            return False
+
+    def _pickle(value, path):
+        with open(path, 'wb') as fp:
+            pickle.dump(value, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _json(value, path):
+        with open(path, 'w') as fp:
+            json.dump(value, fp)
+
+    for name in names:
+        old = manifest.pop(name, None)
+        value = user_ns.get(name)
+        if name not in user_ns or name.startswith('_') or name in shell.user_ns_hidden:
+            entry = None
+        elif isinstance(value, types.ModuleType):
+            entry = {'format': 'module', 'module': value.__name__}
+        elif inspect.isroutine(value) or inspect.isclass(value):
+            entry = None
+        elif use_parquet and type(value).__name__ == 'DataFrame' and type(value).__module__.startswith('pandas') \\
+                and _write(name + '.parquet', value.to_parquet):
+            entry = {'format': 'parquet', 'file': name + '.parquet'}
+        elif _write(name + '.pkl', lambda path: _pickle(value, path)):
+            entry = {'format': 'pickle', 'file': name + '.pkl'}
+        else:
+            entry = None
+        if old is not None and 'file' in old and (entry is None or entry.get('file') != old['file']):
+            try:
+                os.remove(os.path.join(target_dir, old['file']))
+            except OSError:
+                pass
+        if entry is not None:
+            manifest[name] = entry
+    _write(%r, lambda path: _json(manifest, path))
+    if target_dir != snapshot_dir:
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+        os.replace(target_dir, snapshot_dir)
+""" % (SNAPSHOT_MANIFEST, SNAPSHOT_MANIFEST)
+# Calls that reach variables without naming them, cells using them need a full snapshot
+INDIRECT_ACCESS_NAMES = {'exec', 'eval', 'globals', 'vars', 'locals', 'setattr', 'delattr', 'get_ipython'}
+
+RESTORE_PY = """def _infiagent_restore(snapshot_dir):
+    import importlib, json, os, pickle
+    shell = get_ipython()
+    with open(os.path.join(snapshot_dir, %r)) as fp:
+        manifest = json.load(fp)
+    for name, entry in manifest.items():
+        try:
+            if entry['format'] == 'module':
+                value = importlib.import_module(entry['module'])
+            elif entry['format'] == 'parquet':
+                import pandas
+                value = pandas.read_parquet(os.path.join(snapshot_dir, entry['file']))
+            else:
+                with open(os.path.join(snapshot_dir, entry['file']), 'rb') as fp:
+                    value = pickle.load(fp)
+        except Exception:
+            continue
+        shell.user_ns[name] = value
+""" % SNAPSHOT_MANIFEST
+
+
+def has_snapshot(snapshot_dir: str) -> bool:
+    return os.path.isfile(os.path.join(snapshot_dir, SNAPSHOT_MANIFEST))
+
+
+def referenced_names(code: str) -> Optional[List[str]]:
+    """
+    Top-level names a cell reads, binds or deletes, the variables it can have changed. None when that cannot be told
+    from the code: IPython syntax that is not Python, or calls reaching variables without naming them.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            names.add(node.id)
+        elif isinstance(node, ast.alias):
+            names.add((node.asname or node.name).split('.')[0])
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.Global):
+            names.update(node.names)
+    if names & INDIRECT_ACCESS_NAMES or any(isinstance(node, ast.ImportFrom) and node.names[0].name == '*'
+                                            for node in ast.walk(tree)):
+        return None
+    return sorted(names)
+
+
+async def _run_silently(kc: AsyncKernelClient, function_py: str, function_name: str, snapshot_dir: str,
+                        timeout: float, *args):
+    call_args = ', '.join(repr(arg) for arg in (snapshot_dir, *args))
+    code = f"{function_py}\ntry:\n    {function_name}({call_args})\nfinally:\n    del {function_name}\n"
+    reply = await kc.execute_interactive(code, silent=True, store_history=False, timeout=timeout)
+    if reply['content']['status'] != 'ok':
+        logger.warning(f"Kernel {function_name} of {snapshot_dir} failed: {reply['content'].get('evalue')}")
+        return False
+    return True
+
+
+async def snapshot_kernel(kc: AsyncKernelClient, snapshot_dir: str, names: Optional[List[str]] = None,
+                          timeout: float = DEFAULT_SNAPSHOT_TIMEOUT) -> bool:
+    """
+    Save the user namespace of the kernel to snapshot_dir. With names, e.g. the referenced_names of the last cell,
+    only those variables are written again on top of the previous snapshot, otherwise the whole namespace is.
+    """
+    return await _run_silently(kc, SNAPSHOT_PY, '_infiagent_snapshot', snapshot_dir, timeout, names)
+
+
+async def restore_kernel(kc: AsyncKernelClient, snapshot_dir: str,
+                         timeout: float = DEFAULT_SNAPSHOT_TIMEOUT) -> bool:
+    """Load the variables saved in snapshot_dir into the user namespace of the kernel."""
+    return await _run_silently(kc, RESTORE_PY, '_infiagent_restore', snapshot_dir, timeout)
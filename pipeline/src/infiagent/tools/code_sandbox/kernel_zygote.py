@@ -0,0 +1,203 @@
+import asyncio
+import json
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import uuid
+from typing import Dict, List, Optional
+
+from jupyter_client.asynchronous import AsyncKernelClient
+
+from ...exceptions.exceptions import InvalidConfigException, SandboxException
+from ...utils import get_logger
+from .kernel_launcher import (DEFAULT_STARTUP_TIMEOUT, READY_FD_ENV, WATCH_WORKER_PY, WORKER_POLL_INTERVAL,
+                              cleanup_failed_launch, connect_client, read_ready_line)
+from .kernel_pool import KernelHandle
+from .resource_limits import APPLY_LIMITS_PY
+
+logger = get_logger()
+
+DEFAULT_PRELOAD_MODULES = ['numpy', 'pandas', 'matplotlib', 'scipy']
+
+# Template process: import the heavy modules once, then fork one kernel per request on the unix socket. Each child
+# initializes its own IPKernelApp, answers with its pid once the kernel sockets are bound and starts serving. The
+# socket path is argv[1] and the modules to preload are argv[2:]. The template exits once it is reparented, that is
+# once the worker is gone, and every forked kernel watches the worker pid itself since it outlives a closed template.
+ZYGOTE_PY = """import importlib, json, os, random, signal, socket, sys
+worker_pid = os.getppid()
+for module_name in sys.argv[2:]:
+    importlib.import_module(module_name)
+from ipykernel.kernelapp import IPKernelApp
+signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+server.bind(sys.argv[1])
+server.listen(128)
+server.settimeout(%r)
+with os.fdopen(int(os.environ.pop(%r)), 'w') as ready:
+    ready.write(str(os.getpid()) + '\\n')
+while True:
+    try:
+        conn, _ = server.accept()
+    except socket.timeout:
+        if os.getppid() != worker_pid:
+            sys.exit(0)
+        continue
+    if os.fork() != 0:
+        conn.close()
+        continue
+    server.close()
+    os.setsid()
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    random.seed()
+    if 'numpy' in sys.modules:
+        sys.modules['numpy'].random.seed()
+    request = json.loads(conn.makefile('r').readline())
+    resource_limits = request['resource_limits']
+    exec(%r)
+    exec(%r)
+    os.chdir(request['cwd'])
+    app = IPKernelApp.instance()
+    app.initialize(['--IPKernelApp.connection_file', request['connection_file'], '--matplotlib=inline', '--quiet'])
+    conn.sendall((json.dumps({'pid': os.getpid()}) + '\\n').encode())
+    conn.close()
+    app.start()
+    sys.exit(0)
+""" % (WORKER_POLL_INTERVAL, READY_FD_ENV, APPLY_LIMITS_PY, WATCH_WORKER_PY)
+
+
+class ForkedKernelProcess:
+    """Process handle for a kernel forked by the zygote. It is not our child, so liveness is probed by pid."""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+
+    @property
+    def returncode(self) -> Optional[int]:
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            # The zygote reaps its children, the real exit code is not available here
+            return -1
+        except PermissionError:
+            pass
+        return None
+
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+class KernelZygote:
+    """
+    Template kernel process with the scientific stack preloaded. Kernels are forked from it copy-on-write, so they
+    skip interpreter startup and the first-cell imports and share the preloaded pages with each other.
+
+    :param preload_modules: Modules imported once in the template before any kernel is forked.
+    """
+
+    def __init__(self, preload_modules: Optional[List[str]] = None):
+        if not hasattr(os, 'fork'):
+            raise InvalidConfigException("Kernel template mode requires os.fork, which this platform does not support")
+        self._preload_modules = DEFAULT_PRELOAD_MODULES if preload_modules is None else preload_modules
+        self._process: Optional[asyncio.subprocess.Process] = None
+        self._socket_dir: Optional[str] = None
+        self._start_lock = asyncio.Lock()
+
+    @property
+    def socket_path(self) -> str:
+        return os.path.join(self._socket_dir, 'zygote.sock')
+
+    def is_alive(self) -> bool:
+        return self._process is not None and self._process.returncode is None
+
+    async def start(self, startup_timeout: float = DEFAULT_STARTUP_TIMEOUT):
+        async with self._start_lock:
+            if self.is_alive():
+                return
+            self.close()
+            # Short path under the system temp dir, unix socket paths are limited to about 100 bytes
+            self._socket_dir = tempfile.mkdtemp(prefix='infiagent-zygote-')
+
+            read_fd, write_fd = os.pipe()
+            try:
+                self._process = await asyncio.create_subprocess_exec(
+                    sys.executable, '-c', ZYGOTE_PY, self.socket_path, *self._preload_modules,
+                    env={**os.environ, READY_FD_ENV: str(write_fd)},
+                    pass_fds=(write_fd,))
+            except Exception:
+                os.close(read_fd)
+                raise
+            finally:
+                os.close(write_fd)
+
+            try:
+                ready = await asyncio.wait_for(read_ready_line(read_fd), timeout=startup_timeout)
+            except asyncio.TimeoutError as e:
+                self.close()
+                raise SandboxException(f"Kernel template not ready after {startup_timeout} seconds") from e
+            if not ready:
+                return_code = await self._process.wait()
+                self.close()
+                raise SandboxException(f"Kernel template exited during startup with code {return_code}, "
+                                       f"check preload modules {self._preload_modules}")
+            logger.info(f"Kernel template {self._process.pid} ready with modules {self._preload_modules}")
+
+    async def spawn(self, pool_dir: str, cwd: str, startup_timeout: float = DEFAULT_STARTUP_TIMEOUT,
+                    rlimits: Optional[Dict[str, Optional[int]]] = None) -> KernelHandle:
+        """Fork a kernel from the template, starting the template first if needed, and return a ready handle."""
+        await self.start(startup_timeout)
+
+        kernel_id = uuid.uuid4().hex
+        kernel_dir = os.path.join(pool_dir, kernel_id)
+        connection_file = os.path.join(kernel_dir, f'kernel_connection_file_{kernel_id}.json')
+        os.makedirs(kernel_dir, exist_ok=True)
+
+        kc = AsyncKernelClient(connection_file=connection_file)
+        process = None
+
+        async def _fork_and_connect():
+            nonlocal process
+            reader, writer = await asyncio.open_unix_connection(self.socket_path)
+            try:
+                request = {'cwd': cwd, 'connection_file': connection_file, 'resource_limits': rlimits or {}}
+                writer.write((json.dumps(request) + '\n').encode())
+                await writer.drain()
+                # EOF before the reply means the forked kernel died during initialization
+                reply = await reader.readline()
+            finally:
+                writer.close()
+            if not reply:
+                raise SandboxException(f"Kernel {kernel_id} exited during startup")
+            process = ForkedKernelProcess(json.loads(reply)['pid'])
+            await connect_client(kc)
+
+        try:
+            await asyncio.wait_for(_fork_and_connect(), timeout=startup_timeout)
+        except BaseException as e:
+            cleanup_failed_launch(kc, process, kernel_dir)
+            if isinstance(e, asyncio.TimeoutError):
+                raise SandboxException(f"Kernel {kernel_id} not ready after {startup_timeout} seconds") from e
+            if isinstance(e, OSError):
+                # The template is unreachable, its socket is stale or it is dying. The next spawn starts a new one
+                self.close()
+                raise SandboxException(f"Kernel template unreachable. Error: {str(e)}") from e
+            raise
+
+        logger.info(f"Kernel {kernel_id} forked from template with pid {process.pid}")
+        return KernelHandle(kernel_id=kernel_id, client=kc, process=process, kernel_dir=kernel_dir)
+
+    def close(self):
+        """Stop the template. Kernels already forked keep running until they are retired."""
+        if self._process is not None and self._process.returncode is None:
+            try:
+                self._process.kill()
+            except ProcessLookupError:
+                pass
+        self._process = None
+        if self._socket_dir is not None:
+            shutil.rmtree(self._socket_dir, ignore_errors=True)
+            self._socket_dir = None
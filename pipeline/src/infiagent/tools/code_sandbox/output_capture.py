@@ -0,0 +1,87 @@
+import asyncio
+from collections import deque
+from typing import AsyncGenerator, Deque, List
+
+from ...exceptions.exceptions import InvalidConfigException
+
+DEFAULT_HEAD_SIZE = 8000
+DEFAULT_TAIL_SIZE = 2000
+STREAM_QUEUE_SIZE = 64
+STREAM_COALESCE_INTERVAL = 0.1
+
+
+class OutputCapture:
+    """
+    Bounded capture of an output stream. It keeps the first head_size and the last tail_size characters and counts
+    everything in between, so a cell printing gigabytes costs no more than head_size + tail_size characters.
+
+    :param head_size: Number of leading characters to keep.
+    :param tail_size: Number of trailing characters to keep.
+    """
+
+    def __init__(self, head_size: int = DEFAULT_HEAD_SIZE, tail_size: int = DEFAULT_TAIL_SIZE):
+        if head_size < 0 or tail_size < 0:
+            raise InvalidConfigException(f"Output capture sizes must be >= 0, got head {head_size}, tail {tail_size}")
+        self._head_size = head_size
+        self._tail_size = tail_size
+        self._head: List[str] = []
+        self._head_len = 0
+        self._tail: Deque[str] = deque()
+        self._tail_len = 0
+        self._total_size = 0
+
+    @property
+    def total_size(self) -> int:
+        """Number of characters written so far, including the dropped ones."""
+        return self._total_size
+
+    @property
+    def truncated(self) -> bool:
+        return self._total_size > self._head_size + self._tail_size
+
+    def write(self, text: str) -> str:
+        """Capture text, returns the part of it that went into the head, which is the part safe to forward."""
+        self._total_size += len(text)
+        kept = ''
+        if self._head_len < self._head_size:
+            kept = text[:self._head_size - self._head_len]
+            self._head.append(kept)
+            self._head_len += len(kept)
+            text = text[len(kept):]
+        if text and self._tail_size > 0:
+            # A chunk longer than the tail only contributes its end
+            text = text[-self._tail_size:]
+            self._tail.append(text)
+            self._tail_len += len(text)
+            # Drop whole chunks only, the partial one left over is cut in getvalue
+            while self._tail_len - len(self._tail[0]) >= self._tail_size:
+                self._tail_len -= len(self._tail.popleft())
+        return kept
+
+    def getvalue(self) -> str:
+        head = ''.join(self._head)
+        tail = ''.join(self._tail)[-self._tail_size:] if self._tail_size > 0 else ''
+        omitted = self._total_size - len(head) - len(tail)
+        if omitted <= 0:
+            return head + tail
+        return f"{head}\n...... [{omitted} characters truncated] ......\n{tail}"
+
+
+async def coalesce_chunks(chunks: asyncio.Queue, coalesce_interval: float = STREAM_COALESCE_INTERVAL) \
+        -> AsyncGenerator[str, None]:
+    """Yield the text put on chunks until None arrives, chunks arriving within coalesce_interval seconds are merged."""
+    while True:
+        pending = [await chunks.get()]
+        if pending[0] is None:
+            return
+        await asyncio.sleep(coalesce_interval)
+        finished = False
+        while not chunks.empty():
+            chunk = chunks.get_nowait()
+            if chunk is None:
+                finished = True
+                break
+            pending.append(chunk)
+        yield ''.join(pending)
+        if finished:
+            return
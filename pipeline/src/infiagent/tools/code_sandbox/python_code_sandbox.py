@@ -1,18 +1,29 @@
-from typing import Union, Dict
+from typing import AsyncGenerator, Union, Dict, List, Optional
 from werkzeug.datastructures import FileStorage
-from ...tools.base_tool import BaseTool
+from ...tools.sandbox_engine import SandboxCapability, SandboxEngine, SandboxResponse
 from ...utils import clean_ansi, get_logger
-from jupyter_client import BlockingKernelClient
-import json
+from jupyter_client.asynchronous import AsyncKernelClient
+import asyncio
+import atexit
 import os
 import queue
 import re
-import subprocess
+import signal
 import sys
 import time
 import traceback
 from enum import Enum
+from ...exceptions.exceptions import InvalidConfigException, SandboxException
+from ...schemas import MediaFile
 from ...utils.file_utils import clear_files
+from .artifact_store import ArtifactStore, changed_files, scan_files
+from .kernel_launcher import DEFAULT_STARTUP_TIMEOUT, launch_kernel
+from .kernel_pool import KernelHandle, KernelPool
+from .kernel_registry import EVICT_REASON_STUCK, KernelRegistry
+from .kernel_snapshot import SNAPSHOT_DIR_NAME, has_snapshot, referenced_names, restore_kernel, snapshot_kernel
+from .kernel_zygote import KernelZygote
+from .output_capture import STREAM_COALESCE_INTERVAL, STREAM_QUEUE_SIZE, OutputCapture, coalesce_chunks
+from .resource_limits import ExecutionMeter, ExecutionStats, KernelLimits
 
 logger = get_logger()
 
@@ -22,6 +33,15 @@ while 'infiagent' not in os.path.basename(root_directory):
 
 WORK_DIR = f'{root_directory}/tmp/ci_workspace'
 FILE_DIR = f'{root_directory}/tmp/upload_files'
+KERNEL_POOL_DIR = os.path.join(WORK_DIR, '_kernel_pool')
+# Inside the session work dir, hidden so the directory diff does not report stored images again
+ARTIFACT_DIR_NAME = '.outputs'
+KERNEL_LIVENESS_INTERVAL = 1.0
+KERNEL_INTERRUPT_GRACE = 5.0
+# Consecutive failed forks after which kernels are cold started without the template
+MAX_ZYGOTE_FAILURES = 3
+KERNEL_RESTARTED_NOTICE = ('Note: the code interpreter was restarted since the last execution, variables, imports and '
+                           'functions defined by earlier code are lost and must be defined again.')
 
 
 class _Type(Enum):
@@ -30,22 +50,48 @@ class _Type(Enum):
     FAIL = 3
 
 
-class PythonSandBoxToolResponse:
+class PythonSandBoxToolResponse(SandboxResponse):
 
     def __init__(self,
                  sand_box_response: str,
-                 _type: _Type) -> None:
+                 _type: _Type,
+                 execution_stats: Optional[ExecutionStats] = None,
+                 output_files: Optional[List[MediaFile]] = None,
+                 succeeded: Optional[bool] = None) -> None:
         self._sand_box_response = sand_box_response
         self._type = _type
+        self._succeeded = _type == _Type.SUCCESS if succeeded is None else succeeded
+        self._execution_stats = execution_stats
+        self._output_files = output_files or []
 
     @property
     def output_text(self):
-        return self._format(self._sand_box_response, self._type)
+        return self._format(self._sand_box_response, self._type) + self._format_output_files(self._output_files)
 
     @property
     def raw_output(self):
         return self._sand_box_response
 
+    @property
+    def execution_stats(self) -> Optional[ExecutionStats]:
+        return self._execution_stats
+
+    @property
+    def succeeded(self) -> bool:
+        """The code ran to the end without raising, whether or not it printed anything."""
+        return self._succeeded
+
+    @property
+    def output_files(self) -> List[MediaFile]:
+        """Images displayed and files written by the code, their content stays on disk."""
+        return self._output_files
+
+    @staticmethod
+    def _format_output_files(output_files: List[MediaFile]) -> str:
+        if not output_files:
+            return ""
+        return "\nOutput files:\n" + "".join(f"- {file.sandbox_path}\n" for file in output_files)
+
     @classmethod
     def _format(cls, sandbox_response, _type):
         if _type == _Type.FAIL:
@@ -62,148 +108,416 @@ class PythonSandBoxToolResponse:
         return msg
 
 
-class AsyncPythonSandBoxTool(BaseTool):
-    _KERNEL_CLIENTS: Dict[int, BlockingKernelClient] = {}
-    LAUNCH_KERNEL_PY = (f"import os\nos.chdir('{root_directory}/tmp')\nfrom ipykernel import kernelapp as "
-                        f"app\napp.launch_new_instance()")
+class AsyncPythonSandBoxTool(SandboxEngine):
+    capabilities = (SandboxCapability.STREAMING | SandboxCapability.STATEFUL | SandboxCapability.SNAPSHOT |
+                    SandboxCapability.FILE_OUTPUTS)
+    _KERNEL_REGISTRY: Optional[KernelRegistry] = None
+    _KERNEL_POOL: Optional[KernelPool] = None
+    _KERNEL_STARTUP_TIMEOUT: float = DEFAULT_STARTUP_TIMEOUT
+    _KERNEL_ZYGOTE: Optional[KernelZygote] = None
+    _ZYGOTE_FAILURES: int = 0
+    _KERNEL_LIMITS: KernelLimits = KernelLimits()
+    _OUTPUT_CAPTURE: Dict[str, int] = {}
+    _KERNEL_SNAPSHOT: bool = False
+    RESET_KERNEL_PY = (f"get_ipython().run_line_magic('reset', '-f')\nimport os\nos.chdir('{root_directory}/tmp')\n"
+                       f"del os")
 
     def __init__(self, name, description, **kwargs):
         super().__init__(name, description, **kwargs)
-        self._sandbox_id = None
+        # The kernel of the session was evicted and replaced without its variables, not told to the agent yet
+        self._kernel_restarted = False
 
     @classmethod
     async def create(cls, config_data, **params):
         # Unpack the config_data dictionary and any additional parameters
         instance = cls(name=config_data['name'], description=config_data['description'], **params)
+        cls.configure_kernels(config_data)
+        cls.configure_execution_cache(config_data)
+        cls._kernel_pool().fill()
+        cls._kernel_registry().start_reaper()
         return instance
 
     @classmethod
-    def kill_kernels(cls, sandbox_id):
-        if sandbox_id in AsyncPythonSandBoxTool._KERNEL_CLIENTS:
-            AsyncPythonSandBoxTool._KERNEL_CLIENTS[sandbox_id].shutdown()
-            del AsyncPythonSandBoxTool._KERNEL_CLIENTS[sandbox_id]
-        clear_files(os.path.join(WORK_DIR, sandbox_id))
-        clear_files(os.path.join(FILE_DIR, sandbox_id))
-
-    def _start_kernel(self) -> BlockingKernelClient:
-        connection_file = os.path.join(WORK_DIR, self.sandbox_id, f'kernel_connection_file_{self.sandbox_id}.json')
-        launch_kernel_script = os.path.join(WORK_DIR, self.sandbox_id, f'launch_kernel_{self.sandbox_id}.py')
-        for f in [connection_file, launch_kernel_script]:
-            if os.path.exists(f):
-                os.remove(f)
-
-        os.makedirs(os.path.join(WORK_DIR, self.sandbox_id), exist_ok=True)
-        with open(launch_kernel_script, 'w') as fout:
-            fout.write(AsyncPythonSandBoxTool.LAUNCH_KERNEL_PY)
-
-        kernel_process = subprocess.Popen([
-            sys.executable,
-            launch_kernel_script,
-            '--IPKernelApp.connection_file',
-            connection_file,
-            '--matplotlib=inline',
-            '--quiet',
-        ],
-            cwd=WORK_DIR)
-
-        # Wait for kernel connection file to be written
-        while True:
-            if not os.path.isfile(connection_file):
-                time.sleep(0.1)
-            else:
-                # Keep looping if JSON parsing fails, file may be partially written
+    def configure_kernels(cls, config_data: Dict):
+        """Create the worker-wide kernel template, pool and registry on first use, later configs reuse them."""
+        if AsyncPythonSandBoxTool._KERNEL_POOL is not None:
+            return
+
+        AsyncPythonSandBoxTool._KERNEL_STARTUP_TIMEOUT = config_data.get('kernel_startup_timeout',
+                                                                         DEFAULT_STARTUP_TIMEOUT)
+        kernel_limits = KernelLimits(**(config_data.get('kernel_limits') or {}))
+        if kernel_limits.cpu_time_limit and (config_data.get('kernel_pool') or {}).get('recycle_kernels', False):
+            # RLIMIT_CPU counts the whole life of the process, a recycled kernel brings the CPU time of its earlier
+            # sessions along and the next session would be killed for work it never ran
+            raise InvalidConfigException("kernel_limits.cpu_time_limit cannot be combined with "
+                                         "kernel_pool.recycle_kernels, the limit covers the lifetime of a kernel")
+        AsyncPythonSandBoxTool._KERNEL_LIMITS = kernel_limits
+        # Validated here rather than on the first execution
+        AsyncPythonSandBoxTool._OUTPUT_CAPTURE = config_data.get('output_capture') or {}
+        OutputCapture(**AsyncPythonSandBoxTool._OUTPUT_CAPTURE)
+        AsyncPythonSandBoxTool._KERNEL_SNAPSHOT = (config_data.get('kernel_snapshot') or {}).get('enabled', False)
+        template_config = config_data.get('kernel_template') or {}
+        if template_config.get('enabled', False):
+            AsyncPythonSandBoxTool._KERNEL_ZYGOTE = KernelZygote(template_config.get('preload_modules'))
+        pool = KernelPool(launcher=cls._start_kernel, reset_code=cls.RESET_KERNEL_PY,
+                          **(config_data.get('kernel_pool') or {}))
+        registry = KernelRegistry(on_evict=lambda sandbox_id, handle: pool.release(handle),
+                                  **(config_data.get('kernel_registry') or {}))
+        AsyncPythonSandBoxTool._KERNEL_REGISTRY = registry
+        AsyncPythonSandBoxTool._KERNEL_POOL = pool
+        atexit.register(cls.shutdown_kernels)
+
+    @classmethod
+    def shutdown_kernels(cls):
+        """Kill the kernel template and every kernel of the worker, registered with atexit by configure_kernels."""
+        if AsyncPythonSandBoxTool._KERNEL_ZYGOTE is not None:
+            AsyncPythonSandBoxTool._KERNEL_ZYGOTE.close()
+        if AsyncPythonSandBoxTool._KERNEL_REGISTRY is not None:
+            for handle in AsyncPythonSandBoxTool._KERNEL_REGISTRY.pop_all():
                 try:
-                    with open(connection_file, 'r') as fp:
-                        json.load(fp)
-                    break
-                except json.JSONDecodeError:
+                    handle.kill()
+                except ProcessLookupError:
                     pass
+                KernelPool.retire(handle)
+        if AsyncPythonSandBoxTool._KERNEL_POOL is not None:
+            AsyncPythonSandBoxTool._KERNEL_POOL.close(kill=True)
 
-        # Client
-        kc = BlockingKernelClient(connection_file=connection_file)
-        kc.load_connection_file()
-        kc.start_channels()
-        kc.wait_for_ready()
-        return kc
+    @classmethod
+    def _kernel_pool(cls) -> KernelPool:
+        cls.configure_kernels({})
+        return AsyncPythonSandBoxTool._KERNEL_POOL
 
-    async def set_sandbox_id(self, sandbox_id):
-        self._sandbox_id = sandbox_id
+    @classmethod
+    def _kernel_registry(cls) -> KernelRegistry:
+        cls.configure_kernels({})
+        return AsyncPythonSandBoxTool._KERNEL_REGISTRY
 
-    @property
-    def sandbox_id(self):
-        """Getter for sandbox_id."""
-        return self._sandbox_id
+    @classmethod
+    def kernel_metrics(cls) -> Dict[str, int]:
+        """Live, busy, idle and evicted session kernels, plus the warm kernels waiting in the pool."""
+        metrics = cls._kernel_registry().metrics()
+        metrics['pooled'] = cls._kernel_pool().idle_count
+        return metrics
+
+    @classmethod
+    def kill_kernels(cls, sandbox_id):
+        handle = cls._kernel_registry().pop(sandbox_id)
+        if handle is not None:
+            cls._kernel_pool().release(handle)
+        for session_dir in [os.path.join(WORK_DIR, sandbox_id), os.path.join(FILE_DIR, sandbox_id)]:
+            if os.path.isdir(session_dir):
+                clear_files(session_dir)
+
+    @classmethod
+    async def _start_kernel(cls) -> KernelHandle:
+        zygote = AsyncPythonSandBoxTool._KERNEL_ZYGOTE
+        if zygote is not None:
+            try:
+                handle = await zygote.spawn(KERNEL_POOL_DIR, cwd=f'{root_directory}/tmp',
+                                            startup_timeout=AsyncPythonSandBoxTool._KERNEL_STARTUP_TIMEOUT,
+                                            rlimits=AsyncPythonSandBoxTool._KERNEL_LIMITS.to_rlimits())
+                AsyncPythonSandBoxTool._ZYGOTE_FAILURES = 0
+                return handle
+            except (SandboxException, OSError) as e:
+                logger.warning(f"Failed to fork kernel from template, fall back to a cold start. Error: {str(e)}")
+                AsyncPythonSandBoxTool._ZYGOTE_FAILURES += 1
+                if AsyncPythonSandBoxTool._ZYGOTE_FAILURES >= MAX_ZYGOTE_FAILURES \
+                        and AsyncPythonSandBoxTool._KERNEL_ZYGOTE is zygote:
+                    # Every lease would wait for it in vain, kernels cold start from now on
+                    logger.error(f"Kernel template failed {MAX_ZYGOTE_FAILURES} times in a row, disabling it")
+                    AsyncPythonSandBoxTool._KERNEL_ZYGOTE = None
+                    zygote.close()
+        return await launch_kernel(KERNEL_POOL_DIR, cwd=f'{root_directory}/tmp',
+                                   startup_timeout=AsyncPythonSandBoxTool._KERNEL_STARTUP_TIMEOUT,
+                                   rlimits=AsyncPythonSandBoxTool._KERNEL_LIMITS.to_rlimits())
 
     async def sync_to_sandbox(self, file: Union[str, Dict, FileStorage]) -> str:
         return os.path.join(root_directory, f"tmp/upload_files/{self.sandbox_id}/{file.split('/')[-1]}")
 
     @staticmethod
-    def _input_handler(input_code: str) -> str:
-        # 使用正则表达式查找被三重反引号包围的代码块
-        code_blocks = re.findall(r'```(?:python)?\s*(.*?)\s*```', input_code, re.DOTALL)
+    def _escape_ansi(line: str) -> str:
+        ansi_escape = re.compile(r'(?:\x1B[@-_]|[\x80-\x9F])[0-?]*[ -/]*[@-~]')
+        return ansi_escape.sub('', line)
 
-        # 合并所有找到的代码块
-        python_code_cleaned = '\n'.join(code_blocks).strip()
+    @staticmethod
+    def _capture(capture: OutputCapture, parts: List[str]) -> str:
+        """Write message parts to the capture, newline separated as they used to be joined, and return the kept text."""
+        kept = []
+        for part in parts:
+            if capture.total_size:
+                capture.write('\n')
+            kept.append(capture.write(part))
+        return ''.join(kept)
 
-        return python_code_cleaned
+    @staticmethod
+    def _poll_timeout(deadline: Optional[float]) -> float:
+        if deadline is None:
+            return KERNEL_LIVENESS_INTERVAL
+        return max(min(deadline - time.monotonic(), KERNEL_LIVENESS_INTERVAL), 0)
 
     @staticmethod
-    def _escape_ansi(line: str) -> str:
-        ansi_escape = re.compile(r'(?:\x1B[@-_]|[\x80-\x9F])[0-?]*[ -/]*[@-~]')
-        return ansi_escape.sub('', line)
+    async def _interrupt_kernel(handle: KernelHandle, msg_id: str) -> bool:
+        """Send SIGINT to the kernel and drain iopub until the interrupted execution reports idle."""
+        try:
+            os.kill(handle.process.pid, signal.SIGINT)
+        except ProcessLookupError:
+            return False
+
+        deadline = time.monotonic() + KERNEL_INTERRUPT_GRACE
+        while time.monotonic() < deadline:
+            try:
+                msg = await handle.client.get_iopub_msg(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if msg['parent_header'].get('msg_id') == msg_id and msg['msg_type'] == 'status' \
+                    and msg['content'].get('execution_state') == 'idle':
+                return True
+        logger.warning(f"Kernel {handle.kernel_id} not idle {KERNEL_INTERRUPT_GRACE} seconds after the interrupt")
+        return False
 
     @staticmethod
-    def _execute_code(kc: BlockingKernelClient, code: str) -> PythonSandBoxToolResponse:
-        kc.wait_for_ready()
-        kc.execute(code)
-        result = []
+    async def _execute_code(handle: KernelHandle, code: str, timeout: Optional[float] = None,
+                            output_queue: Optional[asyncio.Queue] = None,
+                            artifact_store: Optional[ArtifactStore] = None,
+                            notice: Optional[str] = None) -> PythonSandBoxToolResponse:
+        kc = handle.client
+        if notice and output_queue is not None:
+            await output_queue.put(notice + '\n')
+        # The time limit covers waiting for the kernel as well
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            await kc.wait_for_ready(timeout=timeout)
+        except RuntimeError as e:
+            logger.warning(f"Kernel {handle.kernel_id} not ready. Error: {str(e)}")
+            handle.kill()
+            failure = (f'Timeout: The code interpreter did not respond within the time limit of {timeout} seconds, '
+                       f'it was restarted.')
+            return PythonSandBoxToolResponse(sand_box_response='\n'.join(([notice] if notice else []) + [failure]),
+                                             _type=_Type.FAIL, succeeded=False)
+        meter = ExecutionMeter(handle.process.pid)
+        meter.start()
+        msg_id = kc.execute(code)
+        # Output is bounded as it arrives, nothing below ever holds more than the capture sizes
+        stdout = OutputCapture(**AsyncPythonSandBoxTool._OUTPUT_CAPTURE)
+        errors = OutputCapture(**AsyncPythonSandBoxTool._OUTPUT_CAPTURE)
+        failures = []
+        images = []
         state = _Type.FAIL
 
         while True:
             finished = False
+            text = None
             try:
-                msg = kc.get_iopub_msg()
+                msg = await kc.get_iopub_msg(timeout=AsyncPythonSandBoxTool._poll_timeout(deadline))
+                if msg['parent_header'].get('msg_id') != msg_id:
+                    # Left over from an earlier execution, e.g. a late message after a timeout
+                    continue
                 msg_type = msg['msg_type']
                 logger.info(msg_type)
                 if msg_type == 'status':
                     if msg['content'].get('execution_state') == 'idle':
                         finished = True
                 elif msg_type == 'execute_result':
-                    text = msg['content']['data'].get('text/plain', '')
-                    result.append(text)
+                    text = AsyncPythonSandBoxTool._capture(stdout, [msg['content']['data'].get('text/plain', '')])
+                    if artifact_store is not None:
+                        # Decoding and writing a figure is blocking file I/O, kept off the event loop
+                        images.extend(await asyncio.to_thread(artifact_store.put_display_data,
+                                                              msg['content']['data']))
+                    state = _Type.SUCCESS
+                elif msg_type == 'display_data':
+                    if artifact_store is not None:
+                        images.extend(await asyncio.to_thread(artifact_store.put_display_data,
+                                                              msg['content']['data']))
                     state = _Type.SUCCESS
                 elif msg_type == 'stream':
-                    text = msg['content']['text']
-                    result.append(text)
+                    text = AsyncPythonSandBoxTool._capture(stdout, [msg['content']['text']])
                     state = _Type.SUCCESS
                 elif msg_type == 'error':
-                    text = AsyncPythonSandBoxTool._escape_ansi('\n'.join(msg['content']['traceback']))
-                    result.append(text)
+                    text = AsyncPythonSandBoxTool._capture(errors, msg['content']['traceback'])
+                    text = AsyncPythonSandBoxTool._escape_ansi(text)
                     state = _Type.ERROR
+                if text and output_queue is not None:
+                    # Blocks while the stream consumer is behind, the kernel output waits in the iopub socket
+                    await output_queue.put(text)
             except queue.Empty:
-                text = 'Timeout: Code execution exceeded the time limit.'
-                result.append(text)
-                state = _Type.FAIL
-                finished = True
+                if not handle.is_alive():
+                    failures.append('The code interpreter died, the code may have exceeded its memory or CPU time '
+                                    'limit.')
+                    state = _Type.FAIL
+                    finished = True
+                elif deadline is not None and time.monotonic() >= deadline:
+                    if await AsyncPythonSandBoxTool._interrupt_kernel(handle, msg_id):
+                        failures.append(f'Timeout: Code execution exceeded the time limit of {timeout} seconds and '
+                                        f'was interrupted.')
+                    else:
+                        # Stuck where SIGINT does not get through, e.g. in native code. Left running, it would block
+                        # every later cell of the session
+                        handle.kill()
+                        failures.append(f'Timeout: Code execution exceeded the time limit of {timeout} seconds and '
+                                        f'could not be interrupted, the code interpreter was restarted.')
+                    state = _Type.FAIL
+                    finished = True
+            except asyncio.CancelledError:
+                # The caller is gone, e.g. the client disconnected. Left running, the cell would keep the kernel of
+                # the session busy, and a kernel that does not stop is killed like on a timeout
+                try:
+                    interrupted = await AsyncPythonSandBoxTool._interrupt_kernel(handle, msg_id)
+                except asyncio.CancelledError:
+                    interrupted = False
+                if not interrupted:
+                    handle.kill()
+                raise
             except Exception:
-                text = 'The code interpreter encountered an unexpected error.'
-                result.append(text)
+                failures.append('The code interpreter encountered an unexpected error.')
                 logger.error(''.join(traceback.format_exception(*sys.exc_info())))
                 state = _Type.FAIL
                 finished = True
             if finished:
                 break
-        output = '\n'.join(result)
-        return PythonSandBoxToolResponse(sand_box_response=output, _type=state)
-
-    async def async_run(self, req: str):
-        formatted_input = self._input_handler(req)
-        if self.sandbox_id in AsyncPythonSandBoxTool._KERNEL_CLIENTS:
-            kc = AsyncPythonSandBoxTool._KERNEL_CLIENTS[self.sandbox_id]
-        else:
-            kc = self._start_kernel()
-            AsyncPythonSandBoxTool._KERNEL_CLIENTS[self.sandbox_id] = kc
 
-        return self._execute_code(kc, formatted_input)
+        result = []
+        if stdout.total_size:
+            result.append(stdout.getvalue())
+        if errors.total_size:
+            result.append(AsyncPythonSandBoxTool._escape_ansi(errors.getvalue()))
+        if stdout.truncated or errors.truncated:
+            logger.info(f"Truncated cell output of {stdout.total_size} characters and errors of {errors.total_size} "
+                        f"characters")
+        output = '\n'.join(([notice] if notice else []) + result + failures)
+        execution_stats = meter.stop()
+        logger.info(f"Kernel {handle.kernel_id} execution stats: {execution_stats}")
+        output_files = [MediaFile(file_name=os.path.basename(path), sandbox_path=path) for path in images]
+        return PythonSandBoxToolResponse(sand_box_response=output, _type=state, execution_stats=execution_stats,
+                                         output_files=output_files,
+                                         succeeded=not failures and not errors.total_size)
+
+    async def _lease_kernel(self) -> KernelHandle:
+        handle = self._kernel_registry().get(self.sandbox_id)
+        if handle is not None:
+            return handle
+
+        handle = await self._kernel_pool().lease()
+        # Another request of this session may have leased a kernel while we were waiting
+        registered = self._kernel_registry().add(self.sandbox_id, handle)
+        if registered is not handle:
+            self._kernel_pool().release(handle)
+            return registered
+        # Told with the next response unless the snapshot below brings the variables back
+        self._kernel_restarted = self._kernel_restarted or self._kernel_registry().pop_evicted(self.sandbox_id)
+        session_dir = self._session_dir()
+        os.makedirs(session_dir, exist_ok=True)
+        # Files written with relative paths land in the session dir, where the directory diff picks them up
+        async with handle.lock:
+            await handle.client.execute_interactive(f"import os\nos.chdir({session_dir!r})\ndel os", silent=True,
+                                                    store_history=False)
+            # Lazy restore, a session coming back after eviction or a restart loads its variables instead of
+            # replaying its cells
+            snapshot_dir = os.path.join(session_dir, SNAPSHOT_DIR_NAME)
+            if AsyncPythonSandBoxTool._KERNEL_SNAPSHOT and has_snapshot(snapshot_dir):
+                if await restore_kernel(handle.client, snapshot_dir):
+                    logger.info(f"Restored sandbox {self.sandbox_id} into kernel {handle.kernel_id} from snapshot")
+                    self._kernel_restarted = False
+        return handle
+
+    def _session_dir(self) -> str:
+        return os.path.join(WORK_DIR, self.sandbox_id)
+
+    async def _run_cell(self, handle: KernelHandle, code: str,
+                        output_queue: Optional[asyncio.Queue] = None) -> PythonSandBoxToolResponse:
+        session_dir = self._session_dir()
+        # A kernel runs one cell at a time, serialize executions so each reader gets its own iopub messages
+        try:
+            async with handle.lock:
+                files_before = await asyncio.to_thread(scan_files, session_dir)
+                notice = KERNEL_RESTARTED_NOTICE if self._kernel_restarted else None
+                self._kernel_restarted = False
+                response = await self._execute_code(handle, code,
+                                                    timeout=AsyncPythonSandBoxTool._KERNEL_LIMITS.cell_timeout,
+                                                    output_queue=output_queue,
+                                                    artifact_store=ArtifactStore(os.path.join(session_dir,
+                                                                                              ARTIFACT_DIR_NAME)),
+                                                    notice=notice)
+                files_after = await asyncio.to_thread(scan_files, session_dir)
+        finally:
+            if handle.killed:
+                # The next cell gets a fresh kernel, restored from the last snapshot
+                self._kernel_registry().evict(self.sandbox_id, EVICT_REASON_STUCK)
+        response.output_files.extend(MediaFile(file_name=os.path.basename(path), sandbox_path=path)
+                                     for path in changed_files(files_before, files_after))
+        if AsyncPythonSandBoxTool._KERNEL_SNAPSHOT:
+            names = referenced_names(code)
+            handle.unsaved_names = None if names is None or handle.unsaved_names is None \
+                else handle.unsaved_names.union(names)
+            if response.succeeded:
+                # In the background, the kernel lock keeps the next cell waiting until the snapshot is written
+                asyncio.ensure_future(self._snapshot_kernel(handle, os.path.join(session_dir, SNAPSHOT_DIR_NAME)))
+        return response
 
+    @staticmethod
+    async def _snapshot_kernel(handle: KernelHandle, snapshot_dir: str):
+        try:
+            async with handle.lock:
+                # The session may have ended and its kernel been retired while the snapshot was waiting
+                if handle.is_alive() and handle.client.channels_running:
+                    # Only the variables the cells since the last snapshot referenced
+                    names = None if handle.unsaved_names is None else sorted(handle.unsaved_names)
+                    if await snapshot_kernel(handle.client, snapshot_dir, names):
+                        handle.unsaved_names = set()
+        except Exception as e:
+            logger.error(f"Failed to snapshot kernel {handle.kernel_id}. Error: {str(e)}", exc_info=True)
 
+    async def async_run(self, req: str):
+        formatted_input = self.extract_code(req)
+        handle = await self._lease_kernel()
+
+        response = await self._run_cell(handle, formatted_input)
+        self._kernel_registry().touch(self.sandbox_id)
+        return response
+
+    async def async_stream(self, req: str, coalesce_interval: float = STREAM_COALESCE_INTERVAL) \
+            -> AsyncGenerator[Union[str, PythonSandBoxToolResponse], None]:
+        """
+        Run the code like async_run, but yield the output text as the kernel produces it and the complete
+        PythonSandBoxToolResponse last. Chunks arriving within coalesce_interval seconds are merged into one, the
+        execution stalls on a bounded queue when the consumer falls behind.
+        """
+        formatted_input = self.extract_code(req)
+        handle = await self._lease_kernel()
+        chunks = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+
+        async def _execute():
+            # None marks the end of the output. It is not sent on cancellation, nobody reads the queue anymore
+            try:
+                response = await self._run_cell(handle, formatted_input, output_queue=chunks)
+            except Exception:
+                await chunks.put(None)
+                raise
+            await chunks.put(None)
+            return response
+
+        execution = asyncio.ensure_future(_execute())
+        try:
+            async for text in coalesce_chunks(chunks, coalesce_interval):
+                yield text
+            response = await execution
+        finally:
+            if not execution.done():
+                execution.cancel()
+        self._kernel_registry().touch(self.sandbox_id)
+        yield response
+
+    async def start(self):
+        await self._lease_kernel()
+
+    async def snapshot(self) -> bool:
+        handle = self._kernel_registry().get(self.sandbox_id)
+        if handle is None:
+            return False
+        async with handle.lock:
+            return await snapshot_kernel(handle.client, os.path.join(self._session_dir(), SNAPSHOT_DIR_NAME))
+
+    async def close(self):
+        """Give the kernel of the session back, its files and snapshot stay for a later resume."""
+        handle = self._kernel_registry().pop(self.sandbox_id)
+        if handle is not None:
+            self._kernel_pool().release(handle)
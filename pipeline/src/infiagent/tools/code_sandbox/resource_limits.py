@@ -0,0 +1,120 @@
+import os
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from ...exceptions.exceptions import InvalidConfigException
+from ...utils import get_logger
+
+logger = get_logger()
+
+# Seconds between the soft CPU limit (SIGXCPU) and the hard one (SIGKILL)
+CPU_LIMIT_GRACE = 5
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+# Executed in the kernel process before IPKernelApp is initialized. Expects `resource_limits` to be a dict with the
+# memory_bytes and cpu_seconds keys, None meaning unlimited.
+APPLY_LIMITS_PY = """import resource
+if resource_limits.get('memory_bytes'):
+    resource.setrlimit(resource.RLIMIT_AS, (resource_limits['memory_bytes'], resource_limits['memory_bytes']))
+if resource_limits.get('cpu_seconds'):
+    resource.setrlimit(resource.RLIMIT_CPU, (resource_limits['cpu_seconds'],
+                                             resource_limits['cpu_seconds'] + %d))
+""" % CPU_LIMIT_GRACE
+
+
+@dataclass
+class KernelLimits:
+    """
+    Resource quotas of a sandbox kernel.
+
+    :param memory_limit_mb: Address space limit of the kernel process, allocations beyond it raise MemoryError.
+    :param cpu_time_limit: CPU seconds the kernel process may use over its lifetime before it is killed. As a
+        lifetime limit it only fits kernels serving a single session, it is rejected with recycled kernels.
+    :param cell_timeout: Wall-clock seconds a single cell may run before the kernel is interrupted.
+    """
+    memory_limit_mb: Optional[int] = None
+    cpu_time_limit: Optional[int] = None
+    cell_timeout: Optional[float] = None
+
+    def __post_init__(self):
+        for name in ['memory_limit_mb', 'cpu_time_limit', 'cell_timeout']:
+            value = getattr(self, name)
+            if value is not None and value <= 0:
+                raise InvalidConfigException(f"Kernel limit {name} must be > 0, got {value}")
+
+    def to_rlimits(self) -> Dict[str, Optional[int]]:
+        return {
+            'memory_bytes': self.memory_limit_mb * 1024 * 1024 if self.memory_limit_mb else None,
+            'cpu_seconds': self.cpu_time_limit,
+        }
+
+
+@dataclass
+class ExecutionStats:
+    """Resources used by one cell execution. Process counters are None where /proc is not available."""
+    wall_time: float
+    cpu_time: Optional[float] = None
+    peak_rss_bytes: Optional[int] = None
+
+    def to_dict(self):
+        return {
+            "wall_time": self.wall_time,
+            "cpu_time": self.cpu_time,
+            "peak_rss_bytes": self.peak_rss_bytes
+        }
+
+
+def _read_cpu_time(pid: int) -> Optional[float]:
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as fp:
+            # The command name may contain spaces, fields are counted after its closing parenthesis
+            fields = fp.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def _reset_peak_rss(pid: int) -> bool:
+    try:
+        with open(f'/proc/{pid}/clear_refs', 'w') as fp:
+            fp.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _read_peak_rss(pid: int) -> Optional[int]:
+    try:
+        with open(f'/proc/{pid}/status', 'r') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, IndexError, ValueError):
+        pass
+    return None
+
+
+class ExecutionMeter:
+    """Measure wall time, CPU time and peak RSS of a kernel process around one execution."""
+
+    def __init__(self, pid: int):
+        self._pid = pid
+        self._start_time = None
+        self._start_cpu_time = None
+        self._peak_rss_reset = False
+
+    def start(self):
+        self._peak_rss_reset = _reset_peak_rss(self._pid)
+        self._start_cpu_time = _read_cpu_time(self._pid)
+        self._start_time = time.monotonic()
+
+    def stop(self) -> ExecutionStats:
+        wall_time = time.monotonic() - self._start_time
+        end_cpu_time = _read_cpu_time(self._pid)
+        cpu_time = None
+        if self._start_cpu_time is not None and end_cpu_time is not None:
+            cpu_time = end_cpu_time - self._start_cpu_time
+        # Without the reset VmHWM is the peak of the whole kernel lifetime, not of this execution
+        peak_rss = _read_peak_rss(self._pid) if self._peak_rss_reset else None
+        return ExecutionStats(wall_time=wall_time, cpu_time=cpu_time, peak_rss_bytes=peak_rss)
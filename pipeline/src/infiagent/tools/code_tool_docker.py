@@ -1,14 +1,25 @@
+import asyncio
+import codecs
+import concurrent.futures
+import itertools
 import os
 import pathlib
-from typing import Tuple, Optional, IO, Union, Dict
+import posixpath
+import shutil
+import threading
+from typing import AsyncGenerator, Tuple, Optional, IO, Union, Dict
 import time
 from hashlib import md5
 import docker
-from ..tools.base_tool import BaseTool, BaseToolRequest, BaseToolResponse
-import re
+from ..tools.base_tool import BaseToolRequest
+from ..tools.sandbox_engine import SandboxCapability, SandboxEngine, SandboxResponse
 from ..exceptions.exceptions import InputErrorException, SandBoxFileUploadException
 from werkzeug.datastructures import FileStorage
-from ..utils import get_logger
+from ..utils import TEMP_FILE_UPLOAD_DIR, get_logger, resolve_root_path
+from .docker_sandbox import CellInterrupted, ContainerPool, DatasetCache, DockerBackend, PersistentRepl
+from .docker_sandbox.docker_backend import DEFAULT_MAX_WORKERS
+from .docker_sandbox.persistent_repl import CONTAINER_WORK_DIR, REPL_DIR_NAME, UPLOAD_DIR_NAME
+from .code_sandbox.output_capture import STREAM_COALESCE_INTERVAL, STREAM_QUEUE_SIZE, OutputCapture, coalesce_chunks
 
 logger = get_logger()
 
@@ -20,6 +31,11 @@ except ImportError:
 WORKING_DIR = os.path.join(os.getcwd(), "tmp/code_space")
 OUTPUT_DIR = os.path.join(os.getcwd(), "tmp/output_space")
 UPLOAD_PATH = os.path.join(os.getcwd(), "tmp/upload_files")
+# How often a log thread blocked on a full output queue checks whether the stream was abandoned
+STREAM_PUT_POLL_INTERVAL = 0.5
+CONFIG_KEYS = ["image", "time_out", "work_dir", "output_dir", "persistent", "mem_limit", "idle_timeout", "pool_size",
+               "dataset_cache_dir", "dataset_cache_max_size", "docker_max_workers",
+               "tmpfs_size"]
 
 
 class CodeToolRequest(BaseToolRequest):
@@ -28,9 +44,7 @@ class CodeToolRequest(BaseToolRequest):
     """
     def __init__(self, code_str: str):
         # code_str = 'import pandas as pd\nimport numpy as np\n'+ code_str
-        code_blocks = re.findall(r'```(?:python)?\s*(.*?)\s*```', code_str, re.DOTALL)
-        python_code_cleaned = '\n'.join(code_blocks).strip()
-        self.code = python_code_cleaned
+        self.code = SandboxEngine.extract_code(code_str)
 
 class PythonSandBoxToolResponseDocker:
     def __init__(self, formatter, raw_output) -> None:
@@ -42,7 +56,7 @@ class PythonSandBoxToolResponseDocker:
         return self.formatter.format(self.raw_output)
 
 
-class CodeToolResponse(BaseToolResponse):
+class CodeToolResponse(SandboxResponse):
     """
     Response for Code Tool
     """
@@ -50,7 +64,14 @@ class CodeToolResponse(BaseToolResponse):
         self.exit_code = exit_code
         self.log = log
         self.output_dir = output_dir
-        self.output_text = log
+
+    @property
+    def output_text(self):
+        return self.log
+
+    @property
+    def succeeded(self) -> bool:
+        return self.exit_code == 0
     
     def to_dict(self):
         return {
@@ -60,10 +81,26 @@ class CodeToolResponse(BaseToolResponse):
         }
 
 
-class CodeTool(BaseTool):
+class CodeTool(SandboxEngine):
     """
     Code Tool for code execution
+
+    By default each step appends its code to one script and runs the whole script in a new container. With persistent
+    set, a container per session keeps an interpreter running and each step only sends its own code to it. With
+    pool_size > 0 as well, those containers are leased from a pool of paused ones per image, and a leased container
+    without a cell for idle_timeout seconds is reclaimed by the pool. mem_limit applies to the containers of both modes.
+
+    With dataset_cache_dir set, uploaded files are stored once per content in that dir and mounted read-only instead
+    of being bind-mounted from the upload dir of each session. A container only gets the datasets of its own session,
+    and dataset_cache_max_size bounds the store in bytes.
+
+    In persistent mode, save_file keeps only the files the session created or modified. With tmpfs_size set as well,
+    the working dir of each container is a tmpfs of that size and only those files are copied out of it.
     """
+    _CONTAINER_POOLS: Dict[str, ContainerPool] = {}
+    _DATASET_CACHES: Dict[str, DatasetCache] = {}
+    _DOCKER_BACKEND: Optional[DockerBackend] = None
+
     def __init__(self,
                  name: Optional[str] = "Code Tool",
                  description: Optional[str] = "tool for code_exec",
@@ -72,40 +109,133 @@ class CodeTool(BaseTool):
                  time_out: Optional[int] = 60,
                  work_dir: Optional[str] = WORKING_DIR,
                  output_dir: Optional[str] = OUTPUT_DIR,
+                 persistent: Optional[bool] = False,
+                 mem_limit: Optional[str] = '1024m',
+                 idle_timeout: Optional[int] = 1800,
+                 pool_size: Optional[int] = 0,
+                 dataset_cache_dir: Optional[str] = None,
+                 dataset_cache_max_size: Optional[int] = None,
+                 docker_max_workers: Optional[int] = DEFAULT_MAX_WORKERS,
+                 tmpfs_size: Optional[str] = None,
                  **kwargs
                  ):
         super().__init__(name, description, **kwargs)
-        self._client = docker.from_env()
+        self.capabilities = SandboxCapability.STREAMING | SandboxCapability.ISOLATED
+        if persistent:
+            self.capabilities |= SandboxCapability.STATEFUL
+        self._docker = self._get_docker_backend(docker_max_workers)
+        self._client = self._docker.client
         self._image = image
         self._time_out = time_out
         self._work_dir = work_dir
         self._output_dir = output_dir
         self._upload_file_name = None
         self._upload_file_path = None
+        self._upload_file_digest = None
+        # Uploads of a persistent session by file name, a new container of the session gets them as well
+        self._uploads: Dict[str, str] = {}
         self._code_idx = md5(str(time.time()).encode()).digest().hex()
         self._log_len = 0
+        self._persistent = persistent
+        self._mem_limit = mem_limit
+        self._idle_timeout = idle_timeout
+        self._tmpfs_size = tmpfs_size
+        self._repl: Optional[PersistentRepl] = None
+        self._container_pool: Optional[ContainerPool] = None
+        self._dataset_cache: Optional[DatasetCache] = None
+        if dataset_cache_dir:
+            self._dataset_cache = self._get_dataset_cache(dataset_cache_dir, dataset_cache_max_size)
+        if persistent:
+            # The container keeps the work dir mounted for its whole life, so sessions get their own
+            self._work_dir = os.path.join(work_dir, f"session_{self._code_idx[:16]}")
+            if pool_size:
+                self._container_pool = self._get_container_pool(self._docker, image, os.path.join(work_dir, "_pool"),
+                                                                pool_size, mem_limit, tmpfs_size, idle_timeout,
+                                                                self._dataset_cache is not None)
 
     @classmethod
     async def create(cls, config_data, **params):
         # Unpack the config_data dictionary and any additional parameters
-        instance = cls(name=config_data['name'], description=config_data['description'], **params)
+        tool_config = {key: config_data[key] for key in CONFIG_KEYS if key in config_data}
+        instance = cls(name=config_data['name'], description=config_data['description'], **tool_config, **params)
+        cls.configure_execution_cache(config_data)
+        if instance._container_pool is not None:
+            instance._container_pool.fill()
         return instance
 
-    async def set_sandbox_id(self, sandbox_id):
-        self._sandbox_id = sandbox_id
+    @classmethod
+    def _get_container_pool(cls, docker_backend: DockerBackend, image: str, pool_dir: str, size: int, mem_limit: Optional[str],
+                            tmpfs_size: Optional[str], idle_timeout: Optional[float], datasets: bool):
+        """One pool per image and worker, created by the first tool using it."""
+        if image not in cls._CONTAINER_POOLS:
+            cls._CONTAINER_POOLS[image] = ContainerPool(docker_backend, image, pool_dir, size=size, mem_limit=mem_limit,
+                                                        tmpfs_size=tmpfs_size, idle_timeout=idle_timeout,
+                                                        datasets=datasets)
+        return cls._CONTAINER_POOLS[image]
 
-    @property
-    def sandbox_id(self):
-        """Getter for sandbox_id."""
-        return self._sandbox_id if self._sandbox_id else None
+    @classmethod
+    def _get_docker_backend(cls, max_workers: int) -> DockerBackend:
+        """One client and call pool per worker, created by the first tool, sessions share its connections."""
+        if cls._DOCKER_BACKEND is None:
+            cls._DOCKER_BACKEND = DockerBackend(max_workers)
+        return cls._DOCKER_BACKEND
 
+    @classmethod
+    def _get_dataset_cache(cls, cache_dir: str, max_size: Optional[int]) -> DatasetCache:
+        """One cache per dir and worker, the digest index is shared by all sessions."""
+        cache_dir = resolve_root_path(cache_dir)
+        if cache_dir not in cls._DATASET_CACHES:
+            cls._DATASET_CACHES[cache_dir] = DatasetCache(cache_dir, max_size=max_size)
+        return cls._DATASET_CACHES[cache_dir]
 
     async def async_run(self, req: str):
         req = CodeToolRequest(req)
         code = req.code
         if code is None:
-            return "No code to execute", 1, ""
-        
+            return CodeToolResponse(1, "No code to execute", self._output_dir)
+        if self._persistent:
+            return await self._run_persistent(code)
+        return await self._run_script(code)
+
+    async def async_stream(self, req: str, coalesce_interval: float = STREAM_COALESCE_INTERVAL) \
+            -> AsyncGenerator[Union[str, CodeToolResponse], None]:
+        """
+        Run the code like async_run, but yield the output text as the container prints it and the CodeToolResponse
+        last. The output is bounded by an OutputCapture: only its head is streamed, and the response holds the head
+        and the tail of a long output. In persistent mode the REPL answers with the whole output of a cell once it
+        finished, so nothing streams while a cell runs. That output is yielded as one chunk.
+        """
+        code = CodeToolRequest(req).code
+        if self._persistent:
+            response = await self._run_persistent(code)
+            if response.log:
+                yield response.log
+            yield response
+            return
+
+        chunks = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+
+        async def _execute():
+            # None marks the end of the output. It is not sent on cancellation, nobody reads the queue anymore
+            try:
+                response = await self._run_script(code, output_queue=chunks)
+            except Exception:
+                await chunks.put(None)
+                raise
+            await chunks.put(None)
+            return response
+
+        execution = asyncio.ensure_future(_execute())
+        try:
+            async for text in coalesce_chunks(chunks, coalesce_interval):
+                yield text
+            response = await execution
+        finally:
+            if not execution.done():
+                execution.cancel()
+        yield response
+
+    async def _run_script(self, code: str, output_queue: Optional[asyncio.Queue] = None) -> CodeToolResponse:
         # path and file name for python script
         abs_path = pathlib.Path(self._work_dir).absolute()
         code_hash = self._code_idx
@@ -116,69 +246,181 @@ class CodeTool(BaseTool):
         self._file_dir = file_dir
         os.makedirs(file_dir, exist_ok=True)
         os.makedirs(OUTPUT_DIR, exist_ok=True)
-        if self._upload_file_name:
+        if self._upload_file_digest:
+            # Stored again if the store dropped it since the upload, a known file is not read
+            self._upload_file_digest = await self._store_dataset(self._upload_file_path)
+            upload_volume = {self._dataset_cache.host_path(self._upload_file_digest):
+                             {'bind': f'/tmp/upload_files/{self._upload_file_name}', 'mode': 'ro'}}
+        elif self._upload_file_name:
             upload_file_path = os.path.join(UPLOAD_PATH, self._upload_file_name)
+            upload_volume = {upload_file_path: {'bind': f'/tmp/upload_files/{self._upload_file_name}','mode': 'rw'}}
         
         # write code to file
         with open(file_path, "a", encoding="utf-8") as fout:
             fout.write(code)
         cmd = f'python3 {file_name}'
-        
+        output_dir = os.path.join(OUTPUT_DIR, f'output_{code_hash}')
+        self._output_dir = output_dir
+
         # create docker container
         start_time = time.time()
         if self._upload_file_name:
-            container = self._client.containers.run(
+            container = await self._docker.run(
+                self._client.containers.run,
                 image=self._image,
                 command=cmd,
                 detach=True, 
                 working_dir="/workspace",
-                mem_limit='1024m',
-                volumes={abs_path: {'bind': '/workspace','mode': 'rw'},
-                        upload_file_path: {'bind': f'/tmp/upload_files/{self._upload_file_name}','mode': 'rw'}},
+                mem_limit=self._mem_limit,
+                volumes={abs_path: {'bind': '/workspace','mode': 'rw'}, **upload_volume},
                 )
         else:
-            container = self._client.containers.run(
+            container = await self._docker.run(
+                self._client.containers.run,
                 image=self._image,
                 command=cmd,
                 detach=True, 
                 working_dir="/workspace",
-                mem_limit='10m',
+                mem_limit=self._mem_limit,
                 volumes={abs_path: {'bind': '/workspace','mode': 'rw'}},
                 )
 
-        # hold for time_out seconds
-        while container.status != "exited" and time.time() - start_time < self._time_out:
-            container.reload()
-        
-        # if time out, stop and remove container
-        if container.status != "exited":
-            container.stop()
-            container.remove()
-            return "TIMEOUT", 1, ""
-        
-        # save log to file
-        logs = container.logs().decode("utf-8").rstrip()
-        with open(os.path.join(file_dir, f'log.txt'), 'w') as log_file:
-            log_file.write(logs)
-        new_len = len(logs)
-        logs = logs[self._log_len:]
-        self._log_len = new_len
-
-        exit_code = container.attrs["State"]["ExitCode"]
-        container.remove()
-
-        # save files to output space and rmv files in working space
-        output_dir = os.path.join(OUTPUT_DIR, f'output_{code_hash}')
-        self._output_dir = output_dir
-        # os.makedirs(output_dir, exist_ok=True)
-        # os.rename(file_path, os.path.join(file_dir, 'exec_code.py'))
-        # for f in os.listdir(abs_path):
-        #     os.rename(os.path.join(abs_path, f), os.path.join(output_dir, f))
-        # os.rmdir(abs_path)
+        # follow the log while the container runs, it is written to file and captured as it arrives
+        capture = OutputCapture()
+        stop_following = threading.Event()
+        follow = asyncio.ensure_future(self._docker.run_stream(
+            self._follow_logs, container, asyncio.get_running_loop(), os.path.join(file_dir, 'log.txt'), capture,
+            output_queue, stop_following))
+        try:
+            # hold for time_out seconds, the log ends when the container exits
+            try:
+                log_len = await asyncio.wait_for(asyncio.shield(follow), self._time_out - (time.time() - start_time))
+                exit_code = (await self._docker.run(container.wait))["StatusCode"]
+            except asyncio.TimeoutError:
+                # if time out, stop the container, which ends the log
+                exit_code = None
+                await self._docker.run(container.stop)
+                await follow
+        except BaseException:
+            stop_following.set()
+            self._docker.submit(container.remove, force=True)
+            raise
+        self._docker.submit(container.remove)
+        if exit_code is None:
+            return CodeToolResponse(1, "TIMEOUT", output_dir)
 
-        response = CodeToolResponse(exit_code, logs, output_dir)
-        
-        return response
+        # earlier steps already returned the output of the script up to here
+        self._log_len = log_len
+        return CodeToolResponse(exit_code, capture.getvalue().rstrip(), output_dir)
+
+    def _follow_logs(self, container, loop: asyncio.AbstractEventLoop, log_path: str, capture: OutputCapture,
+                     output_queue: Optional[asyncio.Queue], stop: threading.Event) -> int:
+        """
+        Stream the container log to log_path until the container exits and return its length. Output past the part
+        returned by earlier steps goes to capture, and its head to output_queue, waiting while the queue is full.
+        Runs on the stream pool of the docker backend.
+        """
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        skip = self._log_len
+        log_len = 0
+        with open(log_path, 'w', encoding='utf-8') as log_file:
+            for data in itertools.chain(container.logs(stream=True, follow=True), [None]):
+                text = decoder.decode(b'', final=True) if data is None else decoder.decode(data)
+                log_file.write(text)
+                log_len += len(text)
+                if skip:
+                    text, skip = text[skip:], max(skip - len(text), 0)
+                kept = capture.write(text) if text else ''
+                if not kept or output_queue is None:
+                    continue
+                put = asyncio.run_coroutine_threadsafe(output_queue.put(kept), loop)
+                while not stop.is_set():
+                    try:
+                        put.result(timeout=STREAM_PUT_POLL_INTERVAL)
+                        break
+                    except concurrent.futures.TimeoutError:
+                        pass
+                else:
+                    put.cancel()
+                    output_queue = None
+        return log_len
+
+    async def _ensure_repl(self) -> PersistentRepl:
+        if self._repl is not None and self._repl.is_running():
+            return self._repl
+        # Files of a REPL that exited on its idle timeout or died are still in the work dir, a new container in the
+        # same dir harvests them as well
+        changed_files = []
+        if self._repl is not None:
+            logger.info(f"REPL of session {self._code_idx} is gone, starting a new one")
+            if self._container_pool is None:
+                changed_files = self._repl.changed_files
+            self._release_repl()
+        if self._container_pool is not None:
+            self._repl = await self._container_pool.lease()
+            # The slot dir of the pooled container is the work dir of the session from now on
+            self._work_dir = self._repl.host_dir
+        else:
+            self._repl = PersistentRepl(self._docker, self._image, str(pathlib.Path(self._work_dir).absolute()),
+                                        mem_limit=self._mem_limit, idle_timeout=self._idle_timeout,
+                                        tmpfs_size=self._tmpfs_size, datasets=self._dataset_cache is not None)
+            await self._repl.start()
+            self._repl.record_changed_files(changed_files)
+        for file_name, file_path in self._uploads.items():
+            await self._mount_upload(self._repl, file_name, file_path)
+        return self._repl
+
+    async def _run_persistent(self, code: str):
+        repl = await self._ensure_repl()
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+        # Keep a record of the session as one script, save_file moves it to the outputs like in the legacy mode
+        self._file_path = os.path.join(self._work_dir, f"exec_code_{self._code_idx}.py")
+        self._file_dir = os.path.dirname(self._file_path)
+        with open(self._file_path, "a", encoding="utf-8") as fout:
+            fout.write(code + "\n")
+        self._output_dir = os.path.join(OUTPUT_DIR, f'output_{self._code_idx}')
+
+        try:
+            exit_code, logs = await repl.execute(code, timeout=self._time_out)
+        except CellInterrupted as e:
+            logger.warning(f"Code of session {self._code_idx} timed out after {self._time_out} seconds and was "
+                           f"interrupted")
+            return CodeToolResponse(1, f"{e.output.rstrip()}\nTIMEOUT", self._output_dir)
+        except asyncio.TimeoutError:
+            logger.warning(f"Code of session {self._code_idx} timed out after {self._time_out} seconds, "
+                           f"the REPL container was removed")
+            self._release_repl()
+            return CodeToolResponse(1, "TIMEOUT", self._output_dir)
+        return CodeToolResponse(exit_code, logs.rstrip(), self._output_dir)
+
+    async def start(self):
+        if self._persistent:
+            await self._ensure_repl()
+
+    async def download(self, sandbox_path: str, dst_path: str):
+        """Copy a file of the work dir, sandbox_path is relative to it or below /workspace."""
+        path = posixpath.relpath(sandbox_path, CONTAINER_WORK_DIR) if posixpath.isabs(sandbox_path) else sandbox_path
+        if path.startswith('..'):
+            raise InputErrorException(f"{sandbox_path} is outside of the sandbox work dir {CONTAINER_WORK_DIR}")
+        if self._repl is not None:
+            if not await self._repl.download(path, dst_path):
+                raise FileNotFoundError(sandbox_path)
+            return
+        await asyncio.to_thread(shutil.copyfile, os.path.join(self._work_dir, path), dst_path)
+
+    async def close(self):
+        self._release_repl()
+
+    def _release_repl(self):
+        """Remove the REPL container of a persistent session, or give it back to the pool."""
+        if self._repl is None:
+            return
+        if self._container_pool is not None:
+            self._container_pool.release(self._repl)
+        else:
+            self._repl.close()
+        self._repl = None
 
     async def sync_to_sandbox(self, file: Union[str, Dict, FileStorage]) -> str:
         if isinstance(file, str):
@@ -195,16 +437,65 @@ class CodeTool(BaseTool):
         file_name = file_path.split("/")[-1]  # Extract the file name from the path
         self._upload_file_path = file_path
         self._upload_file_name = file_name
+        if self._dataset_cache is not None:
+            self._upload_file_digest = await self._store_dataset(file_path)
+        if self._persistent:
+            self._uploads[file_name] = file_path
+            if self._repl is not None and self._repl.is_running():
+                # The upload dir is mounted into the running container, the file shows up without a restart
+                await self._mount_upload(self._repl, file_name, file_path)
+            else:
+                # A new container gets all uploads of the session
+                await self._ensure_repl()
 
         return file_path
 
+    async def _store_dataset(self, file_path: str) -> str:
+        # The copies in the upload dirs are ours, they give way to links to the stored dataset
+        own_copy = any(os.path.abspath(file_path).startswith(os.path.abspath(upload_dir) + os.sep)
+                       for upload_dir in (UPLOAD_PATH, TEMP_FILE_UPLOAD_DIR))
+        return await asyncio.to_thread(self._dataset_cache.put, file_path, own_copy)
+
+    async def _mount_upload(self, repl: PersistentRepl, file_name: str, file_path: str):
+        """Put an upload of the session into the upload dir of its container."""
+        upload_path = os.path.join(repl.upload_dir, file_name)
+        if self._dataset_cache is None:
+            await asyncio.to_thread(shutil.copy, file_path, upload_path)
+            return
+        digest = await self._store_dataset(file_path)
+        # Linked into the read-only dataset dir of the container, the symlink only resolves inside it
+        await asyncio.to_thread(self._dataset_cache.link, digest, repl.datasets_dir)
+        target = DatasetCache.container_path(digest)
+        if os.path.islink(upload_path) and os.readlink(upload_path) == target:
+            return
+        if os.path.lexists(upload_path):
+            os.unlink(upload_path)
+        os.symlink(target, upload_path)
+
     async def save_file(self):
         output_dir = self._output_dir
         file_path = self._file_path
         file_dir = self._file_dir
         abs_path = pathlib.Path(self._work_dir).absolute()
         os.makedirs(output_dir, exist_ok=True)
-        os.rename(file_path, os.path.join(file_dir, 'exec_code.py'))
-        for f in os.listdir(abs_path):
-            os.rename(os.path.join(abs_path, f), os.path.join(output_dir, f))
-        os.rmdir(abs_path)
+        if not self._persistent:
+            os.rename(file_path, os.path.join(file_dir, 'exec_code.py'))
+            for f in os.listdir(abs_path):
+                os.rename(os.path.join(abs_path, f), os.path.join(output_dir, f))
+            os.rmdir(abs_path)
+            return
+
+        os.rename(file_path, os.path.join(output_dir, 'exec_code.py'))
+        if self._repl is not None:
+            # Only the files the cells wrote, the REPL keeps the manifest
+            await self._repl.harvest(output_dir)
+        elif not self._tmpfs_size:
+            # The container is gone with its manifest, the work dir on the host still holds the files
+            for f in os.listdir(abs_path):
+                if f not in (REPL_DIR_NAME, UPLOAD_DIR_NAME):
+                    os.rename(os.path.join(abs_path, f), os.path.join(output_dir, f))
+        # A pooled container is reset and keeps its slot dir, a session container goes with its work dir
+        pooled = self._container_pool is not None and self._repl is not None
+        self._release_repl()
+        if not pooled:
+            shutil.rmtree(abs_path, ignore_errors=True)
@@ -0,0 +1,5 @@
+from .container_pool import ContainerPool
+from .dataset_cache import DatasetCache
+from .docker_backend import DockerBackend
+from .persistent_repl import PersistentRepl
+from .repl_connection import CellInterrupted
@@ -0,0 +1,192 @@
+import asyncio
+import os
+import shutil
+import uuid
+from collections import deque
+from typing import Deque, Dict, Optional, Set
+
+from ...exceptions.exceptions import InvalidConfigException, SandboxException
+from ...utils import get_logger
+from .docker_backend import DockerBackend
+from .persistent_repl import DEFAULT_IDLE_TIMEOUT, PersistentRepl
+
+logger = get_logger()
+
+try:
+    import docker
+except ImportError:
+    docker = None
+
+DEFAULT_RESET_TIMEOUT = 30
+# Seconds an unpaused container gets to answer before it is dropped
+DEFAULT_PING_TIMEOUT = 10
+DEFAULT_REAP_INTERVAL = 60
+
+
+class ContainerPool:
+    """
+    Warm REPL containers of one image. Idle containers are paused, so leasing one is an unpause instead of a container
+    create, mount setup and interpreter start. Every container owns a slot dir bind-mounted at /workspace, which is the
+    work dir of the session leasing it. A released container is reset, its namespace, slot dir and dataset dir
+    emptied, and paused again. A leased container idle for longer than idle_timeout, e.g. of a session that ended without releasing it,
+    is removed by a background reaper, its server exits on the same timeout on its own.
+
+    :param docker_backend: Docker client and the pool running its calls.
+    :param image: Image of the containers.
+    :param pool_dir: Host dir holding the slot dirs.
+    :param size: Number of idle containers kept ready.
+    :param mem_limit: Memory limit of each container.
+    :param volumes: Additional volumes of each container, in the docker SDK format.
+    :param tmpfs_size: Size of the tmpfs working dir of each container, None mounts the slot dir.
+    :param idle_timeout: Seconds a leased container may stay without a cell, None never reclaims it.
+    :param reap_interval: Seconds between two checks for leased containers past their idle timeout.
+    :param datasets: Give each container a dataset dir of its own, see PersistentRepl.
+    """
+
+    def __init__(self, docker_backend: DockerBackend, image: str, pool_dir: str, size: int = 0, mem_limit: Optional[str] = None,
+                 volumes: Optional[Dict] = None, tmpfs_size: Optional[str] = None,
+                 idle_timeout: Optional[float] = DEFAULT_IDLE_TIMEOUT, reap_interval: float = DEFAULT_REAP_INTERVAL,
+                 datasets: bool = False):
+        if size < 0:
+            raise InvalidConfigException(f"Container pool size must be >= 0, got {size}")
+        self._docker = docker_backend
+        self._image = image
+        self._pool_dir = pool_dir
+        self._size = size
+        self._mem_limit = mem_limit
+        self._volumes = volumes
+        self._tmpfs_size = tmpfs_size
+        self._idle_timeout = idle_timeout
+        self._reap_interval = reap_interval
+        self._datasets = datasets
+        self._idle: Deque[PersistentRepl] = deque()
+        self._leased: Set[PersistentRepl] = set()
+        self._refill_task: Optional[asyncio.Task] = None
+        self._reap_task: Optional[asyncio.Task] = None
+        self._background_tasks: Set[asyncio.Task] = set()
+
+    @property
+    def idle_count(self) -> int:
+        return len(self._idle)
+
+    @property
+    def leased_count(self) -> int:
+        return len(self._leased)
+
+    def fill(self):
+        """Start filling the pool in the background, if there is a running event loop."""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._schedule_refill()
+
+    async def lease(self) -> PersistentRepl:
+        """Return a running REPL container, from the pool when one is idle, otherwise a newly started one."""
+        while self._idle:
+            repl = self._idle.popleft()
+            try:
+                await repl.unpause()
+                # The server may have exited while paused, the ping also restarts its idle timer
+                await repl.ping(timeout=DEFAULT_PING_TIMEOUT)
+            except (docker.errors.DockerException, SandboxException, asyncio.TimeoutError) as e:
+                logger.warning(f"Dropping pooled REPL container of {repl.host_dir}. Error: {str(e)}")
+                self._discard(repl)
+                continue
+            self._schedule_refill()
+            self._leased.add(repl)
+            self._schedule_reap()
+            return repl
+        self._schedule_refill()
+        repl = await self._start_repl()
+        self._leased.add(repl)
+        self._schedule_reap()
+        return repl
+
+    def release(self, repl: PersistentRepl):
+        """Give a leased container back, it is reset in the background or removed if the pool is full."""
+        self._leased.discard(repl)
+        if repl.is_running() and len(self._idle) < self._size:
+            task = asyncio.ensure_future(self._recycle(repl))
+            self._background_tasks.add(task)
+            task.add_done_callback(self._background_tasks.discard)
+        else:
+            self._discard(repl)
+
+    def reap(self) -> int:
+        """Remove the leased containers idle for longer than idle_timeout, returns how many were removed."""
+        if self._idle_timeout is None:
+            return 0
+        expired = [repl for repl in self._leased if not repl.is_running() or repl.idle_time > self._idle_timeout]
+        for repl in expired:
+            logger.info(f"Reclaiming leased REPL container of {repl.host_dir}, idle for {repl.idle_time:.0f} seconds")
+            self._leased.discard(repl)
+            self._discard(repl)
+        return len(expired)
+
+    def close(self):
+        for task in (self._refill_task, self._reap_task):
+            if task is not None and not task.done():
+                task.cancel()
+        while self._idle:
+            self._discard(self._idle.popleft())
+        while self._leased:
+            self._discard(self._leased.pop())
+
+    async def _recycle(self, repl: PersistentRepl):
+        try:
+            await repl.reset(timeout=DEFAULT_RESET_TIMEOUT)
+            await repl.pause()
+        except Exception as e:
+            logger.warning(f"Failed to recycle REPL container of {repl.host_dir}. Error: {str(e)}")
+            self._discard(repl)
+            return
+        if len(self._idle) < self._size:
+            self._idle.append(repl)
+        else:
+            self._discard(repl)
+
+    async def _start_repl(self) -> PersistentRepl:
+        # Short slot names, the REPL socket path inside the slot is limited in length
+        slot_dir = os.path.join(self._pool_dir, f'slot_{uuid.uuid4().hex[:12]}')
+        # Time paused does not count towards the idle timeout of the server, only a leased container runs out of it
+        repl = PersistentRepl(self._docker, self._image, slot_dir, mem_limit=self._mem_limit, volumes=self._volumes,
+                              idle_timeout=self._idle_timeout, tmpfs_size=self._tmpfs_size, datasets=self._datasets)
+        await repl.start()
+        return repl
+
+    @staticmethod
+    def _discard(repl: PersistentRepl):
+        repl.close()
+        shutil.rmtree(repl.host_dir, ignore_errors=True)
+
+    def _schedule_reap(self):
+        if self._idle_timeout is None:
+            return
+        if self._reap_task is None or self._reap_task.done():
+            self._reap_task = asyncio.ensure_future(self._reap_forever())
+
+    async def _reap_forever(self):
+        while self._leased:
+            await asyncio.sleep(self._reap_interval)
+            self.reap()
+
+    def _schedule_refill(self):
+        if len(self._idle) >= self._size:
+            return
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.ensure_future(self._refill())
+
+    async def _refill(self):
+        while len(self._idle) < self._size:
+            repl = None
+            try:
+                repl = await self._start_repl()
+                await repl.pause()
+            except Exception as e:
+                logger.error(f"Failed to start pooled REPL container of {self._image}. Error: {str(e)}",
+                             exc_info=True)
+                if repl is not None:
+                    self._discard(repl)
+                return
+            self._idle.append(repl)
@@ -0,0 +1,173 @@
+import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from ...utils import get_logger
+
+logger = get_logger()
+
+CONTAINER_DATASET_DIR = '/datasets'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class DatasetCache:
+    """
+    Content-addressed store of uploaded datasets shared by all sandbox sessions. Files are named after the sha256 of
+    their content, so a dataset uploaded by many sessions is stored once. A container only sees the datasets of its
+    own session, link puts hard links to them into a dir mounted read-only for that session.
+
+    The digests are indexed by the inode of the uploaded file with its size and mtime, not by its path. A file seen
+    before, under any of its paths, is not read again. An unknown file is still read in full to hash it, the cost of
+    an upload grows with its size until the copy of the session is linked to the store. put can replace that copy with
+    a hard link to the stored file, which frees its blocks, and stores an own copy by linking it instead of copying.
+    Another upload of the linked file hits the index.
+
+    With max_size, the least recently used datasets are removed once the store grows past it. Sessions keep their
+    links to a removed dataset, a later upload of it stores it again.
+
+    :param cache_dir: Host dir of the store, created on first write.
+    :param max_size: Bytes the store may hold, None for no limit. The dataset stored last is kept even when larger.
+    """
+
+    def __init__(self, cache_dir: str, max_size: Optional[int] = None):
+        self._cache_dir = os.path.abspath(cache_dir)
+        self._max_size = max_size
+        self._index: Dict[Tuple[int, int, int, int], str] = {}
+        self._lock = threading.Lock()
+        # Sizes of the stored datasets, least recently used first
+        self._sizes: OrderedDict = OrderedDict(_scan_store(self._cache_dir))
+        self._size = sum(self._sizes.values())
+
+    @property
+    def cache_dir(self) -> str:
+        return self._cache_dir
+
+    @property
+    def size(self) -> int:
+        """Bytes held by the store."""
+        return self._size
+
+    def put(self, file_path: str, link: bool = False) -> str:
+        """
+        Store the file unless its content is known already and return its digest. With link, the file is replaced
+        by a hard link to the stored copy afterwards. It turns read-only then, only pass it for files of our own.
+        """
+        file_path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            digest = self._index.get(key)
+            if digest is not None and digest in self._sizes:
+                self._sizes.move_to_end(digest)
+                return digest
+
+        digest = _file_digest(file_path)
+        path = self.host_path(digest)
+        linked = False
+        if not os.path.exists(path):
+            os.makedirs(self._cache_dir, exist_ok=True)
+            # Link or copy then rename, containers never see a partial file
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            linked = link and _try_link(file_path, tmp_path)
+            if not linked:
+                shutil.copyfile(file_path, tmp_path)
+            os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, path)
+            logger.info(f"Stored dataset {file_path} as {digest}")
+        # A replaced file is gone, its inode may come back for another one
+        linked = linked or (link and self._link(path, file_path))
+        stored = os.stat(path)
+        with self._lock:
+            if not linked:
+                self._index[key] = digest
+            self._index[(stored.st_dev, stored.st_ino, stored.st_size, stored.st_mtime_ns)] = digest
+            if digest not in self._sizes:
+                self._sizes[digest] = stored.st_size
+                self._size += stored.st_size
+            self._sizes.move_to_end(digest)
+            self._evict()
+        return digest
+
+    def link(self, digest: str, dst_dir: str) -> str:
+        """
+        Put the stored dataset into dst_dir, named after its digest, and return its path there. It is a hard link to
+        the store, or a copy across filesystems. Raises FileNotFoundError when the dataset was removed from the store.
+        """
+        dst_path = os.path.join(dst_dir, digest)
+        with self._lock:
+            if digest in self._sizes:
+                self._sizes.move_to_end(digest)
+        if os.path.exists(dst_path):
+            return dst_path
+        os.makedirs(dst_dir, exist_ok=True)
+        tmp_path = f'{dst_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        if not _try_link(self.host_path(digest), tmp_path):
+            shutil.copyfile(self.host_path(digest), tmp_path)
+        os.replace(tmp_path, dst_path)
+        return dst_path
+
+    def _evict(self):
+        """Remove the least recently used datasets until the store fits max_size, the caller holds the lock."""
+        if self._max_size is None:
+            return
+        while self._size > self._max_size and len(self._sizes) > 1:
+            digest, size = self._sizes.popitem(last=False)
+            self._size -= size
+            try:
+                os.unlink(self.host_path(digest))
+            except FileNotFoundError:
+                pass
+            # Files still linked to it must be hashed and stored again on their next upload
+            for key in [key for key, value in self._index.items() if value == digest]:
+                del self._index[key]
+            logger.info(f"Removed dataset {digest} from the store, it exceeds {self._max_size} bytes")
+
+    @staticmethod
+    def _link(path: str, file_path: str) -> bool:
+        """Replace file_path with a hard link to path, returns whether it was. Across filesystems the copy stays."""
+        tmp_path = f'{file_path}.{os.getpid()}.{threading.get_ident()}.link'
+        try:
+            os.link(path, tmp_path)
+            os.replace(tmp_path, file_path)
+            return True
+        except OSError as e:
+            logger.info(f"Kept the copy of dataset {file_path}, it cannot be linked to the store. Error: {str(e)}")
+            if os.path.lexists(tmp_path):
+                os.unlink(tmp_path)
+            return False
+
+    def host_path(self, digest: str) -> str:
+        return os.path.join(self._cache_dir, digest)
+
+    @staticmethod
+    def container_path(digest: str) -> str:
+        return f'{CONTAINER_DATASET_DIR}/{digest}'
+
+
+def _try_link(src_path: str, dst_path: str) -> bool:
+    try:
+        os.link(src_path, dst_path)
+        return True
+    except OSError:
+        return False
+
+
+def _scan_store(cache_dir: str):
+    """Digests and sizes of the datasets stored by earlier workers, oldest first."""
+    try:
+        entries = [entry for entry in os.scandir(cache_dir) if entry.is_file() and not entry.name.endswith('.tmp')]
+    except FileNotFoundError:
+        return []
+    stats = [(entry.name, entry.stat()) for entry in entries]
+    return [(name, stat.st_size) for name, stat in sorted(stats, key=lambda item: item[1].st_atime)]
+
+
+def _file_digest(file_path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
@@ -0,0 +1,69 @@
+import asyncio
+import functools
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+from ...exceptions.exceptions import InvalidConfigException
+from ...utils import get_logger
+
+logger = get_logger()
+
+try:
+    import docker
+except ImportError:
+    docker = None
+
+DEFAULT_MAX_WORKERS = 16
+
+
+class DockerBackend:
+    """
+    Docker client shared by the sandbox sessions of a worker. docker-py blocks, so its calls run on a bounded thread
+    pool sized like the HTTP connection pool of the client, a slow dockerd call stalls that call only instead of the
+    event loop, and calls of concurrent sessions overlap. Log streams last as long as their container, they get a
+    pool of their own so they never hold up the short calls.
+
+    :param max_workers: Number of docker calls in flight, and of connections to dockerd. Also the number of log
+        streams followed at once.
+    """
+
+    def __init__(self, max_workers: int = DEFAULT_MAX_WORKERS):
+        if max_workers < 1:
+            raise InvalidConfigException(f"Docker backend needs at least one worker, got {max_workers}")
+        self._client = docker.from_env(max_pool_size=max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='docker')
+        self._stream_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='docker-stream')
+
+    @property
+    def client(self):
+        return self._client
+
+    async def run(self, func: Callable, *args, **kwargs):
+        """Run a blocking docker call on the pool and return its result."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor,
+                                                                functools.partial(func, *args, **kwargs))
+
+    async def run_stream(self, func: Callable, *args, **kwargs):
+        """Run a blocking call consuming a docker stream, e.g. a followed log, on the stream pool."""
+        return await asyncio.get_running_loop().run_in_executor(self._stream_executor,
+                                                                functools.partial(func, *args, **kwargs))
+
+    def submit(self, func: Callable, *args, **kwargs) -> Future:
+        """Start a blocking docker call on the pool without waiting for it, failures are logged."""
+        future = self._executor.submit(func, *args, **kwargs)
+        future.add_done_callback(functools.partial(_log_failure, getattr(func, '__name__', repr(func))))
+        return future
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self._stream_executor.shutdown(wait=False)
+        self._client.close()
+
+
+def _log_failure(name: str, future: Future):
+    if future.cancelled() or future.exception() is None:
+        return
+    error = future.exception()
+    if isinstance(error, docker.errors.NotFound):
+        return
+    logger.warning(f"Docker call {name} failed. Error: {str(error)}")
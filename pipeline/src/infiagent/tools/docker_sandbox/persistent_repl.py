@@ -0,0 +1,227 @@
+import asyncio
+import os
+import shutil
+import tarfile
+import tempfile
+from typing import Dict, List, Optional
+
+from ...utils import get_logger
+from .dataset_cache import CONTAINER_DATASET_DIR
+from .docker_backend import DockerBackend
+from .repl_connection import ReplConnection
+
+logger = get_logger()
+
+try:
+    import docker
+except ImportError:
+    docker = None
+
+CONTAINER_WORK_DIR = '/workspace'
+# Inside the work dir, so the socket is reachable through the bind mount from both sides
+REPL_DIR_NAME = '.repl'
+REPL_SERVER_FILE = 'repl_server.py'
+REPL_SOCKET_FILE = 'repl.sock'
+# Inside the work dir as well and mounted where the legacy mode mounts uploaded files
+UPLOAD_DIR_NAME = '.upload_files'
+# Next to the host dir, a dir inside it would be writable through the /workspace mount
+DATASETS_DIR_SUFFIX = '.datasets'
+CONTAINER_UPLOAD_DIR = '/tmp/upload_files'
+DEFAULT_STARTUP_TIMEOUT = 30
+DEFAULT_IDLE_TIMEOUT = 1800
+# Archives of harvested files up to this size stay in memory on their way to the outputs
+MAX_SPOOLED_ARCHIVE_SIZE = 64 * 1024 * 1024
+
+
+class PersistentRepl(ReplConnection):
+    """
+    Long-lived container running a stateful interpreter for one sandbox session. Cells are sent over a unix socket
+    in the bind-mounted work dir, so each step runs only its own code instead of the whole script so far.
+
+    Unix sockets do not cross the VM boundary of Docker Desktop, this needs a Linux host.
+
+    The files changed by the cells are recorded from the replies, harvest moves those to the outputs. With tmpfs_size
+    set, /workspace is a tmpfs of that size instead of the host dir, only its .repl subdir is bind-mounted, and harvest
+    copies the changed files out of the container. Nothing but the final artifacts is written to disk then.
+
+    :param docker_backend: Docker client and the pool running its calls.
+    :param image: Image of the container, it needs python3 on the path.
+    :param host_dir: Host dir mounted at /workspace, the working dir of the code. Its .upload_files subdir is mounted
+        at /tmp/upload_files.
+    :param tmpfs_size: Size of a tmpfs working dir, in the docker format like 512m. None mounts host_dir.
+    :param mem_limit: Memory limit of the container.
+    :param volumes: Additional volumes, in the docker SDK format.
+    :param idle_timeout: Seconds without a cell after which the server exits and the container is removed. None keeps
+        it running until close. Time the container spends paused does not count.
+    :param datasets: Mount a dir of its own read-only at /datasets, for the datasets linked there by the session.
+        reset empties it and close removes it.
+    """
+
+    RESET_KEEP = [UPLOAD_DIR_NAME]
+
+    def __init__(self,
+                 docker_backend: DockerBackend,
+                 image: str,
+                 host_dir: str,
+                 mem_limit: Optional[str] = None,
+                 volumes: Optional[Dict] = None,
+                 idle_timeout: Optional[float] = DEFAULT_IDLE_TIMEOUT,
+                 tmpfs_size: Optional[str] = None,
+                 datasets: bool = False):
+        host_dir = os.path.abspath(host_dir)
+        super().__init__(os.path.join(host_dir, REPL_DIR_NAME, REPL_SOCKET_FILE))
+        self._docker = docker_backend
+        self._image = image
+        self._host_dir = host_dir
+        self._mem_limit = mem_limit
+        self._volumes = volumes or {}
+        self._idle_timeout = idle_timeout
+        self._tmpfs_size = tmpfs_size
+        self._datasets_dir = host_dir + DATASETS_DIR_SUFFIX if datasets else None
+        self._container = None
+
+    @property
+    def host_dir(self) -> str:
+        return self._host_dir
+
+    @property
+    def upload_dir(self) -> str:
+        return os.path.join(self._host_dir, UPLOAD_DIR_NAME)
+
+    @property
+    def datasets_dir(self) -> Optional[str]:
+        return self._datasets_dir
+
+    def is_running(self) -> bool:
+        return self._container is not None and super().is_running()
+
+    async def start(self, startup_timeout: float = DEFAULT_STARTUP_TIMEOUT):
+        repl_dir = os.path.join(self._host_dir, REPL_DIR_NAME)
+        os.makedirs(repl_dir, exist_ok=True)
+        os.makedirs(self.upload_dir, exist_ok=True)
+        dataset_volumes = {}
+        if self._datasets_dir is not None:
+            os.makedirs(self._datasets_dir, exist_ok=True)
+            dataset_volumes = {self._datasets_dir: {'bind': CONTAINER_DATASET_DIR, 'mode': 'ro'}}
+        shutil.copy(os.path.join(os.path.dirname(__file__), REPL_SERVER_FILE), repl_dir)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        container_repl_dir = f'{CONTAINER_WORK_DIR}/{REPL_DIR_NAME}'
+        if self._tmpfs_size:
+            # Docker mounts the tmpfs first, the bind mount of the REPL dir lands inside it
+            work_volumes = {repl_dir: {'bind': container_repl_dir, 'mode': 'rw'}}
+            tmpfs = {CONTAINER_WORK_DIR: f'size={self._tmpfs_size}'}
+        else:
+            work_volumes = {self._host_dir: {'bind': CONTAINER_WORK_DIR, 'mode': 'rw'}}
+            tmpfs = None
+        self._container = await self._docker.run(
+            self._docker.client.containers.run,
+            image=self._image,
+            command=['python3', f'{container_repl_dir}/{REPL_SERVER_FILE}', f'{container_repl_dir}/{REPL_SOCKET_FILE}',
+                     str(self._idle_timeout or 0)],
+            detach=True,
+            auto_remove=True,
+            working_dir=CONTAINER_WORK_DIR,
+            mem_limit=self._mem_limit,
+            volumes={**work_volumes,
+                     self.upload_dir: {'bind': CONTAINER_UPLOAD_DIR, 'mode': 'rw'},
+                     **dataset_volumes,
+                     **self._volumes},
+            tmpfs=tmpfs,
+        )
+
+        await self._connect(startup_timeout, self._container_alive)
+        logger.info(f"REPL container {self._container.short_id} ready for {self._host_dir}")
+
+    async def harvest(self, output_dir: str) -> List[str]:
+        """Move or copy the files changed by the cells to output_dir and return them, files deleted since are skipped."""
+        harvested = []
+        for path in self.changed_files:
+            dst_path = os.path.join(output_dir, path)
+            if self._tmpfs_size:
+                if self._container is None or not await self._docker.run(self._copy_from_container, path, dst_path):
+                    continue
+            else:
+                try:
+                    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+                    os.replace(os.path.join(self._host_dir, path), dst_path)
+                except FileNotFoundError:
+                    continue
+            harvested.append(path)
+        self._changed_files.clear()
+        return harvested
+
+    async def download(self, path: str, dst_path: str) -> bool:
+        """Copy a file from the working dir, path relative to it, returns False if there is no such file."""
+        if self._tmpfs_size:
+            return self._container is not None and await self._docker.run(self._copy_from_container, path, dst_path)
+        try:
+            shutil.copyfile(os.path.join(self._host_dir, path), dst_path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    async def interrupt(self) -> bool:
+        # The server is PID 1 of the container, it gets the signal as it installed a handler for it
+        if self._container is None:
+            return False
+        try:
+            await self._docker.run(self._container.kill, signal='SIGINT')
+        except docker.errors.APIError as e:
+            logger.warning(f"Failed to interrupt REPL container {self._container.id}. Error: {str(e)}")
+            return False
+        return True
+
+    async def reset(self, timeout: Optional[float] = None):
+        await super().reset(timeout)
+        if self._datasets_dir is not None:
+            await asyncio.to_thread(_empty_dir, self._datasets_dir)
+
+    async def pause(self):
+        await self._docker.run(self._container.pause)
+
+    async def unpause(self):
+        await self._docker.run(self._container.unpause)
+
+    def close(self):
+        """Disconnect and remove the container, the removal runs in the background."""
+        super().close()
+        if self._container is not None:
+            self._docker.submit(self._container.remove, force=True)
+        self._container = None
+        if self._datasets_dir is not None:
+            # Only links to the store, removing them is cheap
+            shutil.rmtree(self._datasets_dir, ignore_errors=True)
+
+    def _copy_from_container(self, path: str, dst_path: str) -> bool:
+        """Copy one regular file out of the working dir of the container, runs on the docker pool."""
+        try:
+            stream, _ = self._container.get_archive(f'{CONTAINER_WORK_DIR}/{path}')
+        except docker.errors.NotFound:
+            return False
+        with tempfile.SpooledTemporaryFile(max_size=MAX_SPOOLED_ARCHIVE_SIZE) as archive:
+            for chunk in stream:
+                archive.write(chunk)
+            archive.seek(0)
+            with tarfile.open(fileobj=archive) as tar:
+                # The archive of a path holds it under its base name, anything else is not ours to extract
+                member = tar.next()
+                if member is None or not member.isfile() or member.name != os.path.basename(path):
+                    return False
+                os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+                with tar.extractfile(member) as src, open(dst_path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+        return True
+
+    async def _container_alive(self) -> bool:
+        try:
+            await self._docker.run(self._container.reload)
+        except docker.errors.NotFound:
+            return False
+        return self._container.status in ('created', 'running')
+
+
+def _empty_dir(path: str):
+    for entry in os.scandir(path):
+        os.unlink(entry.path)
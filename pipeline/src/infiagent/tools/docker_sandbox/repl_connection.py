@@ -0,0 +1,179 @@
+import asyncio
+import json
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from ...exceptions.exceptions import InvalidConfigException, SandboxException
+
+# Replies are single JSON lines. The server bounds the output of a cell far below this, the limit is a safety net
+MAX_REPLY_SIZE = 64 * 1024 * 1024
+# sun_path is 108 bytes on Linux, including the terminating null, and the server binds to the path plus '.tmp' first
+MAX_SOCKET_PATH_LENGTH = 103
+# Seconds an interrupted cell gets to unwind before the server is removed
+INTERRUPT_GRACE = 5.0
+
+
+class CellInterrupted(asyncio.TimeoutError):
+    """
+    A cell ran past its timeout and was interrupted, the server and the session state survived.
+
+    :param output: What the cell printed before the interrupt, with the KeyboardInterrupt traceback.
+    """
+
+    def __init__(self, output: str):
+        super().__init__(output)
+        self.output = output
+
+
+class ReplConnection:
+    """
+    Client of repl_server.py over its unix socket. Subclasses start the server, in a container or as a local process,
+    and remove it on close. The files changed by the cells are recorded from the replies.
+
+    :param socket_path: Host path of the server socket.
+    """
+    # Dirs under the working dir that reset empties but leaves in place
+    RESET_KEEP: List[str] = []
+
+    def __init__(self, socket_path: str):
+        if len(socket_path.encode()) > MAX_SOCKET_PATH_LENGTH:
+            raise InvalidConfigException(f"REPL socket path {socket_path} is longer than {MAX_SOCKET_PATH_LENGTH} "
+                                         f"bytes, use a shorter work_dir")
+        self._socket_path = socket_path
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+        self._changed_files: Set[str] = set()
+        self._last_changed_files: List[str] = []
+        self._last_used = time.monotonic()
+
+    @property
+    def socket_path(self) -> str:
+        return self._socket_path
+
+    @property
+    def changed_files(self) -> List[str]:
+        """Files created or modified by the cells so far, relative to the working dir."""
+        return sorted(self._changed_files)
+
+    @property
+    def last_changed_files(self) -> List[str]:
+        """Files created or modified by the last cell, relative to the working dir."""
+        return self._last_changed_files
+
+    @property
+    def idle_time(self) -> float:
+        """Seconds since the last request was answered, 0 while one is running."""
+        if self._lock.locked():
+            return 0.0
+        return time.monotonic() - self._last_used
+
+    def record_changed_files(self, paths: List[str]):
+        """Add files changed by an earlier server in the same working dir."""
+        self._changed_files.update(paths)
+
+    def is_running(self) -> bool:
+        # A server exiting on its idle timeout closes the socket, which shows as EOF on our side
+        return self._writer is not None and not self._writer.is_closing() and not self._reader.at_eof()
+
+    async def execute(self, code: str, timeout: Optional[float] = None) -> Tuple[int, str]:
+        """
+        Run a cell and return its exit code and output. On timeout the cell is interrupted like with Ctrl-C and
+        CellInterrupted raised, the variables defined so far stay. A server not back within INTERRUPT_GRACE seconds,
+        e.g. stuck in native code, is removed together with the session state and asyncio.TimeoutError raised.
+        """
+        return await self._request({'code': code}, timeout)
+
+    async def reset(self, timeout: Optional[float] = None):
+        """Clear the interpreter namespace and the work dir, the server is ready for another session."""
+        await self._request({'reset': True, 'keep': self.RESET_KEEP}, timeout)
+        self._changed_files.clear()
+
+    async def ping(self, timeout: Optional[float] = None):
+        """Check that the server answers, this restarts its idle timer."""
+        await self._request({}, timeout)
+
+    async def interrupt(self) -> bool:
+        """Send SIGINT to the server, returns whether it was sent. Without a way to signal it, nothing is sent."""
+        return False
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader, self._writer = None, None
+
+    async def _connect(self, startup_timeout: float, server_alive: Callable[[], Awaitable[bool]]):
+        deadline = time.monotonic() + startup_timeout
+        while True:
+            try:
+                self._reader, self._writer = await asyncio.open_unix_connection(self._socket_path,
+                                                                                limit=MAX_REPLY_SIZE)
+                return
+            except (FileNotFoundError, ConnectionRefusedError):
+                pass
+            if time.monotonic() > deadline or not await server_alive():
+                self.close()
+                raise SandboxException(f"REPL server {self._socket_path} not ready after {startup_timeout} seconds")
+            await asyncio.sleep(0.05)
+
+    async def _request(self, request: Dict, timeout: Optional[float]) -> Tuple[int, str]:
+        async with self._lock:
+            try:
+                return await self._send(request, timeout)
+            finally:
+                self._last_used = time.monotonic()
+
+    async def _send(self, request: Dict, timeout: Optional[float]) -> Tuple[int, str]:
+        """One request and its reply, the caller holds the lock."""
+        if not self.is_running():
+            raise SandboxException("REPL server is not running")
+        self._writer.write((json.dumps(request) + '\n').encode('utf-8'))
+        try:
+            await self._writer.drain()
+            line = await asyncio.wait_for(self._reader.readline(), timeout=timeout)
+        except asyncio.TimeoutError:
+            line = await self._stop_cell() if 'code' in request else None
+            if not line:
+                self.close()
+                raise asyncio.TimeoutError()
+            _, output = self._read_reply(line)
+            raise CellInterrupted(output)
+        except asyncio.CancelledError:
+            # The caller is gone, e.g. a discarded speculative step. A cell left running would answer the next
+            # request, it is stopped and its reply read, or the server dropped
+            line = None
+            if 'code' in request:
+                try:
+                    line = await self._stop_cell()
+                except asyncio.CancelledError:
+                    line = None
+            if line:
+                self._read_reply(line)
+            else:
+                self.close()
+            raise
+        except (ConnectionError, ValueError) as e:
+            self.close()
+            raise SandboxException(f"Lost connection to the REPL server. Error: {str(e)}") from e
+        if not line:
+            # The server died, most likely killed by the memory limit
+            self.close()
+            raise SandboxException("REPL server exited while running the code, it may have exceeded its "
+                                   "memory limit")
+        return self._read_reply(line)
+
+    async def _stop_cell(self) -> Optional[bytes]:
+        """Interrupt the running cell and return its reply, None when the server could not be interrupted in time."""
+        if not await self.interrupt():
+            return None
+        # The reply of the interrupted cell is still to come, readline keeps what arrived so far
+        try:
+            return await asyncio.wait_for(self._reader.readline(), timeout=INTERRUPT_GRACE)
+        except (asyncio.TimeoutError, ConnectionError, ValueError):
+            return None
+
+    def _read_reply(self, line: bytes) -> Tuple[int, str]:
+        reply = json.loads(line)
+        self._last_changed_files = reply.get('changed', [])
+        self._changed_files.update(self._last_changed_files)
+        return reply['exit_code'], reply['output']
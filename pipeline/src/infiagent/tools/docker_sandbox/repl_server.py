@@ -0,0 +1,274 @@
+"""
+Stateful code runner of the persistent Docker sandbox. It runs inside the container and uses the standard library
+only, as the sandbox image brings nothing else we can rely on.
+
+Usage: python3 repl_server.py <socket path> <idle timeout seconds, 0 for none>
+
+Requests are JSON lines {"code": ...} on the unix socket. Every cell runs in the same namespace, like the next part
+of one growing script, and is answered with a JSON line {"exit_code": ..., "output": ..., "changed": [...]} holding
+stdout and stderr interleaved, bounded to its first OUTPUT_HEAD_SIZE and last OUTPUT_TAIL_SIZE characters, and the
+paths of the files the cell created or modified, relative to the working dir. Output is captured at the file
+descriptor level, so writes of C extensions and of child processes are part of it like for a script. {"reset": true, "keep": [...]} starts
+over with an empty namespace and an empty working dir, for the next session of a pooled container. The dirs named in
+keep are emptied but stay in place, as they may be mounted elsewhere. Any other request, like {}, is a ping answered
+with an empty reply. SIGINT interrupts the running cell like Ctrl-C, the cell fails with KeyboardInterrupt and the
+namespace stays. Between cells it is ignored. The server exits when no request arrives for the idle timeout, the time
+its container spends paused does not count.
+"""
+import codecs
+import io
+import json
+import os
+import select
+import shutil
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+MAX_SCAN_ENTRIES = 10000
+# Same bounds as the OutputCapture of the kernel sandbox, a cell printing gigabytes still gets a small reply
+OUTPUT_HEAD_SIZE = 8000
+OUTPUT_TAIL_SIZE = 2000
+# A wait outlasting the idle timeout by more than this was frozen by a paused container, it starts over
+PAUSE_SLACK = 5
+
+
+class CellState:
+    running = False
+
+
+def interrupt_cell(signum, frame):
+    # A SIGINT arriving after the cell, e.g. while its reply is sent, must not take down the server
+    if CellState.running:
+        raise KeyboardInterrupt
+
+
+class BoundedOutput(io.TextIOBase):
+    """Text stream keeping the head and the tail of what is written, like OutputCapture, which is not available here."""
+
+    def __init__(self, head_size=OUTPUT_HEAD_SIZE, tail_size=OUTPUT_TAIL_SIZE):
+        self._head_size = head_size
+        self._tail_size = tail_size
+        self._head = io.StringIO()
+        self._head_len = 0
+        self._tail = ''
+        self._total_size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self._total_size += len(text)
+        rest = text
+        if self._head_len < self._head_size:
+            kept = rest[:self._head_size - self._head_len]
+            self._head.write(kept)
+            self._head_len += len(kept)
+            rest = rest[len(kept):]
+        if rest and self._tail_size > 0:
+            self._tail = (self._tail + rest[-self._tail_size:])[-self._tail_size:]
+        return len(text)
+
+    def getvalue(self):
+        head = self._head.getvalue()
+        omitted = self._total_size - len(head) - len(self._tail)
+        if omitted <= 0:
+            return head + self._tail
+        return '%s\n...... [%d characters truncated] ......\n%s' % (head, omitted, self._tail)
+
+
+class FdCapture:
+    """Redirect file descriptors 1 and 2 onto a pipe while the cell runs, a thread drains it into output."""
+
+    def __init__(self, output):
+        self._output = output
+        self._read_fd = None
+        self._saved_fds = []
+        self._done = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self._read_fd, write_fd = os.pipe()
+        self._saved_fds = [os.dup(1), os.dup(2)]
+        os.dup2(write_fd, 1)
+        os.dup2(write_fd, 2)
+        os.close(write_fd)
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, saved_fd in zip([1, 2], self._saved_fds):
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+        self._done.set()
+        self._thread.join()
+        os.close(self._read_fd)
+        return False
+
+    def _drain(self):
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        while True:
+            # Once the cell is done, only what is already in the pipe is read. A background process of the cell may
+            # keep the write end open, it must not hold up the reply
+            done = self._done.is_set()
+            ready, _, _ = select.select([self._read_fd], [], [], 0 if done else 0.1)
+            if not ready:
+                if done:
+                    break
+                continue
+            data = os.read(self._read_fd, 65536)
+            if not data:
+                break
+            self._output.write(decoder.decode(data))
+        self._output.write(decoder.decode(b'', final=True))
+
+
+def run_cell(code, namespace, cell_index):
+    output = BoundedOutput()
+    exit_code = 0
+    with FdCapture(output):
+        try:
+            try:
+                CellState.running = True
+                exec(compile(code, '<cell %d>' % cell_index, 'exec'), namespace)
+            finally:
+                CellState.running = False
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                exit_code = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                exit_code = 1
+        except BaseException:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            # Skip the frame of this function, the traceback starts in the user code like for a script
+            traceback.print_exception(exc_type, exc_value, exc_traceback.tb_next)
+            exit_code = 1
+    return exit_code, output.getvalue()
+
+
+def scan_files(work_dir):
+    """Map the files under work_dir to (mtime_ns, inode, size), hidden files and dirs are skipped."""
+    files = {}
+    pending_dirs = [work_dir]
+    while pending_dirs and len(files) < MAX_SCAN_ENTRIES:
+        try:
+            entries = list(os.scandir(pending_dirs.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    pending_dirs.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    files[os.path.relpath(entry.path, work_dir)] = (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+            except OSError:
+                continue
+    return files
+
+
+def wait_readable(sock, idle_timeout):
+    """Wait until sock is readable, False once it stayed idle for idle_timeout seconds, None waits forever."""
+    while True:
+        started = time.monotonic()
+        ready, _, _ = select.select([sock], [], [], idle_timeout)
+        if ready:
+            return True
+        if time.monotonic() - started < idle_timeout + PAUSE_SLACK:
+            return False
+
+
+def new_namespace():
+    return {'__name__': '__main__', '__builtins__': __builtins__}
+
+
+def empty_dir(path, skip=()):
+    for name in os.listdir(path):
+        if name in skip:
+            continue
+        entry = os.path.join(path, name)
+        if os.path.isdir(entry) and not os.path.islink(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        else:
+            try:
+                os.unlink(entry)
+            except OSError:
+                pass
+
+
+def reset(namespace, work_dir, server_dir_name, keep):
+    namespace.clear()
+    namespace.update(new_namespace())
+    os.chdir(work_dir)
+    for name in keep:
+        if os.path.isdir(os.path.join(work_dir, name)):
+            empty_dir(os.path.join(work_dir, name))
+    empty_dir(work_dir, skip=[server_dir_name] + list(keep))
+
+
+def main(socket_path, idle_timeout):
+    namespace = new_namespace()
+    work_dir = os.getcwd()
+    # The dir of the socket and of this script
+    server_dir_name = os.path.basename(os.path.dirname(os.path.abspath(socket_path)))
+    idle_timeout = idle_timeout or None
+    signal.signal(signal.SIGINT, interrupt_cell)
+    # Flushed at each line, stdout and stderr share the pipe of the cell and must arrive in order
+    sys.stdout.reconfigure(line_buffering=True)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Bound and listening under a temp name first, the socket path only appears once it accepts connections
+    bind_path = socket_path + '.tmp'
+    if os.path.exists(bind_path):
+        os.unlink(bind_path)
+    server.bind(bind_path)
+    # The container user and the host user usually differ
+    os.chmod(bind_path, 0o666)
+    server.listen(1)
+    os.rename(bind_path, socket_path)
+
+    cell_index = 0
+    # Compared with the scan after each cell, the files found changed are reported with the reply
+    files = scan_files(work_dir)
+    while True:
+        if not wait_readable(server, idle_timeout):
+            return
+        conn, _ = server.accept()
+        with conn, conn.makefile('rb') as reader:
+            while True:
+                # Clients wait for the reply before the next request, nothing is left in the buffer of the reader
+                if not wait_readable(conn, idle_timeout):
+                    return
+                line = reader.readline()
+                if not line:
+                    break
+                request = json.loads(line)
+                changed = []
+                exit_code, output = 0, ''
+                if request.get('reset'):
+                    reset(namespace, work_dir, server_dir_name, request.get('keep', []))
+                    files = scan_files(work_dir)
+                elif 'code' in request:
+                    cell_index += 1
+                    exit_code, output = run_cell(request['code'], namespace, cell_index)
+                    files_after = scan_files(work_dir)
+                    changed = sorted(path for path, stat in files_after.items() if files.get(path) != stat)
+                    files = files_after
+                reply = {'exit_code': exit_code, 'output': output, 'changed': changed}
+                conn.sendall((json.dumps(reply) + '\n').encode('utf-8'))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], float(sys.argv[2]))
@@ -0,0 +1,175 @@
+import ast
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from ..exceptions.exceptions import InvalidConfigException
+from ..utils import get_logger
+
+logger = get_logger()
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_MAX_DISK_ENTRIES = 100000
+# Pruning lists the whole cache dir, it runs once per this many writes
+DISK_PRUNE_INTERVAL = 100
+
+# Calls known not to change their arguments or anything else, cells calling only these can be replayed. Builtins
+# iterating their argument (list, sorted, sum, min, ...) are left out, given an iterator they would exhaust it
+PURE_FUNCTIONS = {
+    'print', 'len', 'type', 'repr', 'str', 'int', 'float', 'bool', 'round', 'abs', 'isinstance', 'display',
+}
+PURE_METHODS = {
+    'head', 'tail', 'describe', 'info', 'nunique', 'unique', 'value_counts', 'isnull', 'isna', 'notnull', 'notna',
+    'count', 'sum', 'mean', 'median', 'std', 'var', 'min', 'max', 'quantile', 'corr', 'cov', 'skew', 'kurt',
+    'idxmin', 'idxmax', 'groupby', 'agg', 'keys', 'items', 'values', 'tolist', 'to_string', 'memory_usage',
+    'duplicated', 'any', 'all', 'round', 'sort_values', 'sort_index', 'nlargest', 'nsmallest', 'astype', 'format',
+}
+
+
+def is_side_effect_free(code: str) -> bool:
+    """
+    Whether the cell only inspects existing state: expression statements calling known read-only functions and
+    methods, without assignments, imports or in-place keywords. Anything that may advance an iterator, unpacking or
+    looping over a variable, counts as a side effect too.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return False
+    if not tree.body or not all(isinstance(statement, ast.Expr) for statement in tree.body):
+        return False
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.NamedExpr, ast.Lambda, ast.Await, ast.Yield, ast.YieldFrom, ast.Starred)):
+            return False
+        if isinstance(node, ast.comprehension) and not isinstance(node.iter, ast.Call):
+            return False
+        if isinstance(node, ast.Call):
+            if isinstance(node.func, ast.Name):
+                if node.func.id not in PURE_FUNCTIONS:
+                    return False
+            elif not isinstance(node.func, ast.Attribute) or node.func.attr not in PURE_METHODS:
+                return False
+            if any(keyword.arg == 'inplace' for keyword in node.keywords):
+                return False
+    return True
+
+
+def normalize_code(code: str) -> str:
+    """The code without comments and formatting, cells differing only in those share their cache entries."""
+    try:
+        return ast.unparse(ast.parse(code))
+    except SyntaxError:
+        return code.strip()
+
+
+def chain_digest(digest: str, content: str) -> str:
+    return hashlib.sha256(f'{digest}\n{content}'.encode('utf-8')).hexdigest()
+
+
+class ExecutionCache:
+    """
+    Outputs of side-effect-free cells, keyed by the normalized code, the uploaded files and the cells run before it
+    in the session. Entries live in an LRU in memory, and with a cache_dir as one JSON file each on disk, which
+    survives restarts and is shared by the workers of a host. Disk reads and writes run in worker threads, pruning
+    the disk tier in a background task.
+
+    :param max_entries: Entries kept in memory.
+    :param cache_dir: Dir of the disk tier, None for memory only.
+    :param max_disk_entries: Entries kept on disk, the least recently written go first.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, cache_dir: Optional[str] = None,
+                 max_disk_entries: int = DEFAULT_MAX_DISK_ENTRIES):
+        if max_entries < 1 or max_disk_entries < 1:
+            raise InvalidConfigException(f"Execution cache sizes must be >= 1, got {max_entries} in memory and "
+                                         f"{max_disk_entries} on disk")
+        self._max_entries = max_entries
+        self._cache_dir = cache_dir
+        self._max_disk_entries = max_disk_entries
+        self._entries: OrderedDict[str, Dict] = OrderedDict()
+        self._disk_writes = 0
+        self._prune_task: Optional[asyncio.Task] = None
+        self._hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def key(engine: str, code: str, input_digest: str, history_digest: str) -> str:
+        return hashlib.sha256(json.dumps([engine, normalize_code(code), input_digest, history_digest])
+                              .encode('utf-8')).hexdigest()
+
+    def metrics(self) -> Dict[str, int]:
+        return {'entries': len(self._entries), 'hits': self._hits, 'misses': self._misses}
+
+    async def get(self, key: str) -> Optional[Dict]:
+        entry = self._entries.get(key)
+        if entry is None and self._cache_dir is not None:
+            entry = await asyncio.to_thread(self._read, key)
+            if entry is not None:
+                self._remember(key, entry)
+        if entry is None:
+            self._misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self._hits += 1
+        return entry
+
+    async def put(self, key: str, entry: Dict):
+        self._remember(key, entry)
+        if self._cache_dir is None or not await asyncio.to_thread(self._write, key, entry):
+            return
+        self._disk_writes += 1
+        # Pruning lists the whole dir, it must not hold up the step, and one at a time is enough
+        if self._disk_writes % DISK_PRUNE_INTERVAL == 0 and (self._prune_task is None or self._prune_task.done()):
+            self._prune_task = asyncio.ensure_future(asyncio.to_thread(self._prune_disk))
+
+    def _remember(self, key: str, entry: Dict):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def _read(self, key: str) -> Optional[Dict]:
+        try:
+            with open(os.path.join(self._cache_dir, f'{key}.json')) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, key: str, entry: Dict) -> bool:
+        path = os.path.join(self._cache_dir, f'{key}.json')
+        try:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            # Write then rename, other workers never read a partial entry. Writer threads of a worker get their own
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w') as fp:
+                json.dump(entry, fp)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Failed to write execution cache entry {key}. Error: {str(e)}")
+            return False
+        return True
+
+    def _prune_disk(self):
+        entries = []
+        try:
+            it = os.scandir(self._cache_dir)
+        except OSError as e:
+            logger.warning(f"Failed to prune execution cache dir {self._cache_dir}. Error: {str(e)}")
+            return
+        with it:
+            for entry in it:
+                if entry.name.endswith('.json'):
+                    try:
+                        entries.append((entry.stat().st_mtime_ns, entry.path))
+                    except OSError:
+                        continue
+        entries.sort()
+        for _, path in entries[:max(len(entries) - self._max_disk_entries, 0)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,153 @@
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+from typing import Dict, Optional, Union
+
+from werkzeug.datastructures import FileStorage
+
+from .code_sandbox.python_code_sandbox import FILE_DIR, WORK_DIR, PythonSandBoxToolResponse, _Type
+from .docker_sandbox import repl_server
+from .docker_sandbox.persistent_repl import REPL_DIR_NAME, REPL_SOCKET_FILE
+from .docker_sandbox.repl_connection import CellInterrupted, ReplConnection
+from .sandbox_engine import SandboxCapability, SandboxEngine
+from ..schemas import MediaFile
+from ..utils import get_logger
+
+logger = get_logger()
+
+CONFIG_KEYS = ["time_out", "idle_timeout", "work_dir"]
+DEFAULT_STARTUP_TIMEOUT = 10
+DEFAULT_IDLE_TIMEOUT = 1800
+
+
+class LocalRepl(ReplConnection):
+    """
+    repl_server.py run as a plain subprocess of the agent, in its own process group so close takes down anything
+    the code started as well.
+
+    :param work_dir: Working dir of the code, the socket lives in its .repl subdir.
+    :param idle_timeout: Seconds without a cell after which the server exits, None for never.
+    """
+
+    def __init__(self, work_dir: str, idle_timeout: Optional[float] = DEFAULT_IDLE_TIMEOUT):
+        work_dir = os.path.abspath(work_dir)
+        super().__init__(os.path.join(work_dir, REPL_DIR_NAME, REPL_SOCKET_FILE))
+        self._work_dir = work_dir
+        self._idle_timeout = idle_timeout
+        self._process: Optional[subprocess.Popen] = None
+
+    def is_running(self) -> bool:
+        return self._process is not None and self._process.poll() is None and super().is_running()
+
+    async def start(self, startup_timeout: float = DEFAULT_STARTUP_TIMEOUT):
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        self._process = subprocess.Popen([sys.executable, repl_server.__file__, self.socket_path,
+                                          str(self._idle_timeout or 0)],
+                                         cwd=self._work_dir, stdin=subprocess.DEVNULL, start_new_session=True)
+        await self._connect(startup_timeout, self._process_alive)
+
+    async def interrupt(self) -> bool:
+        # To the whole process group like Ctrl-C, subprocesses started by the cell stop as well
+        if self._process is None or self._process.poll() is not None:
+            return False
+        try:
+            os.killpg(self._process.pid, signal.SIGINT)
+        except ProcessLookupError:
+            return False
+        return True
+
+    def close(self):
+        super().close()
+        if self._process is not None:
+            try:
+                os.killpg(self._process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            process = self._process
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                process.wait()
+            else:
+                # Reaped in a worker thread, the event loop does not wait for the exit
+                asyncio.ensure_future(asyncio.to_thread(process.wait))
+        self._process = None
+
+    async def _process_alive(self) -> bool:
+        return self._process.poll() is None
+
+
+class LocalSandboxTool(SandboxEngine):
+    """
+    Runs the code in a Python subprocess per session on the agent host, for trusted eval runs where kernel or
+    container startup dominates the cost of a step. There is no isolation and no resource limit. Variables persist
+    between steps, the process speaks the REPL protocol of the persistent Docker sandbox.
+    """
+    capabilities = SandboxCapability.STATEFUL | SandboxCapability.FILE_OUTPUTS
+
+    def __init__(self,
+                 name: Optional[str] = "Local Sandbox",
+                 description: Optional[str] = "tool for code_exec",
+                 time_out: Optional[float] = 120,
+                 idle_timeout: Optional[float] = DEFAULT_IDLE_TIMEOUT,
+                 work_dir: Optional[str] = WORK_DIR,
+                 **kwargs):
+        super().__init__(name, description, **kwargs)
+        self._time_out = time_out
+        self._idle_timeout = idle_timeout
+        self._work_dir = work_dir
+        self._repl: Optional[LocalRepl] = None
+
+    @classmethod
+    async def create(cls, config_data, **params):
+        tool_config = {key: config_data[key] for key in CONFIG_KEYS if key in config_data}
+        cls.configure_execution_cache(config_data)
+        return cls(name=config_data['name'], description=config_data['description'], **tool_config, **params)
+
+    def _session_dir(self) -> str:
+        return os.path.join(self._work_dir, self.sandbox_id)
+
+    async def start(self):
+        if self._repl is not None and self._repl.is_running():
+            return
+        if self._repl is not None:
+            # Exited on its idle timeout or died, the next step runs in a fresh interpreter
+            logger.info(f"REPL of sandbox {self.sandbox_id} is gone, starting a new one")
+            self._repl.close()
+        session_dir = self._session_dir()
+        os.makedirs(session_dir, exist_ok=True)
+        self._repl = LocalRepl(session_dir, idle_timeout=self._idle_timeout)
+        await self._repl.start()
+
+    async def async_run(self, req: str) -> PythonSandBoxToolResponse:
+        code = self.extract_code(req)
+        await self.start()
+        try:
+            exit_code, output = await self._repl.execute(code, timeout=self._time_out)
+        except CellInterrupted as e:
+            logger.warning(f"Code of sandbox {self.sandbox_id} timed out after {self._time_out} seconds and was "
+                           f"interrupted")
+            return PythonSandBoxToolResponse(f"{e.output}\nTimeout: Code execution exceeded the time limit of "
+                                             f"{self._time_out} seconds and was interrupted, the variables defined "
+                                             f"before are kept", _Type.FAIL)
+        except asyncio.TimeoutError:
+            logger.warning(f"Code of sandbox {self.sandbox_id} timed out after {self._time_out} seconds, the REPL "
+                           f"process was killed")
+            return PythonSandBoxToolResponse(f"Code execution timed out after {self._time_out} seconds, the "
+                                             f"variables of the session are lost", _Type.FAIL)
+        session_dir = self._session_dir()
+        output_files = [MediaFile(file_name=os.path.basename(path), sandbox_path=os.path.join(session_dir, path))
+                        for path in self._repl.last_changed_files]
+        return PythonSandBoxToolResponse(output, _Type.SUCCESS if exit_code == 0 else _Type.ERROR,
+                                         output_files=output_files)
+
+    async def sync_to_sandbox(self, file: Union[str, Dict, FileStorage]) -> str:
+        # Same layout as the kernel sandbox, the uploads of a session are in its upload dir already
+        return os.path.join(FILE_DIR, self.sandbox_id, file.split('/')[-1])
+
+    async def close(self):
+        if self._repl is not None:
+            self._repl.close()
+        self._repl = None
@@ -0,0 +1,182 @@
+import asyncio
+import hashlib
+import os
+import re
+import shutil
+from abc import ABC, abstractmethod
+from enum import Flag, auto
+from typing import AsyncGenerator, Dict, List, Optional, Union
+
+from werkzeug.datastructures import FileStorage
+
+from .base_tool import BaseTool
+from .execution_cache import (DEFAULT_MAX_DISK_ENTRIES, DEFAULT_MAX_ENTRIES, ExecutionCache, chain_digest,
+                              is_side_effect_free, normalize_code)
+from ..schemas import MediaFile
+from ..utils import get_logger, resolve_root_path
+
+logger = get_logger()
+
+# Code blocks of a request, fenced with or without the python tag
+CODE_BLOCK_PATTERN = re.compile(r'```(?:python)?\s*(.*?)\s*```', re.DOTALL)
+
+
+class SandboxCapability(Flag):
+    NONE = 0
+    # async_stream yields the output while the code runs, not only once it finished
+    STREAMING = auto()
+    # Variables defined by a step are visible to the next one
+    STATEFUL = auto()
+    # snapshot saves the variables so the session survives a restart of its interpreter
+    SNAPSHOT = auto()
+    # Responses list the files the code wrote
+    FILE_OUTPUTS = auto()
+    # The code runs in a container, apart from the host running the agent
+    ISOLATED = auto()
+
+
+class SandboxResponse(ABC):
+    """Result of one step run by a sandbox engine."""
+
+    @property
+    @abstractmethod
+    def output_text(self) -> str:
+        """The output as shown to the model."""
+
+    @property
+    @abstractmethod
+    def succeeded(self) -> bool:
+        """The code ran to the end without raising."""
+
+    @property
+    def output_files(self) -> List[MediaFile]:
+        return []
+
+
+class CachedSandboxResponse(SandboxResponse):
+    """The output of an earlier run of the same cell, replayed from the execution cache."""
+
+    def __init__(self, output_text: str, succeeded: bool):
+        self._output_text = output_text
+        self._succeeded = succeeded
+
+    @property
+    def output_text(self) -> str:
+        return self._output_text
+
+    @property
+    def succeeded(self) -> bool:
+        return self._succeeded
+
+
+class SandboxEngine(BaseTool):
+    """
+    Common interface of the code sandboxes the agent runs its actions in. A sandbox serves one session, named by its
+    sandbox id, from start until close. capabilities tells callers what to expect beyond running code, the defaults
+    here cover engines without the matching capability.
+
+    Callers go through upload and run_step, which put the opt-in execution cache in front of the engine. A
+    side-effect-free cell run before with the same uploads and the same cells before it is answered from the cache
+    without reaching the interpreter.
+    """
+    capabilities: SandboxCapability = SandboxCapability.NONE
+    _EXECUTION_CACHE: Optional[ExecutionCache] = None
+
+    def __init__(self, name, description, **kwargs):
+        super().__init__(name, description, **kwargs)
+        self._sandbox_id = None
+        # Digests of the uploaded files and of the cells run so far, both part of the execution cache key
+        self._input_digest = ''
+        self._history_digest = ''
+
+    @classmethod
+    def configure_execution_cache(cls, config_data: Dict):
+        """Enable the execution cache shared by all sandboxes of the worker from the execution_cache tool config."""
+        cache_config = config_data.get('execution_cache') or {}
+        if not cache_config.get('enabled', False) or SandboxEngine._EXECUTION_CACHE is not None:
+            return
+        SandboxEngine._EXECUTION_CACHE = ExecutionCache(
+            max_entries=cache_config.get('max_entries', DEFAULT_MAX_ENTRIES),
+            cache_dir=resolve_root_path(cache_config.get('cache_dir')),
+            max_disk_entries=cache_config.get('max_disk_entries', DEFAULT_MAX_DISK_ENTRIES))
+
+    async def set_sandbox_id(self, sandbox_id):
+        self._sandbox_id = sandbox_id
+
+    @property
+    def sandbox_id(self):
+        """Getter for sandbox_id."""
+        return self._sandbox_id
+
+    @staticmethod
+    def extract_code(req: str) -> str:
+        """The code of the fenced blocks of a request, joined into one cell."""
+        return '\n'.join(CODE_BLOCK_PATTERN.findall(req)).strip()
+
+    def supports(self, capability: SandboxCapability) -> bool:
+        return capability in self.capabilities
+
+    async def start(self):
+        """Get the interpreter of the session ready ahead of its first step, engines start it lazily otherwise."""
+
+    @abstractmethod
+    async def async_run(self, req: str) -> SandboxResponse:
+        """Run the code blocks of req."""
+
+    async def async_stream(self, req: str) -> AsyncGenerator[Union[str, SandboxResponse], None]:
+        """Run the code like async_run, yield output text as it is produced and the response last."""
+        yield await self.async_run(req)
+
+    @abstractmethod
+    async def sync_to_sandbox(self, file: Union[str, Dict, FileStorage]) -> str:
+        """Make an uploaded file available to the code, returns the path to show the model."""
+
+    async def upload(self, file: Union[str, Dict, FileStorage]) -> str:
+        """sync_to_sandbox, recording the content of the file for the execution cache."""
+        path = await self.sync_to_sandbox(file)
+        if SandboxEngine._EXECUTION_CACHE is not None and isinstance(file, str) and os.path.isfile(file):
+            self._input_digest = chain_digest(self._input_digest, await asyncio.to_thread(_file_digest, file))
+        return path
+
+    async def run_step(self, req: str) -> AsyncGenerator[Union[str, SandboxResponse], None]:
+        """async_stream behind the execution cache."""
+        code = self.extract_code(req)
+        cache = SandboxEngine._EXECUTION_CACHE
+        key = None
+        if cache is not None and is_side_effect_free(code):
+            key = cache.key(type(self).__name__, code, self._input_digest, self._history_digest)
+            entry = await cache.get(key)
+            if entry is not None:
+                logger.info(f"Replayed cell of sandbox {self.sandbox_id} from the execution cache")
+                # The cell counts as run, later keys are the same whether or not it was replayed
+                self._history_digest = chain_digest(self._history_digest, normalize_code(code))
+                yield CachedSandboxResponse(entry['output_text'], entry['succeeded'])
+                return
+
+        response = None
+        async for chunk in self.async_stream(req):
+            if isinstance(chunk, SandboxResponse):
+                response = chunk
+            yield chunk
+        if key is not None and response is not None and response.succeeded and not response.output_files:
+            await cache.put(key, {'output_text': response.output_text, 'succeeded': True})
+        self._history_digest = chain_digest(self._history_digest, normalize_code(code))
+
+    async def download(self, sandbox_path: str, dst_path: str):
+        """Copy a file the code wrote to dst_path. Sandboxes sharing the host filesystem have nothing to translate."""
+        await asyncio.to_thread(shutil.copyfile, sandbox_path, dst_path)
+
+    async def snapshot(self) -> bool:
+        """Save the variables of the session, returns whether a snapshot was written."""
+        return False
+
+    async def close(self):
+        """End the session and release its interpreter."""
+
+
+def _file_digest(file_path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
@@ -153,4 +153,10 @@ def convert_delimiter_to_comma(content_stream: io.BytesIO) -> (io.BytesIO, bool)
 def get_file_name_and_path(input_file: str):
     file_name = input_file.split("/")[-1]
     tos_path = input_file.replace(file_name, "")
-    return file_name, tos_path
\ No newline at end of file
+    return file_name, tos_path
+
+def resolve_root_path(path):
+    """Absolute form of a path from the configs, relative paths are taken from the package root like the tmp dirs."""
+    if path is None:
+        return None
+    return os.path.normpath(os.path.join(root_directory, path))
@@ -0,0 +1,27 @@
+import base64
+import os
+
+from infiagent.tools.code_sandbox.artifact_store import ArtifactStore, changed_files, scan_files
+
+
+def test_display_data_is_stored_once(tmp_path):
+    store = ArtifactStore(str(tmp_path / ".outputs"))
+    png = base64.b64encode(b"fake png").decode()
+    first = store.put_display_data({"image/png": png, "text/plain": "<Figure>"})
+    second = store.put_display_data({"image/png": png})
+    assert first == second
+    assert first[0].endswith(".png")
+    assert len(os.listdir(store.store_dir)) == 1
+    assert store.put_display_data({"text/plain": "1"}) == []
+
+
+def test_changed_files_skips_hidden(tmp_path):
+    (tmp_path / "kept.csv").write_text("a")
+    before = scan_files(str(tmp_path))
+    (tmp_path / "new.csv").write_text("b")
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "nested.txt").write_text("c")
+    (tmp_path / ".outputs").mkdir()
+    (tmp_path / ".outputs" / "image.png").write_text("d")
+    after = scan_files(str(tmp_path))
+    assert changed_files(before, after) == sorted([str(tmp_path / "new.csv"), str(tmp_path / "sub" / "nested.txt")])
@@ -0,0 +1,36 @@
+import infiagent.utils  # noqa: F401
+import infiagent.tools  # noqa: F401
+from infiagent.agent.react.completion_stream import CompletionStopDetector
+
+
+def _feed(chunks):
+    detector = CompletionStopDetector(["Observation:"])
+    for i, chunk in enumerate(chunks):
+        if detector.feed(chunk):
+            return detector.text, i
+    return detector.text, None
+
+
+def test_stops_at_the_close_of_the_action_input():
+    completion = "Thought: look\nAction: python_code_sandbox\nAction Input:\n```python\nprint(1)\n```\nObservation: 1\n"
+    text, stopped_at = _feed([completion[i:i + 3] for i in range(0, len(completion), 3)])
+    assert text == "Thought: look\nAction: python_code_sandbox\nAction Input:\n```python\nprint(1)\n```"
+    assert stopped_at < len(completion) // 3
+
+
+def test_stops_before_a_stop_word_split_across_chunks():
+    text, stopped_at = _feed(["Thought: done\nObser", "vation: made up", " and more"])
+    assert (text, stopped_at) == ("Thought: done", 1)
+
+
+def test_final_answer_runs_to_the_end():
+    text, stopped_at = _feed(["Thought: I know\n", "Final Answer: 42"])
+    assert (text, stopped_at) == ("Thought: I know\nFinal Answer: 42", None)
+
+
+def test_several_actions_run_to_the_stop_word():
+    detector = CompletionStopDetector(["Observation:"], stop_at_code_end=False)
+    steps = ["Action: a\nAction Input:\n```python\nx = 1\n```\n",
+             "Then Action: a\nAction Input:\n```python\nprint(x)\n```\n", "Observation: 1"]
+    assert [detector.feed(step) for step in steps] == [False, False, True]
+    assert detector.text == "".join(steps[:2]).rstrip()
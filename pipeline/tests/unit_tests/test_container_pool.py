@@ -0,0 +1,39 @@
+from unittest.mock import MagicMock
+
+from infiagent.tools.docker_sandbox.container_pool import ContainerPool
+
+
+def _repl(idle_time, running=True):
+    repl = MagicMock()
+    repl.idle_time = idle_time
+    repl.is_running.return_value = running
+    repl.host_dir = "/nonexistent/slot"
+    return repl
+
+
+def test_reap_removes_leased_containers_past_their_idle_timeout():
+    pool = ContainerPool(MagicMock(), "image", "/nonexistent", idle_timeout=60)
+    active, abandoned, dead = _repl(5), _repl(120), _repl(0, running=False)
+    pool._leased.update([active, abandoned, dead])
+    assert pool.reap() == 2
+    assert pool.leased_count == 1
+    active.close.assert_not_called()
+    abandoned.close.assert_called_once()
+    dead.close.assert_called_once()
+
+
+def test_reap_without_idle_timeout_keeps_everything():
+    pool = ContainerPool(MagicMock(), "image", "/nonexistent", idle_timeout=None)
+    pool._leased.add(_repl(10 ** 6))
+    assert pool.reap() == 0
+    assert pool.leased_count == 1
+
+
+def test_released_container_is_no_longer_leased():
+    pool = ContainerPool(MagicMock(), "image", "/nonexistent", idle_timeout=60)
+    repl = _repl(120)
+    pool._leased.add(repl)
+    pool.release(repl)
+    assert pool.leased_count == 0
+    assert pool.reap() == 0
+    repl.close.assert_called_once()
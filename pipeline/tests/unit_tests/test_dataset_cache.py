@@ -0,0 +1,79 @@
+import os
+
+from infiagent.tools.docker_sandbox import DatasetCache
+
+
+def test_identical_datasets_are_stored_once(tmp_path):
+    cache = DatasetCache(str(tmp_path / "cache"))
+    for name in ("a.csv", "b.csv"):
+        (tmp_path / name).write_text("x,y\n1,2\n")
+    digest = cache.put(str(tmp_path / "a.csv"))
+    assert cache.put(str(tmp_path / "b.csv")) == digest
+    assert os.listdir(cache.cache_dir) == [digest]
+    assert open(cache.host_path(digest)).read() == "x,y\n1,2\n"
+    assert cache.container_path(digest) == f"/datasets/{digest}"
+
+
+def test_known_file_is_not_hashed_again(tmp_path, monkeypatch):
+    cache = DatasetCache(str(tmp_path / "cache"))
+    (tmp_path / "a.csv").write_text("x\n")
+    digest = cache.put(str(tmp_path / "a.csv"))
+    monkeypatch.setattr("infiagent.tools.docker_sandbox.dataset_cache._file_digest", None)
+    assert cache.put(str(tmp_path / "a.csv")) == digest
+
+
+def test_session_copy_is_replaced_by_a_link(tmp_path, monkeypatch):
+    cache = DatasetCache(str(tmp_path / "cache"))
+    for session in ("s1", "s2"):
+        (tmp_path / session).mkdir()
+        (tmp_path / session / "a.csv").write_text("x\n")
+    digest = cache.put(str(tmp_path / "s1" / "a.csv"), link=True)
+    assert os.path.samefile(tmp_path / "s1" / "a.csv", cache.host_path(digest))
+    assert cache.put(str(tmp_path / "s2" / "a.csv"), link=True) == digest
+    assert os.stat(cache.host_path(digest)).st_nlink == 3
+    # Any path of the stored dataset is known without reading it
+    monkeypatch.setattr("infiagent.tools.docker_sandbox.dataset_cache._file_digest", None)
+    assert cache.put(str(tmp_path / "s2" / "a.csv")) == digest
+
+
+def test_own_copy_is_stored_without_copying(tmp_path):
+    cache = DatasetCache(str(tmp_path / "cache"))
+    (tmp_path / "a.csv").write_text("x\n")
+    digest = cache.put(str(tmp_path / "a.csv"), link=True)
+    assert os.path.samefile(tmp_path / "a.csv", cache.host_path(digest))
+    assert os.stat(cache.host_path(digest)).st_nlink == 2
+
+
+def test_link_puts_only_the_given_dataset_into_the_dir(tmp_path):
+    cache = DatasetCache(str(tmp_path / "cache"))
+    (tmp_path / "a.csv").write_text("x\n")
+    (tmp_path / "b.csv").write_text("y\n")
+    digest = cache.put(str(tmp_path / "a.csv"))
+    cache.put(str(tmp_path / "b.csv"))
+    path = cache.link(digest, str(tmp_path / "session.datasets"))
+    assert os.listdir(tmp_path / "session.datasets") == [digest]
+    assert os.path.samefile(path, cache.host_path(digest))
+    assert cache.link(digest, str(tmp_path / "session.datasets")) == path
+
+
+def test_least_recently_used_datasets_are_removed(tmp_path, monkeypatch):
+    cache = DatasetCache(str(tmp_path / "cache"), max_size=25)
+    digests = {}
+    for name in ("a", "b", "c"):
+        (tmp_path / name).write_text(name * 10)
+        digests[name] = cache.put(str(tmp_path / name))
+        if name == "b":
+            # a is used again, b is the oldest now
+            cache.put(str(tmp_path / "a"))
+    assert sorted(os.listdir(cache.cache_dir)) == sorted([digests["a"], digests["c"]])
+    assert cache.size == 20
+    # The removed dataset is stored again on its next upload
+    assert cache.put(str(tmp_path / "b")) == digests["b"]
+    assert os.path.exists(cache.host_path(digests["b"]))
+
+
+def test_store_of_an_earlier_worker_counts_towards_the_limit(tmp_path):
+    cache = DatasetCache(str(tmp_path / "cache"))
+    (tmp_path / "a.csv").write_text("x" * 10)
+    cache.put(str(tmp_path / "a.csv"))
+    assert DatasetCache(str(tmp_path / "cache"), max_size=100).size == 10
@@ -0,0 +1,111 @@
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from infiagent.tools.docker_sandbox import repl_server
+
+
+@pytest.fixture
+def repl(tmp_path):
+    (tmp_path / ".repl").mkdir()
+    socket_path = str(tmp_path / ".repl" / "repl.sock")
+    process = subprocess.Popen([sys.executable, repl_server.__file__, socket_path, "30"], cwd=str(tmp_path))
+    deadline = time.monotonic() + 10
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    while True:
+        try:
+            conn.connect(socket_path)
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+    reader = conn.makefile("rb")
+
+    def request(payload):
+        conn.sendall((json.dumps(payload) + "\n").encode())
+        reply = json.loads(reader.readline())
+        execute.changed = reply["changed"]
+        return reply["exit_code"], reply["output"]
+
+    def execute(code):
+        return request({"code": code})
+
+    execute.request = request
+    execute.process = process
+    yield execute
+    reader.close()
+    conn.close()
+    process.kill()
+    process.wait()
+
+
+def test_state_is_kept_between_cells(repl):
+    assert repl("x = 20\nprint('set')") == (0, "set\n")
+    assert repl("print(x + 1)") == (0, "21\n")
+
+
+def test_errors_and_exit(repl):
+    exit_code, output = repl("1 / 0")
+    assert exit_code == 1
+    assert "ZeroDivisionError" in output
+    assert "run_cell" not in output
+    assert repl("import sys\nsys.exit(3)") == (3, "")
+    assert repl("print('still alive')") == (0, "still alive\n")
+
+
+def test_reset_clears_namespace_and_work_dir(repl, tmp_path):
+    (tmp_path / ".upload_files").mkdir()
+    repl("x = 1\nopen('out.csv', 'w').write('a')\nopen('.upload_files/data.csv', 'w').write('b')")
+    assert repl.request({"reset": True, "keep": [".upload_files"]}) == (0, "")
+    assert repl("print('x' in dir())") == (0, "False\n")
+    assert sorted(os.listdir(tmp_path)) == [".repl", ".upload_files"]
+    assert os.listdir(tmp_path / ".upload_files") == []
+
+
+def test_empty_request_is_a_ping(repl):
+    repl("x = 1")
+    assert repl.request({}) == (0, "")
+    assert repl("print(x)") == (0, "1\n")
+
+
+def test_changed_files_are_reported(repl):
+    repl("import os\nos.makedirs('plots')\nopen('plots/a.png', 'w').write('a')\nopen('b.csv', 'w').write('b')")
+    assert repl.changed == ["b.csv", os.path.join("plots", "a.png")]
+    repl("open('b.csv', 'a').write('c')")
+    assert repl.changed == ["b.csv"]
+    repl("print(1)")
+    assert repl.changed == []
+
+
+def test_sigint_interrupts_the_cell_only(repl):
+    repl("x = 1")
+    # Between cells it is ignored
+    repl.process.send_signal(signal.SIGINT)
+    interrupt = threading.Timer(0.5, repl.process.send_signal, [signal.SIGINT])
+    interrupt.start()
+    exit_code, output = repl("import time\ntime.sleep(10)")
+    assert exit_code == 1
+    assert "KeyboardInterrupt" in output
+    assert repl("print(x)") == (0, "1\n")
+
+
+def test_large_output_is_truncated(repl):
+    exit_code, output = repl("print('a' * 10000000)\nprint('end')")
+    assert exit_code == 0
+    assert len(output) < repl_server.OUTPUT_HEAD_SIZE + repl_server.OUTPUT_TAIL_SIZE + 100
+    assert "characters truncated" in output and output.endswith("end\n")
+
+
+def test_output_of_native_code_and_child_processes_is_captured(repl):
+    code = "import os, subprocess, sys\nprint('a')\nos.write(1, b'b\\n')\n" \
+           "subprocess.run([sys.executable, '-c', 'print(1)'])\nprint('c', file=sys.stderr)"
+    assert repl(code) == (0, "a\nb\n1\nc\n")
+    assert repl("print('d')") == (0, "d\n")
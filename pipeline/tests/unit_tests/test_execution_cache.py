@@ -0,0 +1,89 @@
+import asyncio
+import os
+
+from infiagent.tools import CachedSandboxResponse, ExecutionCache, SandboxEngine, SandboxResponse
+from infiagent.tools.execution_cache import is_side_effect_free
+
+
+class _Response(SandboxResponse):
+    def __init__(self, output_text):
+        self._output_text = output_text
+
+    @property
+    def output_text(self):
+        return self._output_text
+
+    @property
+    def succeeded(self):
+        return True
+
+
+def test_only_read_only_cells_are_side_effect_free():
+    assert is_side_effect_free("df.head()")
+    assert is_side_effect_free("print(df.describe())  # look at it")
+    assert not is_side_effect_free("x = df.head()")
+    assert not is_side_effect_free("df.sort_values('a', inplace=True)")
+    assert not is_side_effect_free("df.to_csv('out.csv')")
+    assert not is_side_effect_free("import os")
+
+
+def test_lru_evicts_and_disk_tier_survives(tmp_path):
+    async def main():
+        cache = ExecutionCache(max_entries=1, cache_dir=str(tmp_path))
+        first = ExecutionCache.key("engine", "df.head()", "", "")
+        second = ExecutionCache.key("engine", "df.tail()", "", "")
+        await cache.put(first, {"output_text": "1"})
+        await cache.put(second, {"output_text": "2"})
+        assert cache.metrics()["entries"] == 1
+        assert await ExecutionCache(cache_dir=str(tmp_path)).get(first) == {"output_text": "1"}
+
+    asyncio.run(main())
+
+
+def test_key_ignores_formatting_but_not_history():
+    assert ExecutionCache.key("e", "df.head( )  # peek", "", "") == ExecutionCache.key("e", "df.head()", "", "")
+    assert ExecutionCache.key("e", "df.head()", "", "a") != ExecutionCache.key("e", "df.head()", "", "b")
+
+
+def test_repeated_cell_is_replayed(monkeypatch):
+    monkeypatch.setattr(SandboxEngine, "_EXECUTION_CACHE", ExecutionCache())
+    runs = []
+
+    class _Engine(SandboxEngine):
+        async def async_run(self, req):
+            runs.append(req)
+            return _Response(f"run {len(runs)}")
+
+        async def sync_to_sandbox(self, file):
+            return file
+
+    async def run(engine, req):
+        return [chunk async for chunk in engine.run_step(req)][-1]
+
+    async def main():
+        engine, other = _Engine("engine", ""), _Engine("engine", "")
+        assert (await run(engine, "```python\ndf.head()\n```")).output_text == "run 1"
+        replayed = await run(other, "```python\ndf.head()\n```")
+        assert isinstance(replayed, CachedSandboxResponse) and replayed.output_text == "run 1"
+        await run(engine, "```python\ndf = df.dropna()\n```")
+        assert (await run(engine, "```python\ndf.head()\n```")).output_text == "run 3"
+        # A replayed cell advances the history like a run one, the session that replayed finds the same entries
+        await run(other, "```python\ndf = df.dropna()\n```")
+        replayed = await run(other, "```python\ndf.head()\n```")
+        assert isinstance(replayed, CachedSandboxResponse) and replayed.output_text == "run 3"
+
+    asyncio.run(main())
+    assert len(runs) == 4
+
+
+def test_cells_that_may_exhaust_an_iterator_are_not_side_effect_free():
+    assert not is_side_effect_free("list(rows)")
+    assert not is_side_effect_free("print(*rows)")
+    assert not is_side_effect_free("[row for row in rows]")
+    assert is_side_effect_free("[column for column in df.keys()]")
+
+
+def test_relative_cache_dir_does_not_depend_on_the_working_dir(monkeypatch):
+    monkeypatch.setattr(SandboxEngine, "_EXECUTION_CACHE", None)
+    SandboxEngine.configure_execution_cache({"execution_cache": {"enabled": True, "cache_dir": "tmp/execution_cache"}})
+    assert os.path.isabs(SandboxEngine._EXECUTION_CACHE._cache_dir)
@@ -0,0 +1,40 @@
+# utils first, importing infiagent.prompt or infiagent.schemas on its own runs into their import cycle
+import infiagent.utils  # noqa: F401
+from infiagent.prompt import IncrementalPrompt, ZeroShotReactPrompt
+from infiagent.schemas import AgentAction, AgentObservation
+
+
+def _steps(count):
+    steps = []
+    for i in range(count):
+        steps.append(AgentAction(tool="python_code_sandbox", tool_input=f"print({i})", formatted_output="",
+                                 raw_output=f"Action {i} {{braces}}"))
+        steps.append(AgentObservation(tool="python_code_sandbox", formatted_output=f"{i}\n", raw_output=f"{i}\n"))
+    return steps
+
+
+def test_rendering_matches_full_template():
+    template = ZeroShotReactPrompt()
+    variables = {"instruction": "Plot {x}", "tool_description": "sandbox", "tool_names": "python_code_sandbox"}
+    prompt = IncrementalPrompt(template, **variables)
+    steps = _steps(3)
+    for count in [0, 1, 2, 4, 6, 2]:
+        expected = template.format(agent_scratchpad=template.construct_scratchpad(steps[:count]), **variables)
+        assert prompt.render(steps[:count]) == expected
+    assert prompt.matches(**variables)
+    assert not prompt.matches(**dict(variables, instruction="other"))
+
+
+def test_old_observations_are_cut_to_fit_the_budget():
+    template = ZeroShotReactPrompt()
+    variables = {"instruction": "Plot x", "tool_description": "sandbox", "tool_names": "python_code_sandbox"}
+    steps = _steps(3)
+    for step in steps[1::2]:
+        step.formatted_output = "\n".join(str(i) for i in range(1000))
+    full = IncrementalPrompt(template, **variables).render(steps)
+    prompt = IncrementalPrompt(template, count_tokens=len, max_tokens=len(full) - 3000, **variables).render(steps)
+    assert len(prompt) <= len(full) - 3000
+    assert prompt.startswith("Answer the following questions") and "Question: Plot x" in prompt
+    # The latest observation is whole, the first one cut
+    assert prompt.endswith(steps[-1].formatted_output + "\n\nThought:\n\n")
+    assert prompt.count("more characters of this output were left out") == 1
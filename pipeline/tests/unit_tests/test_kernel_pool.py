@@ -0,0 +1,90 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from infiagent.exceptions.exceptions import InvalidConfigException
+from infiagent.tools.code_sandbox.kernel_pool import KernelHandle, KernelPool
+from infiagent.tools.code_sandbox.python_code_sandbox import AsyncPythonSandBoxTool
+
+
+def _fake_launcher():
+    launched = []
+
+    async def launch():
+        process = MagicMock()
+        process.returncode = None
+        handle = KernelHandle(kernel_id=str(len(launched)), client=MagicMock(), process=process,
+                              kernel_dir=f"/nonexistent/{len(launched)}")
+        launched.append(handle)
+        return handle
+
+    return launch, launched
+
+
+def test_invalid_config():
+    launch, _ = _fake_launcher()
+    with pytest.raises(InvalidConfigException):
+        KernelPool(launch, warm_size=2, high_water_mark=1)
+    with pytest.raises(InvalidConfigException):
+        KernelPool(launch, warm_size=1, refill_rate=0)
+
+
+def test_lease_from_warm_pool():
+    launch, launched = _fake_launcher()
+    pool = KernelPool(launch, warm_size=2, refill_rate=1000)
+
+    async def run():
+        pool.fill()
+        await asyncio.sleep(0.1)
+        assert pool.idle_count == 2
+        handle = await pool.lease()
+        assert handle is launched[0]
+        await asyncio.sleep(0.1)
+        assert pool.idle_count == 2
+        pool.close()
+
+    asyncio.run(run())
+    assert len(launched) == 3
+
+
+def test_lease_on_demand_and_retire():
+    launch, launched = _fake_launcher()
+    pool = KernelPool(launch)
+
+    async def run():
+        handle = await pool.lease()
+        pool.release(handle)
+        return handle
+
+    handle = asyncio.run(run())
+    assert len(launched) == 1
+    assert pool.idle_count == 0
+    handle.client.shutdown.assert_called_once()
+
+
+def test_recycle_up_to_high_water_mark():
+    launch, _ = _fake_launcher()
+    pool = KernelPool(launch, high_water_mark=1, recycle_kernels=True, reset_code="%reset -f")
+
+    async def run():
+        first, second = await pool.lease(), await pool.lease()
+        first.client.execute_interactive = AsyncMock()
+        second.client.execute_interactive = AsyncMock()
+        pool.release(first)
+        pool.release(second)
+        await asyncio.sleep(0.1)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert pool.idle_count == 1
+    first.client.execute_interactive.assert_called_once()
+    second.client.shutdown.assert_called_once()
+
+
+def test_cpu_limit_is_rejected_with_recycled_kernels(monkeypatch):
+    monkeypatch.setattr(AsyncPythonSandBoxTool, "_KERNEL_POOL", None)
+    with pytest.raises(InvalidConfigException):
+        AsyncPythonSandBoxTool.configure_kernels({'kernel_pool': {'recycle_kernels': True},
+                                                  'kernel_limits': {'cpu_time_limit': 60}})
+    assert AsyncPythonSandBoxTool._KERNEL_POOL is None
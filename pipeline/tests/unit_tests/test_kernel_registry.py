@@ -0,0 +1,72 @@
+import asyncio
+from unittest.mock import MagicMock
+
+import pytest
+
+from infiagent.exceptions.exceptions import InvalidConfigException
+from infiagent.tools.code_sandbox.kernel_pool import KernelHandle
+from infiagent.tools.code_sandbox.kernel_registry import KernelRegistry
+
+
+def _handle(kernel_id):
+    process = MagicMock()
+    process.returncode = None
+    return KernelHandle(kernel_id=kernel_id, client=MagicMock(), process=process, kernel_dir="/nonexistent")
+
+
+def test_invalid_config():
+    with pytest.raises(InvalidConfigException):
+        KernelRegistry(on_evict=MagicMock(), max_live_kernels=0)
+    with pytest.raises(InvalidConfigException):
+        KernelRegistry(on_evict=MagicMock(), idle_ttl=-1)
+
+
+def test_lru_eviction():
+    on_evict = MagicMock()
+    registry = KernelRegistry(on_evict=on_evict, max_live_kernels=2)
+    first, second, third = _handle("a"), _handle("b"), _handle("c")
+    registry.add("s1", first)
+    registry.add("s2", second)
+    registry.get("s1")
+    registry.add("s3", third)
+
+    assert "s2" not in registry
+    assert len(registry) == 2
+    on_evict.assert_called_once_with("s2", second)
+    assert registry.metrics()["evicted_lru"] == 1
+
+
+def test_busy_kernel_is_not_evicted():
+    on_evict = MagicMock()
+    registry = KernelRegistry(on_evict=on_evict, max_live_kernels=1)
+    busy = _handle("a")
+
+    async def run():
+        async with busy.lock:
+            registry.add("s1", busy)
+            registry.add("s2", _handle("b"))
+            assert registry.metrics()["busy"] == 1
+
+    asyncio.run(run())
+    assert "s1" in registry and "s2" in registry
+    on_evict.assert_not_called()
+
+
+def test_reap_idle_and_dead_kernels():
+    on_evict = MagicMock()
+    registry = KernelRegistry(on_evict=on_evict, idle_ttl=0.01)
+    dead = _handle("a")
+    dead.process.returncode = 1
+    registry.add("s1", dead)
+    registry.add("s2", _handle("b"))
+
+    async def run():
+        await asyncio.sleep(0.05)
+        registry.reap()
+
+    asyncio.run(run())
+    assert len(registry) == 0
+    metrics = registry.metrics()
+    assert metrics["evicted_dead"] == 1
+    assert metrics["evicted_idle_ttl"] == 1
+    assert metrics["live"] == 0
@@ -0,0 +1,40 @@
+import json
+import os
+import types
+
+from infiagent.tools.code_sandbox.kernel_snapshot import (RESTORE_PY, SNAPSHOT_MANIFEST, SNAPSHOT_PY,
+                                                          referenced_names)
+
+
+def _kernel(user_ns):
+    shell = types.SimpleNamespace(user_ns=user_ns, user_ns_hidden={})
+    namespace = {'get_ipython': lambda: shell}
+    exec(SNAPSHOT_PY + RESTORE_PY, namespace)
+    return namespace['_infiagent_snapshot'], namespace['_infiagent_restore']
+
+
+def test_referenced_names():
+    assert referenced_names("import numpy.linalg\ny = x + 1\ndel z") == ["numpy", "x", "y", "z"]
+    assert referenced_names("%matplotlib inline") is None
+    assert referenced_names("globals()['x'] = 1") is None
+
+
+def test_snapshot_writes_only_the_given_names(tmp_path):
+    snapshot_dir = str(tmp_path / ".snapshot")
+    user_ns = {'x': 1, 'y': [1], 'os': os}
+    snapshot, _ = _kernel(user_ns)
+    snapshot(snapshot_dir, None)
+    y_mtime = os.stat(os.path.join(snapshot_dir, "y.pkl")).st_mtime_ns
+
+    user_ns['x'] = 2
+    user_ns['z'] = 'new'
+    del user_ns['os']
+    snapshot(snapshot_dir, ['os', 'x', 'z'])
+    with open(os.path.join(snapshot_dir, SNAPSHOT_MANIFEST)) as fp:
+        assert sorted(json.load(fp)) == ['x', 'y', 'z']
+    assert os.stat(os.path.join(snapshot_dir, "y.pkl")).st_mtime_ns == y_mtime
+
+    restored = {}
+    _, restore = _kernel(restored)
+    restore(snapshot_dir)
+    assert restored == {'x': 2, 'y': [1], 'z': 'new'}
@@ -0,0 +1,69 @@
+import asyncio
+import subprocess
+import sys
+from unittest.mock import MagicMock
+
+from infiagent.tools.code_sandbox import python_code_sandbox
+from infiagent.tools.code_sandbox.kernel_launcher import WATCH_WORKER_PY
+from infiagent.tools.code_sandbox.kernel_pool import KernelHandle, KernelPool
+from infiagent.tools.code_sandbox.kernel_registry import KernelRegistry
+from infiagent.tools.code_sandbox.kernel_zygote import KernelZygote
+from infiagent.tools.code_sandbox.python_code_sandbox import MAX_ZYGOTE_FAILURES, AsyncPythonSandBoxTool
+
+
+def test_unreachable_template_falls_back_to_cold_start(monkeypatch, tmp_path):
+    zygote = KernelZygote(preload_modules=[])
+    closed = []
+
+    async def start(startup_timeout=None):
+        # Alive as far as the process goes, but nothing listens on the socket
+        zygote._socket_dir = str(tmp_path)
+
+    async def launch_kernel(pool_dir, cwd, startup_timeout, rlimits):
+        return KernelHandle(kernel_id="cold", client=MagicMock(), process=MagicMock(), kernel_dir=str(tmp_path))
+
+    monkeypatch.setattr(zygote, "start", start)
+    monkeypatch.setattr(zygote, "close", lambda: closed.append(True))
+    monkeypatch.setattr(python_code_sandbox, "launch_kernel", launch_kernel)
+    monkeypatch.setattr(python_code_sandbox, "KERNEL_POOL_DIR", str(tmp_path))
+    monkeypatch.setattr(AsyncPythonSandBoxTool, "_KERNEL_ZYGOTE", zygote)
+    monkeypatch.setattr(AsyncPythonSandBoxTool, "_ZYGOTE_FAILURES", 0)
+
+    async def run():
+        return [await AsyncPythonSandBoxTool._start_kernel() for _ in range(MAX_ZYGOTE_FAILURES)]
+
+    handles = asyncio.run(run())
+    assert [handle.kernel_id for handle in handles] == ["cold"] * MAX_ZYGOTE_FAILURES
+    # Closed after every failed fork so the next one restarts it, then disabled
+    assert len(closed) == MAX_ZYGOTE_FAILURES + 1
+    assert AsyncPythonSandBoxTool._KERNEL_ZYGOTE is None
+
+
+def test_kernel_exits_with_its_worker():
+    worker = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(0.5)"])
+    kernel = subprocess.Popen([sys.executable, "-c",
+                               f"worker_pid = {worker.pid}\n{WATCH_WORKER_PY}\nimport time\ntime.sleep(30)"])
+    try:
+        worker.wait()
+        assert kernel.wait(timeout=10) == 1
+    finally:
+        kernel.kill()
+
+
+def test_shutdown_kills_every_kernel(monkeypatch, tmp_path):
+    zygote = MagicMock()
+    registry = KernelRegistry(on_evict=lambda sandbox_id, handle: None)
+    pool = KernelPool(launcher=MagicMock())
+    leased = KernelHandle(kernel_id="leased", client=MagicMock(), process=MagicMock(), kernel_dir=str(tmp_path))
+    idle = KernelHandle(kernel_id="idle", client=MagicMock(), process=MagicMock(), kernel_dir=str(tmp_path))
+    registry.add("session", leased)
+    pool._idle.append(idle)
+    monkeypatch.setattr(AsyncPythonSandBoxTool, "_KERNEL_ZYGOTE", zygote)
+    monkeypatch.setattr(AsyncPythonSandBoxTool, "_KERNEL_REGISTRY", registry)
+    monkeypatch.setattr(AsyncPythonSandBoxTool, "_KERNEL_POOL", pool)
+
+    AsyncPythonSandBoxTool.shutdown_kernels()
+    zygote.close.assert_called_once()
+    leased.process.kill.assert_called_once()
+    idle.process.kill.assert_called_once()
+    assert len(registry) == 0 and pool.idle_count == 0
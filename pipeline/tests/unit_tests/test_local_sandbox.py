@@ -0,0 +1,95 @@
+import asyncio
+import os
+
+from infiagent.tools import LocalSandboxTool, SandboxCapability
+from infiagent.agent.react.async_react_agent import AsyncReactAgent
+from infiagent.conversation_sessions import CodeInterpreterSession
+from infiagent.llm import BaseLLM
+from infiagent.prompt import ZeroShotReactPrompt
+
+
+def _run(tmp_path, steps, time_out=10):
+    async def run():
+        sandbox = LocalSandboxTool(name="python_code_sandbox", description="", time_out=time_out,
+                                   work_dir=str(tmp_path))
+        await sandbox.set_sandbox_id("local-test")
+        try:
+            return [await sandbox.async_run(f"```python\n{code}\n```") for code in steps]
+        finally:
+            await sandbox.close()
+
+    return asyncio.run(run())
+
+
+def test_variables_persist_and_files_are_reported(tmp_path):
+    first, second = _run(tmp_path, ["x = 20\nopen('out.csv', 'w').write('a')", "print(x + 1)"])
+    assert first.succeeded
+    assert [file.sandbox_path for file in first.output_files] == [os.path.join(str(tmp_path), "local-test", "out.csv")]
+    assert second.raw_output == "21\n"
+    assert second.output_files == []
+
+
+def test_errors_and_timeouts_fail_the_step(tmp_path):
+    error, timeout, after = _run(tmp_path, ["1 / 0", "x = 1\nimport time\ntime.sleep(5)", "print(x)"], time_out=0.5)
+    assert not error.succeeded and "ZeroDivisionError" in error.raw_output
+    assert not timeout.succeeded and "KeyboardInterrupt" in timeout.output_text
+    # Interrupted, not killed, the session keeps its variables
+    assert after.raw_output == "1\n"
+
+
+def test_capabilities():
+    sandbox = LocalSandboxTool(name="python_code_sandbox", description="")
+    assert sandbox.supports(SandboxCapability.STATEFUL)
+    assert not sandbox.supports(SandboxCapability.ISOLATED)
+
+
+def test_repl_exited_on_idle_timeout_is_restarted(tmp_path):
+    async def run():
+        sandbox = LocalSandboxTool(name="python_code_sandbox", description="", idle_timeout=0.5,
+                                   work_dir=str(tmp_path))
+        await sandbox.set_sandbox_id("local-test")
+        try:
+            await sandbox.async_run("```python\nx = 1\n```")
+            await asyncio.sleep(1.5)
+            assert not sandbox._repl.is_running()
+            return await sandbox.async_run("```python\nprint('x' in dir())\n```")
+        finally:
+            await sandbox.close()
+
+    response = asyncio.run(run())
+    assert response.succeeded and response.raw_output == "False\n"
+
+
+def test_cancelled_cell_is_interrupted(tmp_path):
+    async def run():
+        sandbox = LocalSandboxTool(name="python_code_sandbox", description="", work_dir=str(tmp_path))
+        await sandbox.set_sandbox_id("local-test")
+        try:
+            await sandbox.async_run("```python\nx = 1\n```")
+            cell = asyncio.ensure_future(sandbox.async_run("```python\nimport time\ntime.sleep(30)\n```"))
+            await asyncio.sleep(0.5)
+            cell.cancel()
+            await asyncio.gather(cell, return_exceptions=True)
+            # Stopped, not left running ahead of the next cell, which gets its own reply
+            return await asyncio.wait_for(sandbox.async_run("```python\nprint(x)\n```"), timeout=5)
+        finally:
+            await sandbox.close()
+
+    assert asyncio.run(run()).raw_output == "1\n"
+
+
+def test_closing_the_session_stops_the_repl(tmp_path):
+    async def run():
+        agent = AsyncReactAgent(prompt_template=ZeroShotReactPrompt())
+        agent.llm = BaseLLM(model_name="test", params={})
+        sandbox = LocalSandboxTool(name="python_code_sandbox", description="", work_dir=str(tmp_path))
+        await sandbox.set_sandbox_id("local-test")
+        agent.add_plugin(sandbox.name, sandbox)
+        session = CodeInterpreterSession(session_id="local-test", agent=agent)
+        await sandbox.async_run("```python\nx = 1\n```")
+        process = sandbox._repl._process
+        await session.close()
+        await asyncio.sleep(0.5)
+        return process
+
+    assert asyncio.run(run()).poll() is not None
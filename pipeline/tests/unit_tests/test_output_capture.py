@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+from infiagent.exceptions.exceptions import InvalidConfigException
+from infiagent.tools.code_sandbox.output_capture import OutputCapture, coalesce_chunks
+
+
+def test_small_output_is_kept_verbatim():
+    capture = OutputCapture(head_size=10, tail_size=10)
+    assert capture.write("hello ") == "hello "
+    assert capture.write("world") == "worl"
+    assert capture.getvalue() == "hello world"
+    assert not capture.truncated
+
+
+def test_large_output_keeps_head_and_tail():
+    capture = OutputCapture(head_size=5, tail_size=5)
+    for i in range(1000):
+        capture.write(f"{i:04d}")
+    value = capture.getvalue()
+    assert capture.truncated
+    assert capture.total_size == 4000
+    assert value.startswith("00000")
+    assert value.endswith("80999")
+    assert "[3990 characters truncated]" in value
+
+
+def test_chunk_larger_than_the_tail_keeps_only_its_end():
+    capture = OutputCapture(head_size=5, tail_size=5)
+    capture.write("x" * 100000 + "12345")
+    assert sum(len(chunk) for chunk in capture._tail) == 5
+    assert capture.getvalue() == "xxxxx\n...... [99995 characters truncated] ......\n12345"
+
+
+def test_invalid_sizes():
+    with pytest.raises(InvalidConfigException):
+        OutputCapture(head_size=-1)
+
+
+def test_coalesce_chunks_merges_queued_text():
+    async def run():
+        chunks = asyncio.Queue()
+        for text in ["a", "b", None]:
+            chunks.put_nowait(text)
+        return [text async for text in coalesce_chunks(chunks, coalesce_interval=0)]
+
+    assert asyncio.run(run()) == ["ab"]
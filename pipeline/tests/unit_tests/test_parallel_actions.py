@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+import infiagent.utils  # noqa: F401
+from infiagent.agent.react.async_react_agent import AsyncReactAgent
+from infiagent.exceptions.exceptions import SandboxException
+from infiagent.llm import BaseLLM
+from infiagent.prompt import ZeroShotReactPrompt
+from infiagent.schemas import AgentMultiAction, BaseCompletion
+from infiagent.tools import LocalSandboxTool
+
+COMPLETION = ("Thought: check both\n"
+              "Action: python_code_sandbox\nAction Input:\n```python\nx = 6\n```\n"
+              "Then Action: python_code_sandbox\nAction Input:\n```python\nprint(x * 7)\n```\n"
+              "Action: python_code_sandbox\nAction Input:\n```python\nprint('other')\n```\n"
+              "Observation: made up")
+
+
+class _LLM(BaseLLM):
+    async def async_completion(self, prompt, **kwargs):
+        return BaseCompletion(state="success", content=COMPLETION)
+
+
+def test_actions_of_one_output_run_in_the_same_round(tmp_path):
+    async def run():
+        agent = AsyncReactAgent(prompt_template=ZeroShotReactPrompt(), parallel_actions=True)
+        agent.llm = _LLM(model_name="test", params={})
+        sandbox = LocalSandboxTool(name="python_code_sandbox", description="", work_dir=str(tmp_path))
+        await sandbox.set_sandbox_id("parallel")
+        agent.add_plugin(sandbox.name, sandbox)
+        try:
+            responses = [response async for response in agent._chat("question", max_iterations=1)]
+        finally:
+            await sandbox.close()
+        return agent.intermediate_steps, responses
+
+    (action, observation), responses = asyncio.run(run())
+    assert isinstance(action, AgentMultiAction)
+    assert [step.after_previous for step in action.actions] == [False, True, False]
+    assert "made up" not in action.raw_output
+    assert "42" in observation.raw_output and "other" in observation.raw_output
+    assert observation.raw_output.index("42") < observation.raw_output.index("other")
+
+
+class _FailingSandbox(LocalSandboxTool):
+    async def async_run(self, req):
+        raise SandboxException("sandbox down")
+
+
+def test_first_failure_cancels_the_other_actions(tmp_path):
+    async def run():
+        agent = AsyncReactAgent(prompt_template=ZeroShotReactPrompt(), parallel_actions=True)
+        sandbox = LocalSandboxTool(name="python_code_sandbox", description="", work_dir=str(tmp_path))
+        failing = _FailingSandbox(name="failing_sandbox", description="", work_dir=str(tmp_path))
+        for plugin in [sandbox, failing]:
+            await plugin.set_sandbox_id("parallel")
+            agent.add_plugin(plugin.name, plugin)
+        response = agent._parse_multi_action(
+            "Action: python_code_sandbox\nAction Input:\n```python\nimport time\ntime.sleep(30)\n```\n"
+            "Action: failing_sandbox\nAction Input:\n```python\npass\n```\n")
+        try:
+            with pytest.raises(SandboxException):
+                await asyncio.wait_for(agent._process_agent_actions(response, 1, 1), timeout=10)
+            # The sleeping cell was interrupted, the session is free again
+            return await asyncio.wait_for(sandbox.async_run("```python\nprint('free')\n```"), timeout=5)
+        finally:
+            await sandbox.close()
+
+    assert asyncio.run(run()).raw_output == "free\n"
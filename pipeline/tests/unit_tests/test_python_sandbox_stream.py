@@ -0,0 +1,108 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+from infiagent.tools.code_sandbox import python_code_sandbox
+from infiagent.tools.code_sandbox.kernel_pool import KernelHandle
+from infiagent.tools.code_sandbox.kernel_registry import EVICT_REASON_IDLE_TTL, KernelRegistry
+from infiagent.tools.code_sandbox.python_code_sandbox import (KERNEL_RESTARTED_NOTICE, AsyncPythonSandBoxTool,
+                                                              PythonSandBoxToolResponse, _Type)
+
+
+def _sandbox(monkeypatch, outputs, delay):
+    handle = KernelHandle(kernel_id="0", client=MagicMock(), process=MagicMock(), kernel_dir="/nonexistent/0")
+
+    async def lease_kernel(self):
+        return handle
+
+    async def execute_code(handle, code, timeout=None, output_queue=None, artifact_store=None, notice=None):
+        for text in outputs:
+            await output_queue.put(text)
+            await asyncio.sleep(delay)
+        return PythonSandBoxToolResponse(sand_box_response=''.join(outputs), _type=_Type.SUCCESS)
+
+    monkeypatch.setattr(AsyncPythonSandBoxTool, "_lease_kernel", lease_kernel)
+    monkeypatch.setattr(AsyncPythonSandBoxTool, "_execute_code", staticmethod(execute_code))
+    monkeypatch.setattr(AsyncPythonSandBoxTool, "_kernel_registry", classmethod(lambda cls: MagicMock()))
+    sandbox = AsyncPythonSandBoxTool(name="python_code_sandbox", description="")
+    asyncio.run(sandbox.set_sandbox_id("nonexistent-stream-test"))
+    return sandbox
+
+
+def _collect(sandbox, coalesce_interval):
+    async def run():
+        return [chunk async for chunk in sandbox.async_stream("```python\npass\n```", coalesce_interval)]
+
+    return asyncio.run(run())
+
+
+def test_stream_yields_chunks_then_response(monkeypatch):
+    sandbox = _sandbox(monkeypatch, ["a", "b", "c"], delay=0.05)
+    chunks = _collect(sandbox, coalesce_interval=0)
+    assert chunks[:-1] == ["a", "b", "c"]
+    assert isinstance(chunks[-1], PythonSandBoxToolResponse)
+    assert chunks[-1].raw_output == "abc"
+
+
+def test_stream_coalesces_fast_output(monkeypatch):
+    sandbox = _sandbox(monkeypatch, [str(i) for i in range(10)], delay=0)
+    chunks = _collect(sandbox, coalesce_interval=0.05)
+    assert ''.join(chunks[:-1]) == "0123456789"
+    assert len(chunks) < 11
+
+
+def test_session_is_told_when_its_kernel_was_evicted(monkeypatch, tmp_path):
+    registry = KernelRegistry(on_evict=MagicMock())
+    pool = MagicMock()
+    pool.lease = AsyncMock(side_effect=lambda: KernelHandle(kernel_id="0", client=AsyncMock(), process=MagicMock(),
+                                                            kernel_dir=str(tmp_path)))
+
+    async def execute_code(handle, code, timeout=None, output_queue=None, artifact_store=None, notice=None):
+        return PythonSandBoxToolResponse(sand_box_response=notice or "", _type=_Type.SUCCESS)
+
+    monkeypatch.setattr(python_code_sandbox, "WORK_DIR", str(tmp_path))
+    monkeypatch.setattr(AsyncPythonSandBoxTool, "_execute_code", staticmethod(execute_code))
+    monkeypatch.setattr(AsyncPythonSandBoxTool, "_kernel_registry", classmethod(lambda cls: registry))
+    monkeypatch.setattr(AsyncPythonSandBoxTool, "_kernel_pool", classmethod(lambda cls: pool))
+    monkeypatch.setattr(AsyncPythonSandBoxTool, "_KERNEL_SNAPSHOT", False)
+    sandbox = AsyncPythonSandBoxTool(name="python_code_sandbox", description="")
+
+    async def run():
+        await sandbox.set_sandbox_id("evicted")
+        outputs = [(await sandbox.async_run("x = 1")).raw_output]
+        registry.evict("evicted", EVICT_REASON_IDLE_TTL)
+        outputs.append((await sandbox.async_run("print(x)")).raw_output)
+        outputs.append((await sandbox.async_run("print(x)")).raw_output)
+        return outputs
+
+    assert asyncio.run(run()) == ["", KERNEL_RESTARTED_NOTICE, ""]
+
+
+def test_cancelled_execution_stops_the_kernel(monkeypatch):
+    client = MagicMock()
+    client.wait_for_ready = AsyncMock()
+    client.execute.return_value = "msg"
+
+    async def get_iopub_msg(timeout=None):
+        await asyncio.sleep(3600)
+
+    client.get_iopub_msg = get_iopub_msg
+    process = MagicMock()
+    process.returncode = None
+    handle = KernelHandle(kernel_id="0", client=client, process=process, kernel_dir="/nonexistent/0")
+    interrupt = AsyncMock(return_value=False)
+    monkeypatch.setattr(AsyncPythonSandBoxTool, "_interrupt_kernel", staticmethod(interrupt))
+
+    async def run():
+        execution = asyncio.ensure_future(AsyncPythonSandBoxTool._execute_code(handle, "while True: pass"))
+        await asyncio.sleep(0.1)
+        execution.cancel()
+        try:
+            await execution
+        except asyncio.CancelledError:
+            return True
+        return False
+
+    assert asyncio.run(run())
+    interrupt.assert_awaited_once_with(handle, "msg")
+    # Not interrupted in time, killed
+    assert handle.killed
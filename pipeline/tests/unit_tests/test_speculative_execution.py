@@ -0,0 +1,58 @@
+import asyncio
+
+import infiagent.utils  # noqa: F401
+from infiagent.agent.react.async_react_agent import AsyncReactAgent
+from infiagent.llm import BaseLLM
+from infiagent.prompt import ZeroShotReactPrompt
+from infiagent.schemas import BaseCompletion
+from infiagent.tools import LocalSandboxTool
+
+EVENTS = []
+
+
+class _SlowToStopLLM(BaseLLM):
+    code = "print(6 * 7)"
+
+    async def async_stream_completion(self, prompt, **kwargs):
+        try:
+            for chunk in ["Action: python_code_sandbox\nAction Input:\n```python\n", f"{self.code}\n```", "\nObserv"]:
+                yield BaseCompletion(state="success", content=chunk)
+        finally:
+            # Closing the connection to the server takes a while
+            await asyncio.sleep(0.5)
+            EVENTS.append("generation stopped")
+
+
+class _Sandbox(LocalSandboxTool):
+    async def async_run(self, req):
+        EVENTS.append("code started")
+        return await super().async_run(req)
+
+
+def _chat(tmp_path, code):
+    async def run():
+        agent = AsyncReactAgent(prompt_template=ZeroShotReactPrompt(), speculative_execution=True)
+        agent.llm = _SlowToStopLLM(model_name="test", params={})
+        agent.llm.code = code
+        sandbox = _Sandbox(name="python_code_sandbox", description="", work_dir=str(tmp_path))
+        await sandbox.set_sandbox_id("speculative")
+        agent.add_plugin(sandbox.name, sandbox)
+        try:
+            return [response async for response in agent._chat("question", max_iterations=1)]
+        finally:
+            await sandbox.close()
+
+    EVENTS.clear()
+    return asyncio.run(run())
+
+
+def test_code_runs_while_the_generation_stops(tmp_path):
+    responses = _chat(tmp_path, "print(6 * 7)")
+    assert EVENTS == ["code started", "generation stopped"]
+    assert "42" in responses[-1].output_text
+
+
+def test_code_with_side_effects_waits_for_the_step(tmp_path):
+    responses = _chat(tmp_path, "x = 6 * 7\nprint(x)")
+    assert EVENTS == ["generation stopped", "code started"]
+    assert "42" in responses[-1].output_text
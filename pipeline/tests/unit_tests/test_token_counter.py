@@ -0,0 +1,36 @@
+import asyncio
+import threading
+import time
+
+import infiagent.utils  # noqa: F401
+from infiagent.llm import token_counter
+from infiagent.llm.token_counter import TokenCounter
+
+
+class _Tokenizer:
+    def encode(self, text, add_special_tokens=False):
+        return text.split()
+
+
+def test_tokenizer_loads_off_the_event_loop(monkeypatch):
+    loaded = threading.Event()
+
+    class _AutoTokenizer:
+        @staticmethod
+        def from_pretrained(name):
+            time.sleep(0.2)
+            loaded.set()
+            return _Tokenizer()
+
+    monkeypatch.setattr(token_counter, "AutoTokenizer", _AutoTokenizer)
+    monkeypatch.setattr(TokenCounter, "_TOKENIZERS", {})
+
+    async def run():
+        counter = TokenCounter("slow-tokenizer")
+        # Estimated while the tokenizer loads in the background, the loop is not held up
+        estimated = counter.count("one two three four")
+        assert not loaded.is_set()
+        await counter.load()
+        return estimated, counter.count("one two three four")
+
+    assert asyncio.run(run()) == (6, 4)